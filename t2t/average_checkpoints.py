@@ -0,0 +1,235 @@
+# coding=utf-8
+r"""Streaming checkpoint averaging.
+
+Unlike t2t's avg_checkpoints.py, this script does not load all
+checkpoints into memory. Each variable is averaged separately by reading
+it from one checkpoint after the other and adding it to a running sum
+which is a memory-mapped file in `scratch_dir`. Variables are
+distributed over `num_workers` processes, so peak memory is roughly
+`num_workers` times the size of the largest variable plus one output
+shard (see checkpoint_writer.py).
+
+Checkpoints are ordered by training step. The average can be uniform,
+weighted with explicit `weights`, or an exponential moving average over
+the checkpoints (`ema_decay`). With `dev_scores` and `top_k`, only the
+k checkpoints with the best dev set scores are averaged.
+
+  python average_checkpoints.py --prefix train/ \
+    --checkpoints model.ckpt-10000,model.ckpt-11000,model.ckpt-12000 \
+    --dev_scores dev_bleu.txt --top_k 2 --output_path train/avg/avg_2
+
+Non-float variables such as global_step are copied from the latest
+checkpoint.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import checkpoint_writer
+
+flags = tf.flags
+FLAGS = flags.FLAGS
+
+flags.DEFINE_string("checkpoints", "",
+                    "Comma-separated list of checkpoints to average.")
+flags.DEFINE_string("prefix", "",
+                    "Prefix (e.g., directory) to append to each checkpoint.")
+flags.DEFINE_integer("num_last_checkpoints", 0,
+                     "Averages the last N saved checkpoints. If the "
+                     "checkpoints flag is set, this is ignored.")
+flags.DEFINE_string("dev_scores", "",
+                    "Text file with lines '<checkpoint> <score>'. The "
+                    "checkpoint can be given by its name (model.ckpt-1000), "
+                    "its path, or its training step.")
+flags.DEFINE_integer("top_k", 0,
+                     "If positive, average only the top_k checkpoints with "
+                     "the best scores in dev_scores.")
+flags.DEFINE_bool("lower_is_better", False,
+                  "Whether lower dev scores are better (e.g. perplexity).")
+flags.DEFINE_string("weights", "",
+                    "Comma-separated weights for the (selected) checkpoints "
+                    "in order of their training step. Normalized to sum to 1.")
+flags.DEFINE_float("ema_decay", 0.0,
+                   "If positive, use an exponential moving average over the "
+                   "checkpoints in order of their training step instead of "
+                   "the uniform average.")
+flags.DEFINE_integer("num_workers", 4,
+                     "Number of processes which average variables in parallel.")
+flags.DEFINE_string("scratch_dir", "",
+                    "Directory for the memory-mapped running sums. Defaults "
+                    "to the output directory.")
+flags.DEFINE_integer("shard_size_mb", 512,
+                     "Size of the output checkpoint shards.")
+flags.DEFINE_string("output_path", "/tmp/averaged.ckpt",
+                    "Path to output the averaged checkpoint to.")
+
+
+def checkpoint_exists(path):
+  return (tf.gfile.Exists(path) or tf.gfile.Exists(path + ".meta") or
+          tf.gfile.Exists(path + ".index"))
+
+
+def checkpoint_step(path):
+  """Training step of a checkpoint from its name or global_step."""
+  match = re.search(r"-(\d+)$", path)
+  if match:
+    return int(match.group(1))
+  reader = tf.contrib.framework.load_checkpoint(path)
+  if reader.has_tensor("global_step"):
+    return int(reader.get_tensor("global_step"))
+  return -1
+
+
+def get_checkpoints():
+  if FLAGS.checkpoints:
+    checkpoints = [c.strip() for c in FLAGS.checkpoints.split(",")]
+    checkpoints = [FLAGS.prefix + c for c in checkpoints if c]
+  elif FLAGS.num_last_checkpoints:
+    checkpoint_state = tf.train.get_checkpoint_state(
+        os.path.dirname(FLAGS.prefix))
+    checkpoints = checkpoint_state.all_model_checkpoint_paths[
+        -FLAGS.num_last_checkpoints:]
+  else:
+    raise ValueError("Specify either checkpoints or num_last_checkpoints")
+  checkpoints = [c for c in checkpoints if checkpoint_exists(c)]
+  if not checkpoints:
+    raise ValueError("None of the checkpoints exist")
+  return sorted(checkpoints, key=checkpoint_step)
+
+
+def read_dev_scores(path):
+  scores = {}
+  with open(path) as reader:
+    for line in reader:
+      parts = line.strip().split()
+      if len(parts) >= 2:
+        scores[parts[0]] = float(parts[1])
+  return scores
+
+
+def select_top_k(checkpoints, scores, k, lower_is_better):
+  """Selects the k best checkpoints and keeps them in step order."""
+  def get_score(path):
+    for key in [path, os.path.basename(path), str(checkpoint_step(path))]:
+      if key in scores:
+        return scores[key]
+    raise ValueError("No dev score for checkpoint %s" % path)
+  ranked = sorted(checkpoints, key=get_score, reverse=not lower_is_better)
+  for path in ranked:
+    tf.logging.info("Dev score %f: %s" % (get_score(path), path))
+  selected = set(ranked[:k])
+  return [c for c in checkpoints if c in selected]
+
+
+def get_weights(n):
+  """Normalized averaging weights for n checkpoints in step order."""
+  if FLAGS.weights:
+    weights = [float(w) for w in FLAGS.weights.split(",")]
+    if len(weights) != n:
+      raise ValueError("Got %d weights for %d checkpoints"
+                       % (len(weights), n))
+  elif FLAGS.ema_decay > 0.0:
+    # ema = decay * ema + (1 - decay) * x, initialized with the first
+    # checkpoint
+    d = FLAGS.ema_decay
+    weights = [d ** (n - 1)] + [(1.0 - d) * d ** (n - 1 - i)
+                                for i in xrange(1, n)]
+  else:
+    weights = [1.0] * n
+  total = sum(weights)
+  if total <= 0.0:
+    raise ValueError("Weights must sum to a positive value")
+  return [w / total for w in weights]
+
+
+def check_variables(checkpoints):
+  """Checks that all checkpoints have the same variables and shapes."""
+  var_list = tf.contrib.framework.list_variables(checkpoints[0])
+  for path in checkpoints[1:]:
+    if tf.contrib.framework.list_variables(path) != var_list:
+      raise ValueError("Variables in %s differ from %s"
+                       % (path, checkpoints[0]))
+  return var_list
+
+
+# Checkpoint readers of the worker process
+_readers = None
+
+
+def _init_worker(checkpoints):
+  global _readers
+  _readers = [tf.contrib.framework.load_checkpoint(c) for c in checkpoints]
+
+
+def _average_variable(args):
+  """Averages one variable over all checkpoints into a .npy file."""
+  name, weights, path = args
+  start_time = time.time()
+  acc = None
+  for reader, weight in zip(_readers, weights):
+    tensor = reader.get_tensor(name)
+    if not np.issubdtype(tensor.dtype, np.floating):
+      np.save(path, _readers[-1].get_tensor(name))
+      return name, path, time.time() - start_time
+    if acc is None:
+      acc = np.lib.format.open_memmap(path, mode="w+", dtype=tensor.dtype,
+                                      shape=tensor.shape)
+      np.multiply(tensor, weight, out=acc)
+    else:
+      acc += tensor * weight
+    del tensor
+  acc.flush()
+  del acc
+  return name, path, time.time() - start_time
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  checkpoints = get_checkpoints()
+  if FLAGS.top_k > 0:
+    if not FLAGS.dev_scores:
+      raise ValueError("top_k requires dev_scores")
+    checkpoints = select_top_k(checkpoints, read_dev_scores(FLAGS.dev_scores),
+                               FLAGS.top_k, FLAGS.lower_is_better)
+  weights = get_weights(len(checkpoints))
+  for path, weight in zip(checkpoints, weights):
+    tf.logging.info("Averaging %s with weight %f" % (path, weight))
+  var_list = check_variables(checkpoints)
+  # Creates the output directory
+  writer = checkpoint_writer.CheckpointWriter(FLAGS.output_path,
+                                              FLAGS.shard_size_mb)
+  scratch_parent = FLAGS.scratch_dir or os.path.dirname(
+      os.path.abspath(FLAGS.output_path))
+  if not tf.gfile.Exists(scratch_parent):
+    tf.gfile.MakeDirs(scratch_parent)
+  scratch_dir = tempfile.mkdtemp(prefix="avg_scratch_", dir=scratch_parent)
+  tasks = [(name, weights, os.path.join(scratch_dir, "var%05d.npy" % idx))
+           for idx, (name, _) in enumerate(var_list)]
+  start_time = time.time()
+  pool = multiprocessing.Pool(FLAGS.num_workers, _init_worker, (checkpoints,))
+  try:
+    for name, path, duration in pool.imap(_average_variable, tasks):
+      tf.logging.info("Averaged %s in %.2fs" % (name, duration))
+      writer.add(name, np.load(path, mmap_mode="r"))
+    pool.close()
+    pool.join()
+    writer.close()
+  finally:
+    pool.terminate()
+    shutil.rmtree(scratch_dir, ignore_errors=True)
+  tf.logging.info("Averaged %d variables of %d checkpoints in %.1fs"
+                  % (len(var_list), len(checkpoints), time.time() - start_time))
+
+
+if __name__ == "__main__":
+  tf.app.run()
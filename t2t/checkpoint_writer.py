@@ -0,0 +1,101 @@
+# coding=utf-8
+r"""Writes TF checkpoints tensor by tensor without model variables.
+
+tf.train.Saver needs a variable and an assign op for each tensor and
+keeps all values in the session. CheckpointWriter instead collects
+numpy arrays until `shard_size_mb` is reached, writes them with a single
+SaveV2 op as one shard, and merges all shards into the final
+checkpoint like a sharded Saver does. At most one shard is kept in
+memory.
+
+  writer = checkpoint_writer.CheckpointWriter("/tmp/avg/model.ckpt-100")
+  writer.add("transformer/body/...", value)
+  writer.close()
+"""
+
+import os
+import uuid
+
+import numpy as np
+import tensorflow as tf
+from tensorflow.python.ops import io_ops
+
+
+class CheckpointWriter(object):
+  """Writes a checkpoint in the V2 format from numpy arrays."""
+
+  def __init__(self, output_path, shard_size_mb=512):
+    """Creates the writer.
+
+    Args:
+      output_path: Checkpoint prefix, e.g. /path/to/model.ckpt-1000
+      shard_size_mb: Size of the buffered tensors which triggers
+                     writing a shard
+    """
+    self.output_path = output_path
+    self.shard_size = shard_size_mb * 1024 * 1024
+    output_dir = os.path.dirname(os.path.abspath(output_path))
+    if not tf.gfile.Exists(output_dir):
+      tf.gfile.MakeDirs(output_dir)
+    self._temp_dir = "%s_temp_%s" % (output_path, uuid.uuid4().hex)
+    self._shard_prefixes = []
+    self._names = set()
+    self._buffer = []
+    self._buffered_bytes = 0
+
+  def add(self, name, value):
+    """Adds a tensor. Names must be unique."""
+    if name in self._names:
+      raise ValueError("Tensor %s was added twice" % name)
+    self._names.add(name)
+    value = np.asarray(value)
+    self._buffer.append((name, value))
+    self._buffered_bytes += value.nbytes
+    if self._buffered_bytes >= self.shard_size:
+      self._flush()
+
+  def _flush(self):
+    if not self._buffer:
+      return
+    prefix = os.path.join(self._temp_dir,
+                          "part-%05d" % len(self._shard_prefixes))
+    graph = tf.Graph()
+    with graph.as_default():
+      placeholders = [tf.placeholder(tf.as_dtype(value.dtype),
+                                     shape=value.shape)
+                      for _, value in self._buffer]
+      save_op = io_ops.save_v2(prefix, [name for name, _ in self._buffer],
+                               [""] * len(self._buffer), placeholders)
+      with tf.Session(graph=graph) as sess:
+        sess.run(save_op, {p: value for p, (_, value)
+                           in zip(placeholders, self._buffer)})
+    tf.logging.info("Wrote shard %d with %d tensors (%.1f MB)" % (
+        len(self._shard_prefixes), len(self._buffer),
+        self._buffered_bytes / 1048576.0))
+    self._shard_prefixes.append(prefix)
+    self._buffer = []
+    self._buffered_bytes = 0
+
+  def close(self, update_checkpoint_state=True):
+    """Writes the remaining tensors and merges the shards into
+    `output_path`. If `update_checkpoint_state` is true, the
+    `checkpoint` file in the output directory points to the new
+    checkpoint afterwards.
+    """
+    self._flush()
+    if not self._shard_prefixes:
+      raise ValueError("Cannot write an empty checkpoint")
+    graph = tf.Graph()
+    with graph.as_default():
+      merge_op = io_ops.merge_v2_checkpoints(
+          self._shard_prefixes, self.output_path, delete_old_dirs=True)
+      with tf.Session(graph=graph) as sess:
+        sess.run(merge_op)
+    if tf.gfile.Exists(self._temp_dir):
+      tf.gfile.DeleteRecursively(self._temp_dir)
+    if update_checkpoint_state:
+      tf.train.update_checkpoint_state(
+          os.path.dirname(os.path.abspath(self.output_path)),
+          os.path.abspath(self.output_path))
+    tf.logging.info("Wrote %d tensors to %s"
+                    % (len(self._names), self.output_path))
@@ -0,0 +1,144 @@
+# coding=utf-8
+r"""Columnar binary format for token-level statistics.
+
+The output is a directory with one raw little-endian binary file per
+column (<name>.bin), offsets.bin with the int64 start offset of each
+sentence plus the total number of tokens, and meta.json with the column
+names and dtypes. Columns can be memory-mapped with numpy:
+
+  import columnar_output
+  data = columnar_output.load("forced-decoding-out")
+  first_sen = slice(data.offsets[0], data.offsets[1])
+  print(data.columns["log_prob-0"][first_sen])
+"""
+
+import json
+import os
+
+import numpy as np
+
+BASE_COLUMNS = ["sen_idx", "word_idx", "trg_word"]
+
+
+class ColumnarOutputWriter(object):
+  """Appends token-level statistics to a columnar output directory.
+  Tokens are buffered and written to the column files in chunks of at
+  least `chunk_size` tokens.
+  """
+
+  def __init__(self, path, headers, chunk_size=100000):
+    """Creates the output directory.
+
+    Args:
+      path: Output directory
+      headers: Names of the statistics in each row passed to `write()`
+      chunk_size: Minimum number of tokens per write
+    """
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self.path = path
+    self.headers = headers
+    self.chunk_size = chunk_size
+    # Statistics which duplicate a base column are not stored twice
+    self.stat_columns = [(i, name) for i, name in enumerate(headers)
+                         if name not in BASE_COLUMNS]
+    self.columns = BASE_COLUMNS + [name for _, name in self.stat_columns]
+    self.dtypes = {"sen_idx": np.int32, "word_idx": np.int32,
+                   "trg_word": np.int32}
+    self.files = {name: open(os.path.join(path, "%s.bin" % name), "wb")
+                  for name in self.columns}
+    self.offsets_file = open(os.path.join(path, "offsets.bin"), "wb")
+    self.n_tokens = 0
+    self.n_sentences = 0
+    self._buffer = []
+    self._buffered_tokens = 0
+
+  def write(self, trg_sentence, rows):
+    """Adds a sentence.
+
+    Args:
+      trg_sentence: List of target words
+      rows: One row of statistics (in the order of `headers`) for each
+            target word
+    """
+    self._buffer.append((trg_sentence, rows))
+    self._buffered_tokens += len(trg_sentence)
+    if self._buffered_tokens >= self.chunk_size:
+      self._flush()
+
+  def _flush(self):
+    if not self._buffer:
+      return
+    lengths = [len(trg_sentence) for trg_sentence, _ in self._buffer]
+    starts = self.n_tokens + np.cumsum([0] + lengths[:-1])
+    np.asarray(starts, dtype=np.int64).tofile(self.offsets_file)
+    values = {
+        "sen_idx": np.repeat(
+            np.arange(self.n_sentences, self.n_sentences + len(lengths)),
+            lengths),
+        "word_idx": np.concatenate([np.arange(l) for l in lengths]),
+        "trg_word": np.concatenate(
+            [trg_sentence for trg_sentence, _ in self._buffer]),
+    }
+    rows = [row for _, sen_rows in self._buffer for row in sen_rows]
+    for i, name in self.stat_columns:
+      column = np.asarray([row[i] for row in rows])
+      if name not in self.dtypes:
+        self.dtypes[name] = np.int32 if column.dtype.kind in "iub" \
+                            else np.float32
+      values[name] = column
+    for name in self.columns:
+      np.asarray(values[name], dtype=self.dtypes[name]).tofile(
+          self.files[name])
+    self.n_tokens += sum(lengths)
+    self.n_sentences += len(lengths)
+    self._buffer = []
+    self._buffered_tokens = 0
+
+  def close(self):
+    self._flush()
+    np.asarray([self.n_tokens], dtype=np.int64).tofile(self.offsets_file)
+    self.offsets_file.close()
+    for f in self.files.values():
+      f.close()
+    with open(os.path.join(self.path, "meta.json"), "w") as meta_writer:
+      json.dump({
+          "n_tokens": self.n_tokens,
+          "n_sentences": self.n_sentences,
+          "columns": [[name, np.dtype(self.dtypes.get(name, np.float32)).str]
+                      for name in self.columns]
+        }, meta_writer, indent=2)
+
+
+class ColumnarOutput(object):
+  """Memory-mapped view on a columnar output directory.
+
+  Attributes:
+    columns: Dictionary from column name to a [n_tokens] np.memmap
+    offsets: [n_sentences+1] array with the start of each sentence
+  """
+
+  def __init__(self, path):
+    with open(os.path.join(path, "meta.json")) as meta_reader:
+      meta = json.load(meta_reader)
+    self.n_tokens = meta["n_tokens"]
+    self.n_sentences = meta["n_sentences"]
+    self.columns = {}
+    for name, dtype in meta["columns"]:
+      if self.n_tokens == 0:
+        self.columns[name] = np.zeros(0, dtype=dtype)
+      else:
+        self.columns[name] = np.memmap(
+            os.path.join(path, "%s.bin" % name), dtype=dtype, mode="r",
+            shape=(self.n_tokens,))
+    self.offsets = np.fromfile(os.path.join(path, "offsets.bin"),
+                               dtype=np.int64)
+
+  def sentence(self, sen_idx):
+    """Returns a dictionary with the column values of a sentence."""
+    s = slice(self.offsets[sen_idx], self.offsets[sen_idx + 1])
+    return {name: column[s] for name, column in self.columns.items()}
+
+
+def load(path):
+  return ColumnarOutput(path)
@@ -1,6 +1,14 @@
 # coding=utf-8
 # Adapted from t2t's avg_checkpoints
-"""Script to import a single model into a t2t ensemble."""
+"""Script to import one or more models into a t2t ensemble.
+
+By default, the new ensemble checkpoint is written tensor by tensor with
+checkpoint_writer.CheckpointWriter: only the tensor which is currently
+written (and the current output shard) is kept in memory. Model
+variables are read from the model checkpoints when they are needed.
+With --nodirect_write, the old path which creates a variable and an
+assign op for each tensor and saves them with tf.train.Saver is used.
+"""
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
@@ -13,19 +21,27 @@ import six
 from six.moves import zip  # pylint: disable=redefined-builtin
 import tensorflow as tf
 
+import checkpoint_writer
+
 flags = tf.flags
 FLAGS = flags.FLAGS
 
 flags.DEFINE_string("ensemble_path", "",
                     "Path to the ensemble checkpoint.")
-flags.DEFINE_integer("model_id", 0,
-                     "ID of the imported model in the ensemble")
+flags.DEFINE_string("model_id", "0",
+                    "Comma-separated IDs of the imported models in the ensemble")
 flags.DEFINE_string("model_path", "",
-                    "Path to the model checkpoint.")
+                    "Comma-separated paths to the model checkpoints, one per "
+                    "model ID.")
 flags.DEFINE_string("model_name", "transformer",
                     "Model name.")
 flags.DEFINE_string("output_path", "/tmp/averaged.ckpt",
                     "Path to output the new ensemble checkpoint with imported model to.")
+flags.DEFINE_bool("direct_write", True,
+                  "Write the checkpoint tensor by tensor without creating "
+                  "variables and assign ops.")
+flags.DEFINE_integer("shard_size_mb", 512,
+                     "Size of the output checkpoint shards if direct_write.")
 
 
 def checkpoint_exists(path):
@@ -41,59 +57,105 @@ def count_models(ensemble_var_list):
   return len(models)
 
 
-def main(_):
-  print("READING MODEL CHECKPOINT FILE..................")
-  body_var_values = {}
-  embed_var_values = defaultdict(lambda: [])
-  reader = tf.contrib.framework.load_checkpoint(FLAGS.model_path)
-  model_var_list = tf.contrib.framework.list_variables(FLAGS.model_path)
+def fix_embed_name(embed_name):
+  """Fixes the embedding name (depends on number of models in the
+  ensemble).
+  """
+  parts = embed_name.split("/")
+  mod_parts = parts[1].split("_")
+  mod_parts[-1] = str(int(mod_parts[-1]) * 2)
+  parts[1] = "_".join(mod_parts)
+  return "/".join(parts)
+
+
+def map_model_variables(model_id, model_path):
+  """Maps ensemble variable names to the variables in a model checkpoint.
+
+  Returns:
+    Dictionary from the variable name in the ensemble to a list of
+    (shard_id, name) tuples in the model checkpoint. Body variables
+    have a single entry, embedding shards are concatenated.
+  """
+  var_map = defaultdict(lambda: [])
+  model_var_list = tf.contrib.framework.list_variables(model_path)
   body_var_prefix = "%s/body/" % FLAGS.model_name
   for name, shape in model_var_list:
-    tensor = reader.get_tensor(name)
     if name.startswith(body_var_prefix):
-      name_in_ensemble = "ensemble/body/ens_model_%d/%s" % (FLAGS.model_id, name[len(body_var_prefix):])
-      body_var_values[name_in_ensemble] = tensor
+      name_in_ensemble = "ensemble/body/ens_model_%d/%s" % (model_id, name[len(body_var_prefix):])
+      var_map[name_in_ensemble].append((0, name))
       print("Importing body var %s as %s" % (name, name_in_ensemble))
     if name.startswith("%s/symbol_modality" % FLAGS.model_name):
       parts = name.split("/")
-      name_in_ensemble = "ensemble/%s/ens_weights_%d" % ("/".join(parts[1:-1]), FLAGS.model_id)
+      name_in_ensemble = "ensemble/%s/ens_weights_%d" % ("/".join(parts[1:-1]), model_id)
       shard_id = int(parts[-1].split("_")[-1])
-      embed_var_values[name_in_ensemble].append((shard_id, tensor))
+      var_map[fix_embed_name(name_in_ensemble)].append((shard_id, name))
       print("Importing embed shard %s with ID %d into %s" % (name, shard_id, name_in_ensemble))
+  for shards in var_map.values():
+    shards.sort()
+  return var_map
+
+
+def read_model_variable(reader, shards):
+  if len(shards) == 1:
+    return reader.get_tensor(shards[0][1])
+  print("Stacking %d tensors for embedding" % len(shards))
+  return np.concatenate([reader.get_tensor(name) for _, name in shards],
+                        axis=0)
+
+
+def iterate_ensemble_values(model_ids, model_paths):
+  """Yields (name, value, dtype) for each variable of the new ensemble
+  checkpoint. Only one tensor is read at a time.
+  """
+  imported = {}
+  for model_id, model_path in zip(model_ids, model_paths):
+    print("READING MODEL CHECKPOINT FILE %s.........." % model_path)
+    reader = tf.contrib.framework.load_checkpoint(model_path)
+    for name, shards in six.iteritems(map_model_variables(model_id,
+                                                          model_path)):
+      imported[name] = (reader, shards)
 
   print("READING ENSEMBLE CHECKPOINT FILE..................")
-  var_values = {}
-  var_dtypes = {}
   ensemble_var_list = tf.contrib.framework.list_variables(FLAGS.ensemble_path)
   n_models = count_models(ensemble_var_list)
   print("Ensemble consists of %d models" % n_models)
-  for embed_name, tensors in embed_var_values.iteritems():
-    print("Stacking %d tensors for embedding %s" % (len(tensors), embed_name))
-    tensors.sort()
-    embed_matrix = np.concatenate([t for _, t in tensors], axis=0)
-    # Fix variable name (depends on number of models in the ensemble)
-    parts = embed_name.split("/")
-    mod_parts = parts[1].split("_")
-    mod_parts[-1] = str(int(mod_parts[-1]) * 2)
-    parts[1] = "_".join(mod_parts)
-    embed_name_in_ensemble = "/".join(parts)
-    body_var_values[embed_name_in_ensemble] = embed_matrix
   reader = tf.contrib.framework.load_checkpoint(FLAGS.ensemble_path)
+  var_dtypes = reader.get_variable_to_dtype_map()
+  zero_prefixes = tuple("training/ensemble/body/ens_model_%d" % model_id
+                        for model_id in model_ids)
+  n_imported = 0
   for name, shape in ensemble_var_list:
-    tensor = reader.get_tensor(name)
-    var_dtypes[name] = tensor.dtype
-    if name in body_var_values:
-      var_values[name] = body_var_values[name]
+    dtype = var_dtypes[name].as_numpy_dtype
+    if name in imported:
+      value = read_model_variable(*imported[name])
+      n_imported += 1
       print("Imported: %s" % name)
-    elif name.startswith("training/ensemble/body/ens_model_%d" % FLAGS.model_id):
-      var_values[name] = np.zeros(shape)
+    elif name.startswith(zero_prefixes):
+      value = np.zeros(shape, dtype=dtype)
       print("To zero: %s" % name)
     else:
-      var_values[name] = tensor
-      print("Pass through: %s (abssum=%f)" % (name, np.sum(np.abs(tensor))))
+      value = reader.get_tensor(name)
+      print("Pass through: %s (abssum=%f)" % (name, np.sum(np.abs(value))))
+    yield name, value.astype(dtype, copy=False), dtype
+  if n_imported != len(imported):
+    print("WARNING: %d of %d model variables are not in the ensemble"
+          % (len(imported) - n_imported, len(imported)))
 
-  print("")
-  print("WRITING ENSEMBLE CHECKPOINT FILE..................")
+
+def write_direct(values):
+  writer = checkpoint_writer.CheckpointWriter(FLAGS.output_path,
+                                              FLAGS.shard_size_mb)
+  for name, value, _ in values:
+    writer.add(name, value)
+  writer.close()
+
+
+def write_with_saver(values):
+  var_values = {}
+  var_dtypes = {}
+  for name, value, dtype in values:
+    var_values[name] = value
+    var_dtypes[name] = dtype
   tf_vars = [
       tf.get_variable(v, shape=var_values[v].shape, dtype=var_dtypes[v])
       for v in var_values
@@ -110,5 +172,22 @@ def main(_):
     saver.save(sess, FLAGS.output_path)
 
 
+def main(_):
+  model_ids = [int(i) for i in FLAGS.model_id.split(",")]
+  model_paths = FLAGS.model_path.split(",")
+  if len(model_ids) != len(model_paths):
+    raise ValueError("Got %d model IDs for %d model paths"
+                     % (len(model_ids), len(model_paths)))
+  if len(set(model_ids)) != len(model_ids):
+    raise ValueError("Model IDs must be unique")
+  values = iterate_ensemble_values(model_ids, model_paths)
+  print("")
+  print("WRITING ENSEMBLE CHECKPOINT FILE..................")
+  if FLAGS.direct_write:
+    write_direct(values)
+  else:
+    write_with_saver(values)
+
+
 if __name__ == "__main__":
   tf.app.run()
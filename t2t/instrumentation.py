@@ -0,0 +1,270 @@
+# coding=utf-8
+r"""Timing and throughput instrumentation for the T2T scripts.
+
+The scripts route their session calls through `run()` and wrap graph
+building, checkpoint restore, and Python-side pre- and post-processing
+in `timed()`. Each event is written as one JSON line to the profile
+output (if configured), and `finish()` logs a summary per event type:
+number of calls, total and mean wall time, and for session calls the
+number of tokens per second and the fraction of padding in the fed
+batches. Worker processes append to the same file, so the summary
+covers all processes.
+
+  instrumentation.configure("profile.jsonl", trace_every_n=100,
+                            trace_dir="traces")
+  with instrumentation.timed("graph_build"):
+    ...
+  values = instrumentation.run(sess, fetches, feed_dict,
+                               batches=[src_batch, trg_batch])
+  instrumentation.finish()
+
+The summary of an existing profile can be printed with
+
+  python instrumentation.py profile.jsonl
+"""
+
+import collections
+import contextlib
+import json
+import os
+import sys
+import threading
+import time
+
+import numpy as np
+import tensorflow as tf
+
+PAD_ID = 0
+
+
+class _Stats(object):
+  """Aggregates events by their name."""
+
+  def __init__(self):
+    self.counts = collections.defaultdict(int)
+    self.times = collections.defaultdict(float)
+    self.tokens = collections.defaultdict(int)
+    self.slots = collections.defaultdict(int)
+
+  def add(self, record):
+    name = record["event"]
+    self.counts[name] += 1
+    self.times[name] += record["time"]
+    if "n_slots" in record:
+      self.tokens[name] += record["n_tokens"]
+      self.slots[name] += record["n_slots"]
+
+  def summary(self):
+    """Returns a dictionary from event name to aggregated statistics."""
+    summary = {}
+    for name in sorted(self.counts):
+      total_time = self.times[name]
+      entry = {"count": self.counts[name],
+               "total_time": total_time,
+               "mean_time": total_time / self.counts[name]}
+      if self.slots[name] > 0:
+        entry["n_tokens"] = self.tokens[name]
+        entry["tokens_per_sec"] = self.tokens[name] / max(total_time, 1e-9)
+        entry["padding_ratio"] = 1.0 - float(self.tokens[name]) \
+                                       / self.slots[name]
+      summary[name] = entry
+    return summary
+
+
+class Profiler(object):
+  """Collects timing events and writes them to a JSON-lines file."""
+
+  def __init__(self, path=None, trace_every_n=0, trace_dir=None):
+    """Creates the profiler.
+
+    Args:
+      path: Path to the JSON-lines output, or None to only aggregate
+            the events in memory
+      trace_every_n: If positive, record a full TF step trace for every
+                     n-th session call and write it to `trace_dir` in
+                     Chrome trace format (chrome://tracing)
+      trace_dir: Output directory for step traces
+    """
+    self.path = path
+    self.trace_every_n = trace_every_n
+    self.trace_dir = trace_dir or "."
+    self.stats = _Stats()
+    self.n_runs = 0
+    self._pid = os.getpid()
+    self._lock = threading.Lock()
+    self._writer = None
+    if path:
+      # All processes append, so that lines are not overwritten
+      open(path, "w").close()
+      self._writer = open(path, "a")
+    if trace_every_n > 0 and not os.path.isdir(self.trace_dir):
+      os.makedirs(self.trace_dir)
+
+  def record(self, event, duration, **fields):
+    """Adds an event with a wall time of `duration` seconds."""
+    record = {"event": event, "time": duration, "pid": os.getpid(),
+              "timestamp": time.time()}
+    record.update(fields)
+    if os.getpid() != self._pid:
+      # Forked worker process
+      self._pid = os.getpid()
+      self._lock = threading.Lock()
+      if self.path:
+        self._writer = open(self.path, "a")
+    with self._lock:
+      self.stats.add(record)
+      if self.path:
+        self._writer.write("%s\n" % json.dumps(record))
+        self._writer.flush()
+
+  @contextlib.contextmanager
+  def timed(self, event, **fields):
+    """Context manager which records the wall time of its body."""
+    start_time = time.time()
+    yield
+    self.record(event, time.time() - start_time, **fields)
+
+  def timed_iter(self, iterable, event):
+    """Iterates over `iterable` and records the time spent in each
+    `next()` call, e.g. to measure batch creation in generators.
+    """
+    iterator = iter(iterable)
+    while True:
+      start_time = time.time()
+      try:
+        item = next(iterator)
+      except StopIteration:
+        return
+      self.record(event, time.time() - start_time)
+      yield item
+
+  def run(self, sess, fetches, feed_dict=None, batches=(),
+          event="session_run"):
+    """Runs `fetches` in `sess` and records the wall time.
+
+    Args:
+      sess: Session or MonitoredSession
+      fetches: Passed through to `sess.run()`
+      feed_dict: Passed through to `sess.run()`
+      batches: Token ID arrays in `feed_dict`, padded with PAD_ID, used
+               to compute the number of tokens and the padding ratio
+      event: Event name
+
+    Returns:
+      The result of `sess.run()`.
+    """
+    self.n_runs += 1
+    run_options = None
+    run_metadata = None
+    if self.trace_every_n > 0 and self.n_runs % self.trace_every_n == 0:
+      run_options = tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE)
+      run_metadata = tf.RunMetadata()
+    start_time = time.time()
+    values = sess.run(fetches, feed_dict, options=run_options,
+                      run_metadata=run_metadata)
+    duration = time.time() - start_time
+    fields = {}
+    if batches:
+      batches = [np.asarray(b) for b in batches]
+      fields["n_tokens"] = int(sum(np.count_nonzero(b != PAD_ID)
+                                   for b in batches))
+      fields["n_slots"] = int(sum(b.size for b in batches))
+      fields["shapes"] = [list(b.shape) for b in batches]
+    if run_metadata is not None:
+      fields["trace"] = self._write_trace(run_metadata)
+    self.record(event, duration, **fields)
+    return values
+
+  def _write_trace(self, run_metadata):
+    from tensorflow.python.client import timeline
+    path = os.path.join(self.trace_dir, "trace-%d-%d.json"
+                        % (os.getpid(), self.n_runs))
+    with open(path, "w") as writer:
+      writer.write(timeline.Timeline(
+          run_metadata.step_stats).generate_chrome_trace_format())
+    return path
+
+  def summary(self):
+    """Aggregated statistics of all processes if events are written to
+    a file, otherwise of this process.
+    """
+    if not self.path:
+      return self.stats.summary()
+    self._writer.flush()
+    return summarize_file(self.path)
+
+  def finish(self):
+    """Logs the summary and appends it to the JSON-lines output."""
+    summary = self.summary()
+    log_summary(summary)
+    if self.path:
+      self._writer.write("%s\n" % json.dumps({"event": "summary",
+                                              "summary": summary}))
+      self._writer.close()
+    return summary
+
+
+def summarize_file(path):
+  """Aggregates the events in a JSON-lines profile."""
+  stats = _Stats()
+  with open(path) as reader:
+    for line in reader:
+      if not line.endswith("\n"):
+        continue
+      record = json.loads(line)
+      if record["event"] != "summary":
+        stats.add(record)
+  return stats.summary()
+
+
+def log_summary(summary):
+  for name, entry in sorted(summary.items()):
+    msg = "%s: count=%d total=%.3fs mean=%.2fms" % (
+        name, entry["count"], entry["total_time"],
+        1000.0 * entry["mean_time"])
+    if "tokens_per_sec" in entry:
+      msg += " tokens=%d tokens/s=%.1f padding=%.1f%%" % (
+          entry["n_tokens"], entry["tokens_per_sec"],
+          100.0 * entry["padding_ratio"])
+    tf.logging.info(msg)
+
+
+_profiler = Profiler()
+
+
+def configure(path=None, trace_every_n=0, trace_dir=None):
+  """Replaces the global profiler. Must be called before forking worker
+  processes so that they write to the same file.
+  """
+  global _profiler
+  _profiler = Profiler(path, trace_every_n, trace_dir)
+  return _profiler
+
+
+def get():
+  return _profiler
+
+
+def record(event, duration, **fields):
+  _profiler.record(event, duration, **fields)
+
+
+def timed(event, **fields):
+  return _profiler.timed(event, **fields)
+
+
+def timed_iter(iterable, event):
+  return _profiler.timed_iter(iterable, event)
+
+
+def run(sess, fetches, feed_dict=None, batches=(), event="session_run"):
+  return _profiler.run(sess, fetches, feed_dict, batches, event)
+
+
+def finish():
+  return _profiler.finish()
+
+
+if __name__ == "__main__":
+  tf.logging.set_verbosity(tf.logging.INFO)
+  log_summary(summarize_file(sys.argv[1]))
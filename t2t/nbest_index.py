@@ -0,0 +1,167 @@
+# coding=utf-8
+r"""Compact on-disk index for Moses-style n-best lists.
+
+Lines have the format
+
+  <sen_id> ||| <token ids> ||| <features> ||| <score>
+
+The index is a directory with raw little-endian binary files which are
+memory-mapped when the index is loaded, so worker processes share the
+same pages and no process parses the text n-best list:
+
+  tokens.bin         int32, token IDs of all entries, concatenated
+  token_offsets.bin  int64, start of each entry in tokens.bin, plus total
+  scores.bin         float64, score of each entry
+  line_offsets.bin   int64, byte offset of each entry in the n-best file
+  order.bin          int64, entry indices sorted (stably) by sentence ID
+  sen_offsets.bin    int64, start of each sentence ID in order.bin, plus
+                     total
+  meta.json          Format version, size and mtime of the indexed n-best
+                     file
+
+  import nbest_index
+  index = nbest_index.load_or_build("nbest.txt")
+  for score, tokens in index.get(0):
+    print(score, tokens)
+"""
+
+import json
+import logging
+import os
+
+import numpy as np
+
+INDEX_FILES = ["tokens", "token_offsets", "scores", "line_offsets", "order",
+               "sen_offsets"]
+
+# Version 2 stores scores as float64 (version 1: float32)
+INDEX_VERSION = 2
+
+
+def _source_stats(nbest_path):
+  stat = os.stat(nbest_path)
+  return {"nbest_path": os.path.abspath(nbest_path),
+          "size": stat.st_size,
+          "mtime": stat.st_mtime}
+
+
+def build_index(nbest_path, index_path, chunk_size=1000000):
+  """Creates the index directory for an n-best list.
+
+  Args:
+    nbest_path: Path to the n-best list
+    index_path: Output directory
+    chunk_size: Number of tokens buffered before writing to tokens.bin
+  """
+  logging.info("Building n-best index %s for %s" % (index_path, nbest_path))
+  if not os.path.isdir(index_path):
+    os.makedirs(index_path)
+  sen_ids = []
+  scores = []
+  line_offsets = []
+  token_offsets = [0]
+  token_buffer = []
+  with open(os.path.join(index_path, "tokens.bin"), "wb") as tokens_writer:
+    with open(nbest_path, "rb") as nbest_reader:
+      offset = 0
+      for line in iter(nbest_reader.readline, b""):
+        line_offsets.append(offset)
+        offset += len(line)
+        parts = line.split(b"|")
+        sen_ids.append(int(parts[0].strip()))
+        scores.append(float(parts[-1].strip()))
+        tokens = [int(t) for t in parts[3].split()]
+        token_buffer.extend(tokens)
+        token_offsets.append(token_offsets[-1] + len(tokens))
+        if len(token_buffer) >= chunk_size:
+          np.asarray(token_buffer, dtype=np.int32).tofile(tokens_writer)
+          token_buffer = []
+    np.asarray(token_buffer, dtype=np.int32).tofile(tokens_writer)
+  sen_ids = np.asarray(sen_ids, dtype=np.int64)
+  order = np.argsort(sen_ids, kind="mergesort")
+  n_sentences = int(sen_ids.max()) + 1 if len(sen_ids) else 0
+  sen_offsets = np.searchsorted(sen_ids[order], np.arange(n_sentences + 1))
+  arrays = {
+      "token_offsets": np.asarray(token_offsets, dtype=np.int64),
+      "scores": np.asarray(scores, dtype=np.float64),
+      "line_offsets": np.asarray(line_offsets, dtype=np.int64),
+      "order": order.astype(np.int64),
+      "sen_offsets": sen_offsets.astype(np.int64)}
+  for name, array in arrays.items():
+    array.tofile(os.path.join(index_path, "%s.bin" % name))
+  meta = _source_stats(nbest_path)
+  meta["version"] = INDEX_VERSION
+  meta["n_entries"] = len(scores)
+  meta["n_sentences"] = n_sentences
+  with open(os.path.join(index_path, "meta.json"), "w") as meta_writer:
+    json.dump(meta, meta_writer, indent=2)
+
+
+class NbestIndex(object):
+  """Memory-mapped n-best index created with `build_index()`."""
+
+  def __init__(self, index_path):
+    with open(os.path.join(index_path, "meta.json")) as meta_reader:
+      self.meta = json.load(meta_reader)
+    self.n_sentences = self.meta["n_sentences"]
+    dtypes = {"tokens": np.int32, "scores": np.float64}
+    for name in INDEX_FILES:
+      path = os.path.join(index_path, "%s.bin" % name)
+      dtype = dtypes.get(name, np.int64)
+      if os.path.getsize(path) == 0:
+        array = np.zeros(0, dtype=dtype)
+      else:
+        array = np.memmap(path, dtype=dtype, mode="r")
+      setattr(self, "_%s" % name, array)
+
+  def _entries(self, sen_id):
+    if sen_id < 0 or sen_id >= self.n_sentences:
+      return []
+    return self._order[self._sen_offsets[sen_id]:self._sen_offsets[sen_id+1]]
+
+  def get(self, sen_id):
+    """Returns the n-best list for a sentence ID as list of
+    (score, token_ids) tuples in file order. Unknown sentence IDs
+    have an empty n-best list.
+    """
+    return [(float(self._scores[e]),
+             self._tokens[self._token_offsets[e]:
+                          self._token_offsets[e+1]].tolist())
+            for e in self._entries(sen_id)]
+
+  def byte_offset(self, sen_id):
+    """Byte offset of the first line of `sen_id` in the n-best file, or
+    None if the sentence ID does not occur.
+    """
+    entries = self._entries(sen_id)
+    if len(entries) == 0:
+      return None
+    return int(self._line_offsets[entries[0]])
+
+  def is_up_to_date(self, nbest_path):
+    stats = _source_stats(nbest_path)
+    return self.meta["size"] == stats["size"] \
+        and self.meta["mtime"] == stats["mtime"]
+
+
+def load_or_build(nbest_path, index_path=None):
+  """Loads the index for `nbest_path`, and (re)builds it if it does not
+  exist, has an older format version, or the n-best file has changed
+  since.
+
+  Args:
+    nbest_path: Path to the n-best list
+    index_path: Index directory. Defaults to <nbest_path>.idx
+  """
+  if not index_path:
+    index_path = "%s.idx" % nbest_path
+  meta_path = os.path.join(index_path, "meta.json")
+  if os.path.isfile(meta_path):
+    with open(meta_path) as meta_reader:
+      version = json.load(meta_reader).get("version", 1)
+    if version == INDEX_VERSION:
+      index = NbestIndex(index_path)
+      if index.is_up_to_date(nbest_path):
+        return index
+  build_index(nbest_path, index_path)
+  return NbestIndex(index_path)
@@ -0,0 +1,186 @@
+# coding=utf-8
+r"""Reader/writer threads around the session calls of the T2T scripts.
+
+A reader thread consumes the input iterator (reading, parsing, and
+batching) ahead of time and puts the items into a bounded queue. The
+calling thread takes the items from the queue and runs the session
+calls. A writer thread takes the results from a second bounded queue
+and formats and writes them. TF releases the GIL in session.run(), so
+parsing and writing overlap with the computation. The calling thread
+processes the items in input order and both queues are FIFO, so the
+output order is preserved.
+
+  stats = pipeline.run(batch_iter(path), score_batch, write_result,
+                       queue_size=16)
+
+At the end, the occupancy of both queues is logged: the mean number of
+items in the input queue when the next item was taken, how often the
+calling thread had to wait for the reader (input queue empty) or for
+the writer (output queue full), and the total waiting times.
+"""
+
+import sys
+import threading
+import time
+
+try:
+  import Queue as queue
+except ImportError:
+  import queue
+
+import tensorflow as tf
+
+import instrumentation
+
+# Marks the end of a queue
+_END = object()
+
+
+class _Failure(object):
+  """Exception raised in the reader or writer thread."""
+
+  def __init__(self, exc_info):
+    self.exc_info = exc_info
+
+
+def _reraise(exc_info):
+  exc_type, exc_value, exc_tb = exc_info
+  if exc_value is None:
+    exc_value = exc_type()
+  if sys.version_info[0] >= 3:
+    raise exc_value.with_traceback(exc_tb)
+  exec("raise exc_type, exc_value, exc_tb")
+
+
+def _reader(inputs, input_queue, stop_event):
+  try:
+    for item in inputs:
+      while not stop_event.is_set():
+        try:
+          input_queue.put(item, timeout=0.1)
+          break
+        except queue.Full:
+          pass
+      if stop_event.is_set():
+        return
+    input_queue.put(_END)
+  except Exception:
+    input_queue.put(_Failure(sys.exc_info()))
+
+
+def _writer(output_queue, write_fn, failures):
+  while True:
+    result = output_queue.get()
+    if result is _END:
+      return
+    if failures:
+      # Drain the queue so that the calling thread does not block
+      continue
+    try:
+      write_fn(result)
+    except Exception:
+      failures.append(sys.exc_info())
+
+
+class QueueStats(object):
+  """Occupancy statistics of the input and output queues."""
+
+  def __init__(self, queue_size):
+    self.queue_size = queue_size
+    self.n_items = 0
+    self.input_occupancy = 0
+    self.input_empty = 0
+    self.input_wait_time = 0.0
+    self.output_occupancy = 0
+    self.output_full = 0
+    self.output_wait_time = 0.0
+
+  def summary(self):
+    n = max(self.n_items, 1)
+    return {
+        "queue_size": self.queue_size,
+        "n_items": self.n_items,
+        "mean_input_occupancy": float(self.input_occupancy) / n,
+        "input_empty_ratio": float(self.input_empty) / n,
+        "input_wait_time": self.input_wait_time,
+        "mean_output_occupancy": float(self.output_occupancy) / n,
+        "output_full_ratio": float(self.output_full) / n,
+        "output_wait_time": self.output_wait_time}
+
+  def log(self, name):
+    s = self.summary()
+    tf.logging.info(
+        "%s: %d items, input queue: mean occupancy %.1f/%d, empty %.1f%% "
+        "(waited %.2fs), output queue: mean occupancy %.1f/%d, full %.1f%% "
+        "(waited %.2fs)" % (
+            name, s["n_items"], s["mean_input_occupancy"], self.queue_size,
+            100.0 * s["input_empty_ratio"], s["input_wait_time"],
+            s["mean_output_occupancy"], self.queue_size,
+            100.0 * s["output_full_ratio"], s["output_wait_time"]))
+
+
+def run(inputs, process_fn, write_fn, queue_size=16, name="pipeline"):
+  """Runs `process_fn` on each item of `inputs` and passes the results
+  to `write_fn` in input order.
+
+  Args:
+    inputs: Iterable which is consumed in the reader thread
+    process_fn: Called in the calling thread for each input item, or
+                None to pass the items to `write_fn` unchanged (e.g. if
+                `inputs` is the result iterator of a process pool)
+    write_fn: Called in the writer thread for each result
+    queue_size: Maximum number of items in each queue. If 0, all steps
+                run sequentially in the calling thread.
+    name: Name used in the log output
+
+  Returns:
+    QueueStats instance.
+  """
+  stats = QueueStats(queue_size)
+  if queue_size <= 0:
+    for item in inputs:
+      stats.n_items += 1
+      write_fn(process_fn(item) if process_fn else item)
+    return stats
+  input_queue = queue.Queue(queue_size)
+  output_queue = queue.Queue(queue_size)
+  stop_event = threading.Event()
+  write_failures = []
+  reader = threading.Thread(target=_reader,
+                            args=(inputs, input_queue, stop_event))
+  writer = threading.Thread(target=_writer,
+                            args=(output_queue, write_fn, write_failures))
+  reader.daemon = True
+  writer.daemon = True
+  reader.start()
+  writer.start()
+  try:
+    while not write_failures:
+      stats.input_occupancy += input_queue.qsize()
+      if input_queue.empty():
+        stats.input_empty += 1
+      start_time = time.time()
+      item = input_queue.get()
+      stats.input_wait_time += time.time() - start_time
+      if item is _END:
+        break
+      if isinstance(item, _Failure):
+        _reraise(item.exc_info)
+      stats.n_items += 1
+      result = process_fn(item) if process_fn else item
+      stats.output_occupancy += output_queue.qsize()
+      if output_queue.full():
+        stats.output_full += 1
+      start_time = time.time()
+      output_queue.put(result)
+      stats.output_wait_time += time.time() - start_time
+  finally:
+    stop_event.set()
+    output_queue.put(_END)
+    writer.join()
+  if write_failures:
+    _reraise(write_failures[0])
+  stats.log(name)
+  instrumentation.record(name, stats.input_wait_time + stats.output_wait_time,
+                         **stats.summary())
+  return stats
@@ -0,0 +1,176 @@
+# coding=utf-8
+r"""Shared-prefix scoring of n-best lists with T2T Transformer models.
+
+Hypotheses in an n-best list usually share long prefixes. A PrefixTrie
+stores each distinct prefix only once. The trie is flattened into a
+single target sequence in which every node attends only to itself and
+its ancestors, and uses its depth in the trie as position. This gives
+each node exactly the context it has in standard forced decoding, so a
+single decoder pass computes the distribution after every distinct
+prefix once, and the keys and values of shared prefixes are reused by
+all their descendants.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import numpy as np
+
+from tensor2tensor.layers import common_attention
+from tensor2tensor.layers import common_layers
+from tensor2tensor.models import transformer
+
+import tensorflow as tf
+
+
+class PrefixTrie(object):
+  """Prefix trie over target sentences. Nodes are numbered in insertion
+  order, so parents always come before their children.
+  """
+
+  def __init__(self):
+    self.tokens = []
+    self.parents = []
+    self.depths = []
+    self.paths = []
+    self._children = [{}]  # Children of the virtual root are at index 0
+
+  def add(self, sentence):
+    """Adds a sentence to the trie.
+
+    Args:
+      sentence: List of target token IDs
+
+    Returns:
+      Index of the sentence in `paths`.
+    """
+    path = []
+    parent = -1
+    for depth, token in enumerate(sentence):
+      children = self._children[parent + 1]
+      node = children.get(token)
+      if node is None:
+        node = len(self.tokens)
+        children[token] = node
+        self.tokens.append(token)
+        self.parents.append(parent)
+        self.depths.append(depth)
+        self._children.append({})
+      path.append(node)
+      parent = node
+    self.paths.append(path)
+    return len(self.paths) - 1
+
+  def __len__(self):
+    return len(self.tokens)
+
+  def n_tokens(self):
+    """Number of tokens without prefix sharing."""
+    return sum(len(path) for path in self.paths)
+
+  def decoder_inputs(self):
+    """Token fed to the decoder at each node, i.e. the token of its
+    parent, or 0 for children of the root.
+    """
+    return [0 if p < 0 else self.tokens[p] for p in self.parents]
+
+  def ancestor_mask(self):
+    """[n_nodes, n_nodes] bool array. Entry (i, j) is true if node j is
+    node i or an ancestor of node i.
+    """
+    n = len(self.tokens)
+    mask = np.zeros((n, n), dtype=np.bool)
+    for node, parent in enumerate(self.parents):
+      if parent >= 0:
+        mask[node] = mask[parent]
+      mask[node, node] = True
+    return mask
+
+  def hypo_scores(self, node_scores):
+    """Sums up node scores along the path of each sentence.
+
+    Args:
+      node_scores: [n_nodes] array with the log-probability of each node
+
+    Returns:
+      List of floats, one for each sentence in insertion order.
+    """
+    return [float(np.sum(node_scores[path])) for path in self.paths]
+
+
+def create_trie_batch(tries):
+  """Creates padded arrays for a batch of tries.
+
+  Returns:
+    Tuple (targets, positions, ancestor_mask) with shapes
+    [n_tries, max_nodes], [n_tries, max_nodes], and
+    [n_tries, max_nodes, max_nodes]. `targets` holds the node tokens
+    shifted one to the left, which T2T shifts right again to obtain the
+    decoder inputs.
+  """
+  max_nodes = max(len(trie) for trie in tries)
+  targets = np.zeros((len(tries), max_nodes), dtype=np.int32)
+  positions = np.zeros((len(tries), max_nodes), dtype=np.int32)
+  mask = np.zeros((len(tries), max_nodes, max_nodes), dtype=np.bool)
+  for i, trie in enumerate(tries):
+    n = len(trie)
+    targets[i, :n-1] = trie.decoder_inputs()[1:]
+    positions[i, :n] = trie.depths
+    mask[i, :n, :n] = trie.ancestor_mask()
+    # Padding nodes attend to themselves only
+    mask[i, np.arange(n, max_nodes), np.arange(n, max_nodes)] = True
+  return targets, positions, mask
+
+
+def node_tokens_batch(tries):
+  """[n_tries, max_nodes] array with the token of each trie node."""
+  max_nodes = max(len(trie) for trie in tries)
+  tokens = np.zeros((len(tries), max_nodes), dtype=np.int32)
+  for i, trie in enumerate(tries):
+    tokens[i, :len(trie)] = trie.tokens
+  return tokens
+
+
+def use_tree_attention(translate_model, positions, ancestor_mask):
+  """Replaces the causal self-attention of the Transformer decoder with
+  attention over trie ancestors, and the linear positions with the node
+  depths. Decoder inputs are expected in the format of
+  `create_trie_batch()`.
+
+  While the model body is built, `transformer_prepare_decoder()` is
+  replaced by a version which adds the timing signal of the node depths
+  to the shifted target embeddings, so the decoder input of each node
+  is computed exactly as in standard forced decoding.
+
+  Args:
+    translate_model: T2TModel with a `decode()` method (Transformer)
+    positions: [batch_size, n_nodes] int32 tensor with node depths
+    ancestor_mask: [batch_size, n_nodes, n_nodes] bool tensor
+  """
+  if not hasattr(translate_model, "decode"):
+    raise AttributeError("Prefix trie scoring requires a Transformer model")
+  if translate_model.hparams.pos != "timing":
+    raise AttributeError("Prefix trie scoring requires hparams.pos=timing")
+  if getattr(translate_model.hparams, "proximity_bias", False):
+    raise AttributeError("Prefix trie scoring does not support "
+                         "hparams.proximity_bias")
+
+  def prepare_decoder_for_trie(targets, hparams, features=None):
+    decoder_input = common_layers.shift_right_3d(targets)
+    decoder_input = common_attention.add_timing_signal_1d_given_position(
+        decoder_input, positions)
+    tree_bias = tf.expand_dims(
+        (1.0 - tf.cast(ancestor_mask, tf.float32)) * -1e9, 1)
+    if getattr(hparams, "activation_dtype", "float32") == "bfloat16":
+      tree_bias = tf.cast(tree_bias, tf.bfloat16)
+    return decoder_input, tree_bias
+
+  body_fn = translate_model.body
+  def body_with_tree_attention(*args, **kwargs):
+    prepare_decoder_fn = transformer.transformer_prepare_decoder
+    transformer.transformer_prepare_decoder = prepare_decoder_for_trie
+    try:
+      return body_fn(*args, **kwargs)
+    finally:
+      transformer.transformer_prepare_decoder = prepare_decoder_fn
+  translate_model.body = body_with_tree_attention
@@ -1,32 +1,157 @@
 # coding=utf-8
-r"""Shuffles the records in a T2T dataset file."""
+r"""Shuffles the records in a T2T dataset file.
+
+With --num_buckets > 1, the records are shuffled in external memory in
+two passes. The first pass assigns each record of all input files to
+a random bucket file in --tmp_dir. The second pass reads the buckets
+one by one, shuffles each bucket in memory, and writes the records to
+the output shards. This yields a uniformly random permutation of all
+records, but only one bucket is kept in memory at a time.
+
+  python shuffle_t2t_dataset.py \
+    --input_filename 'data/translate-train-*,data/bt-train-*' \
+    --output_filename data/shuffled-train --num_shards 10 \
+    --num_buckets 64 --seed 1
+
+The output is reproducible for the same inputs, seed, and number of
+buckets.
+"""
 
 from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+import os
+import random
+import shutil
+import tempfile
+
 import tensorflow as tf
-from random import shuffle
 
-tf.flags.DEFINE_string("input_filename", "", "input filename")
+tf.flags.DEFINE_string("input_filename", "",
+                       "input filename, or comma-separated file patterns")
 tf.flags.DEFINE_string("output_filename", "", "output filename")
+tf.flags.DEFINE_integer("num_shards", 1,
+                        "Number of output shards. If larger than 1, shards "
+                        "are named <output_filename>-00000-of-00010 etc.")
+tf.flags.DEFINE_integer("num_buckets", 1,
+                        "Number of temporary buckets for the external "
+                        "shuffle. If 1, all records are shuffled in memory.")
+tf.flags.DEFINE_string("tmp_dir", "",
+                       "Directory for the temporary bucket files. Defaults "
+                       "to the output directory.")
+tf.flags.DEFINE_integer("seed", 1, "random seed")
 
 FLAGS = tf.flags.FLAGS
 
 
-def main(_):
-  tf.logging.set_verbosity(tf.logging.INFO)
-  reader = tf.python_io.tf_record_iterator(FLAGS.input_filename)
-  writer = tf.python_io.TFRecordWriter(FLAGS.output_filename)
-  tf.logging.info("Reading records from %s..." % FLAGS.input_filename)
-  records = [record for record in reader]
+def get_input_files(patterns):
+  filenames = set()
+  for pattern in patterns.split(","):
+    if pattern.strip():
+      filenames.update(tf.gfile.Glob(pattern.strip()))
+  if not filenames:
+    raise ValueError("No input files match %s" % patterns)
+  # Sorted for reproducibility
+  return sorted(filenames)
+
+
+def get_output_files(output_filename, num_shards):
+  if num_shards <= 1:
+    return [output_filename]
+  return ["%s-%05d-of-%05d" % (output_filename, i, num_shards)
+          for i in xrange(num_shards)]
+
+
+def read_records(filenames):
+  for filename in filenames:
+    tf.logging.info("Reading records from %s..." % filename)
+    for record in tf.python_io.tf_record_iterator(filename):
+      yield record
+
+
+class ShardedWriter(object):
+  """Writes `n_records` records to consecutive output shards."""
+
+  def __init__(self, output_files, n_records):
+    self.output_files = output_files
+    self.n_records = n_records
+    self.n_written = 0
+    self.shard = -1
+    self.writer = None
+
+  def write(self, record):
+    # Shard i takes the records [i*n/k, (i+1)*n/k)
+    shard = self.n_written * len(self.output_files) // self.n_records
+    if shard != self.shard:
+      if self.writer is not None:
+        self.writer.close()
+      self.shard = shard
+      tf.logging.info("Writing records to %s..." % self.output_files[shard])
+      self.writer = tf.python_io.TFRecordWriter(self.output_files[shard])
+    self.writer.write(record)
+    self.n_written += 1
+
+  def close(self):
+    if self.writer is not None:
+      self.writer.close()
+    # Create empty shards if there are fewer records than shards
+    for filename in self.output_files[self.shard + 1:]:
+      tf.python_io.TFRecordWriter(filename).close()
+
+
+def shuffle_in_memory(input_files, output_files, rng):
+  records = list(read_records(input_files))
   tf.logging.info("Shuffling %d records..." % len(records))
-  shuffle(records)
-  tf.logging.info("Writing records...")
+  rng.shuffle(records)
+  writer = ShardedWriter(output_files, len(records))
   for record in records:
     writer.write(record)
   writer.close()
 
 
+def shuffle_external(input_files, output_files, num_buckets, tmp_dir, rng):
+  bucket_dir = tempfile.mkdtemp(prefix="shuffle_buckets_", dir=tmp_dir)
+  try:
+    bucket_files = [os.path.join(bucket_dir, "bucket-%05d" % i)
+                    for i in xrange(num_buckets)]
+    bucket_writers = [tf.python_io.TFRecordWriter(f) for f in bucket_files]
+    n_records = 0
+    for record in read_records(input_files):
+      bucket_writers[rng.randrange(num_buckets)].write(record)
+      n_records += 1
+    for bucket_writer in bucket_writers:
+      bucket_writer.close()
+    tf.logging.info("Scattered %d records into %d buckets in %s"
+                    % (n_records, num_buckets, bucket_dir))
+    writer = ShardedWriter(output_files, n_records)
+    for bucket_file in bucket_files:
+      records = list(tf.python_io.tf_record_iterator(bucket_file))
+      tf.logging.info("Shuffling %d records in %s..."
+                      % (len(records), bucket_file))
+      rng.shuffle(records)
+      for record in records:
+        writer.write(record)
+      del records
+      os.remove(bucket_file)
+    writer.close()
+  finally:
+    shutil.rmtree(bucket_dir, ignore_errors=True)
+
+
+def main(_):
+  tf.logging.set_verbosity(tf.logging.INFO)
+  rng = random.Random(FLAGS.seed)
+  input_files = get_input_files(FLAGS.input_filename)
+  output_files = get_output_files(FLAGS.output_filename, FLAGS.num_shards)
+  if FLAGS.num_buckets <= 1:
+    shuffle_in_memory(input_files, output_files, rng)
+  else:
+    tmp_dir = FLAGS.tmp_dir or os.path.dirname(
+        os.path.abspath(FLAGS.output_filename))
+    shuffle_external(input_files, output_files, FLAGS.num_buckets, tmp_dir,
+                     rng)
+
+
 if __name__ == "__main__":
   tf.app.run()
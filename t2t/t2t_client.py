@@ -0,0 +1,107 @@
+# coding=utf-8
+r"""Client for the T2T scoring server (see t2t_server.py).
+
+Messages are pickled Python objects with an 8-byte length prefix. The
+server socket is only accessible by the user who started the server.
+
+  client = t2t_client.ScoringClient("/tmp/t2t.sock")
+  print(client.list_models())
+  scores = client.score("nmt", [[10, 11, 1]], [[20, 21, 1]])
+"""
+
+import socket
+import struct
+
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+import numpy as np
+
+
+def send_message(sock, msg):
+  data = pickle.dumps(msg, 2)
+  sock.sendall(struct.pack("!Q", len(data)) + data)
+
+
+def _recv_exactly(sock, n):
+  chunks = []
+  while n > 0:
+    chunk = sock.recv(min(n, 1048576))
+    if not chunk:
+      raise EOFError("Connection closed")
+    chunks.append(chunk)
+    n -= len(chunk)
+  return b"".join(chunks)
+
+
+def recv_message(sock):
+  n, = struct.unpack("!Q", _recv_exactly(sock, 8))
+  return pickle.loads(_recv_exactly(sock, n))
+
+
+class ServerError(Exception):
+  """Raised if the server could not process a request."""
+  pass
+
+
+class ScoringClient(object):
+  """Connection to a scoring server. Sentences are lists or arrays of
+  token IDs. Trailing zeros (PAD) are allowed and are not scored.
+  """
+
+  def __init__(self, socket_path):
+    self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    self._sock.connect(socket_path)
+
+  def _call(self, **request):
+    send_message(self._sock, request)
+    response = recv_message(self._sock)
+    if "error" in response:
+      raise ServerError(response["error"])
+    return response["result"]
+
+  def list_models(self):
+    """Returns a dictionary from model name to model properties."""
+    return self._call(op="list")
+
+  def score(self, model, src_sentences, trg_sentences):
+    """Token-level log-probabilities.
+
+    Args:
+      model: Model name
+      src_sentences: List of source sentences, or None for glue LMs
+      trg_sentences: List of target sentences
+
+    Returns:
+      List of float arrays, one for each target sentence, with zeros
+      at PAD positions.
+    """
+    return self._call(op="score", model=model, src=src_sentences,
+                      trg=trg_sentences)
+
+  def force_decode(self, model, src_sentences, trg_sentences):
+    """Full log-probability distributions at each target position.
+
+    Returns:
+      List of [trg_len, vocab_size] arrays.
+    """
+    return self._call(op="force_decode", model=model, src=src_sentences,
+                      trg=trg_sentences)
+
+  def sample(self, model, src_sentences, trg_sentences, pos,
+             temperature=1.0):
+    """Samples a token at position `pos[i]` of each target sentence
+    given all other target tokens (one Gibbs sampling step).
+
+    Returns:
+      Tuple (samples, sentence_scores) of arrays with one entry for each
+      target sentence.
+    """
+    return self._call(op="sample", model=model, src=src_sentences,
+                      trg=trg_sentences, pos=np.asarray(pos),
+                      temperature=temperature)
+
+  def close(self):
+    self._sock.close()
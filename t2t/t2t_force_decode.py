@@ -3,6 +3,7 @@
 
 import logging
 import os
+import time
 
 # Requires tensor2tensor
 from tensor2tensor import models  # pylint: disable=unused-import
@@ -20,6 +21,15 @@ from tensorflow.python.training import training
 import numpy as np
 
 import argparse
+import itertools
+import multiprocessing
+
+import columnar_output
+import instrumentation
+import pipeline
+import prefix_trie
+import t2t_client
+import t2t_freeze_graph
 
 EOS_ID = 1
 BOS_ID = 2
@@ -114,6 +124,61 @@ def gather_2d(params, indices):
   return tf.gather_nd(params, gather_nd_indices)
 
 
+def per_token_stats(log_probs, targets, top_k):
+  """Creates the graph for per-token statistics of a single model.
+
+  Args:
+    log_probs: [trg_len, vocab_size] float32 tensor
+    targets: [trg_len] int32 tensor with the reference words
+    top_k: Number of entries in the top-k statistics
+
+  Returns:
+    Dictionary with tensors "log_prob" (log-prob of the reference),
+    "rank" (number of words with a higher score than the reference),
+    "entropy", "topk_ids", and "topk_probs". The first three are
+    [trg_len] tensors, the last two [trg_len, top_k] tensors.
+  """
+  word_indices = tf.stack([tf.range(tf.shape(targets)[0]), targets], axis=1)
+  ref_log_probs = tf.gather_nd(log_probs, word_indices)
+  topk_log_probs, topk_ids = tf.nn.top_k(log_probs, k=top_k)
+  return {
+      "log_prob": ref_log_probs,
+      "rank": tf.reduce_sum(tf.to_int32(
+          log_probs > tf.expand_dims(ref_log_probs, 1)), 1),
+      "entropy": -tf.reduce_sum(tf.exp(log_probs) * log_probs, 1),
+      "topk_ids": topk_ids,
+      "topk_probs": tf.exp(topk_log_probs)}
+
+
+def tile_encoder_output(translate_model, batch_size):
+  """Runs the encoder of `translate_model` on a single source sentence
+  and tiles its output along the batch dimension, such that all target
+  sentences in the batch share one encoder run.
+
+  Args:
+    translate_model: T2TModel with an `encode()` method (Transformer)
+    batch_size: int32 scalar tensor with the number of target sentences
+  """
+  if not hasattr(translate_model, "encode"):
+    raise AttributeError("encode_once requires a model with an encoder")
+  encode_fn = translate_model.encode
+  def encode_and_tile(*args, **kwargs):
+    encoder_output, encoder_decoder_attention_bias = encode_fn(
+        *args, **kwargs)
+    return (tf.tile(encoder_output, [batch_size, 1, 1]),
+            tf.tile(encoder_decoder_attention_bias, [batch_size, 1, 1, 1]))
+  translate_model.encode = encode_and_tile
+
+
+def pad_sentences(sentences):
+  """Creates a [len(sentences), max_len] array padded with zeros."""
+  max_len = max(len(s) for s in sentences)
+  padded = np.zeros((len(sentences), max_len), dtype=np.int32)
+  for i, s in enumerate(sentences):
+    padded[i, :len(s)] = s
+  return padded
+
+
 class Tensor2TensorAdaptor(object):
 
     def __init__(self,
@@ -123,36 +188,113 @@ class Tensor2TensorAdaptor(object):
                  checkpoint_dir,
                  src_vocab_size,
                  trg_vocab_size,
-                 single_cpu_thread=False):
+                 single_cpu_thread=False,
+                 encode_once=False,
+                 use_prefix_trie=False,
+                 intra_op_threads=0,
+                 top_k=5,
+                 batch_pairs=False):
         logging.info("Initializing model at %s" % checkpoint_dir)
-        self._single_cpu_thread = single_cpu_thread
-        self._checkpoint_dir = checkpoint_dir
-        self.src_vocab_size = src_vocab_size
-        self.trg_vocab_size = trg_vocab_size
+        start_time = time.time()
+        self._init_adaptor(src_vocab_size, trg_vocab_size,
+                           single_cpu_thread=single_cpu_thread,
+                           intra_op_threads=intra_op_threads,
+                           encode_once=encode_once,
+                           use_prefix_trie=use_prefix_trie,
+                           batch_pairs=batch_pairs,
+                           checkpoint_dir=checkpoint_dir)
         if not model_name or not problem_name or not hparams_set_name:
             tf.logging.fatal(
                 "Please specify t2t_model, t2t_problem, and t2t_hparams_set!")
             raise AttributeError
-        self.consumed = []
-        self.src_sentence = []
         predictor_graph = tf.Graph()
         with predictor_graph.as_default() as g:
             hparams = trainer_lib.create_hparams(hparams_set_name)
             self._add_problem_hparams(hparams, problem_name)
             translate_model = registry.model(model_name)(
                 hparams, tf.estimator.ModeKeys.EVAL)
-            self._inputs_var = tf.placeholder(dtype=tf.int32, shape=[None],
-                                              name="sgnmt_inputs")
-            self._targets_var = tf.placeholder(dtype=tf.int32, shape=[None], 
-                                               name="sgnmt_targets")
-            features = {"inputs": expand_input_dims_for_t2t(self._inputs_var), 
-                        "targets": expand_input_dims_for_t2t(self._targets_var)}
+            if self._batch_pairs:
+                self._inputs_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None, None], name="sgnmt_inputs")
+            else:
+                self._inputs_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None], name="sgnmt_inputs")
+            if use_prefix_trie:
+                # Flattened trie inputs, see prefix_trie.py
+                self._targets_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None], name="sgnmt_targets")
+                self._positions_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None], name="sgnmt_positions")
+                self._ancestor_mask_var = tf.placeholder(
+                    dtype=tf.bool, shape=[None, None], 
+                    name="sgnmt_ancestor_mask")
+                prefix_trie.use_tree_attention(
+                    translate_model, 
+                    tf.expand_dims(self._positions_var, 0),
+                    tf.expand_dims(self._ancestor_mask_var, 0))
+                targets = expand_input_dims_for_t2t(self._targets_var)
+            elif self._batch_pairs:
+                # Batch of (source, target) pairs
+                self._targets_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None, None], name="sgnmt_targets")
+                targets = expand_input_dims_for_t2t(self._targets_var,
+                                                    batched=True)
+            elif self._encode_once:
+                # Batch of target sentences for a single source sentence
+                self._targets_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None, None], name="sgnmt_targets")
+                tile_encoder_output(translate_model,
+                                    tf.shape(self._targets_var)[0])
+                targets = expand_input_dims_for_t2t(self._targets_var,
+                                                    batched=True)
+            else:
+                self._targets_var = tf.placeholder(
+                    dtype=tf.int32, shape=[None], name="sgnmt_targets")
+                targets = expand_input_dims_for_t2t(self._targets_var)
+            features = {"inputs": expand_input_dims_for_t2t(
+                            self._inputs_var, batched=self._batch_pairs),
+                        "targets": targets}
             translate_model.prepare_features_for_infer(features)
             translate_model._fill_problem_hparams_features(features)
             logits, _ = translate_model(features)
-            logits = tf.squeeze(logits, [0, 2, 3])
+            if self._encode_once or self._batch_pairs:
+                logits = tf.squeeze(logits, [2, 3])
+            else:
+                logits = tf.squeeze(logits, [0, 2, 3])
             self._log_probs = log_prob_from_logits(logits)
+            if self._encode_once or self._batch_pairs or use_prefix_trie:
+                self._stats = {}
+            else:
+                self._stats = per_token_stats(
+                    self._log_probs, self._targets_var, top_k)
+            restore_start_time = time.time()
             self.mon_sess = self.create_session()
+        instrumentation.record("graph_build", restore_start_time - start_time)
+        instrumentation.record("restore", time.time() - restore_start_time)
+        logging.info("Graph building and checkpoint restore took %.2fs"
+                     % (time.time() - start_time))
+
+    def _init_adaptor(self, src_vocab_size, trg_vocab_size,
+                      single_cpu_thread=False, intra_op_threads=0,
+                      encode_once=False, use_prefix_trie=False,
+                      batch_pairs=False, checkpoint_dir=None):
+        """Sets the attributes used by the methods of this class. Called
+        by all constructors, including those of subclasses which build
+        their own graph.
+        """
+        self._single_cpu_thread = single_cpu_thread
+        self._intra_op_threads = intra_op_threads
+        self._encode_once = encode_once and not use_prefix_trie
+        self._use_prefix_trie = use_prefix_trie
+        self._batch_pairs = batch_pairs and not use_prefix_trie
+        if self._batch_pairs:
+            self._encode_once = False
+        self._checkpoint_dir = checkpoint_dir
+        self._stats = {}
+        self.src_vocab_size = src_vocab_size
+        self.trg_vocab_size = trg_vocab_size
+        self.consumed = []
+        self.src_sentence = []
 
     def _add_problem_hparams(self, hparams, problem_name):
         problem = registry.problem(problem_name)
@@ -180,21 +322,27 @@ class Tensor2TensorAdaptor(object):
             gpu_options = tf.GPUOptions(
                 per_process_gpu_memory_fraction=0.95)
             config = tf.ConfigProto(
+                intra_op_parallelism_threads=self._intra_op_threads,
                 allow_soft_placement=True,
                 graph_options=graph_options,
                 gpu_options=gpu_options,
                 log_device_placement=False)
         return config
 
+    def _checkpoint_path(self, checkpoint_dir):
+        """Latest checkpoint in `checkpoint_dir`, or `checkpoint_dir`
+        itself if it is not a directory.
+        """
+        if os.path.isdir(checkpoint_dir):
+            return saver.latest_checkpoint(checkpoint_dir)
+        tf.logging.info("%s is not a directory. Interpreting as direct "
+                        "path to checkpoint..." % checkpoint_dir)
+        return checkpoint_dir
+
     def create_session(self):
         """Creates a MonitoredSession for this predictor."""
         try:
-            if os.path.isdir(self._checkpoint_dir):
-                checkpoint_path = saver.latest_checkpoint(self._checkpoint_dir)
-            else:
-                checkpoint_path = self._checkpoint_dir
-                tf.logging.info("%s is not a directory. Interpreting as direct "
-                             "path to checkpoint..." % checkpoint_path)
+            checkpoint_path = self._checkpoint_path(self._checkpoint_dir)
             return training.MonitoredSession(
                 session_creator=training.ChiefSessionCreator(
                     checkpoint_filename_with_path=checkpoint_path,
@@ -207,17 +355,280 @@ class Tensor2TensorAdaptor(object):
                 "pred_trg_vocab_size, and all the t2t_* parameters.")
             raise AttributeError("Could not initialize TF session.")
                 
+    def supported_graph_stats(self):
+        """Names of statistics which `get_stats()` can compute in TF."""
+        return set(self._stats.keys())
+
+    def get_stats(self, src_sentence, trg_sentence, stat_names):
+        """Computes per-token statistics in TF, so that the full
+        [trg_len, vocab_size] matrix is not fetched.
+
+        Returns:
+          Dictionary from statistic name to numpy array.
+        """
+        stat_names = list(stat_names)
+        if not stat_names:
+            return {}
+        values = instrumentation.run(
+            self.mon_sess, [self._stats[n] for n in stat_names],
+            {self._inputs_var: src_sentence,
+             self._targets_var: trg_sentence},
+            batches=[src_sentence, trg_sentence])
+        return dict(zip(stat_names, values))
+
+    def get_stats_batch(self, src_sentence, trg_sentences, stat_names):
+        return [self.get_stats(src_sentence, t, stat_names) 
+                for t in trg_sentences]
+
     def get_log_probs(self, src_sentence, trg_sentence):
         """Call the T2T model in self.mon_sess."""
-        log_probs = self.mon_sess.run(self._log_probs,
+        if self._batch_pairs:
+            return self.get_log_probs_pairs([src_sentence], [trg_sentence])[0]
+        if self._encode_once or self._use_prefix_trie:
+            return self.get_log_probs_batch(src_sentence, [trg_sentence])[0]
+        log_probs = instrumentation.run(self.mon_sess, self._log_probs,
             {self._inputs_var: src_sentence,
-             self._targets_var: trg_sentence})
+             self._targets_var: trg_sentence},
+            batches=[src_sentence, trg_sentence])
         return log_probs
 
+    def get_log_probs_batch(self, src_sentence, trg_sentences):
+        """Scores multiple target sentences for the same source sentence.
+        If the adaptor was created with encode_once, the encoder runs only
+        once for all target sentences. With use_prefix_trie, shared
+        prefixes of the target sentences are only computed once.
+
+        Returns:
+          List of [trg_len, vocab_size] arrays, one for each target sentence.
+        """
+        if self._use_prefix_trie:
+            trie = prefix_trie.PrefixTrie()
+            for trg_sentence in trg_sentences:
+                trie.add(trg_sentence)
+            targets, positions, ancestor_mask = prefix_trie.create_trie_batch(
+                [trie])
+            node_log_probs = instrumentation.run(
+                self.mon_sess, self._log_probs,
+                {self._inputs_var: src_sentence,
+                 self._targets_var: targets[0],
+                 self._positions_var: positions[0],
+                 self._ancestor_mask_var: ancestor_mask[0]},
+                batches=[src_sentence, targets[0]])
+            return [node_log_probs[path] for path in trie.paths]
+        if not self._encode_once:
+            return [self.get_log_probs(src_sentence, t) for t in trg_sentences]
+        targets = pad_sentences(trg_sentences)
+        log_probs = instrumentation.run(self.mon_sess, self._log_probs,
+            {self._inputs_var: src_sentence,
+             self._targets_var: targets},
+            batches=[src_sentence, targets])
+        return [lp[:len(t)] for lp, t in zip(log_probs, trg_sentences)]
+
+    def get_log_probs_pairs(self, src_sentences, trg_sentences):
+        """Scores a batch of sentence pairs with different source
+        sentences in a single padded call. Requires batch_pairs.
+
+        Returns:
+          List of [trg_len, vocab_size] arrays, one for each pair.
+        """
+        if not self._batch_pairs:
+            return [self.get_log_probs(s, t)
+                    for s, t in zip(src_sentences, trg_sentences)]
+        inputs = pad_sentences(src_sentences)
+        targets = pad_sentences(trg_sentences)
+        log_probs = instrumentation.run(self.mon_sess, self._log_probs,
+            {self._inputs_var: inputs,
+             self._targets_var: targets},
+            batches=[inputs, targets])
+        return [lp[:len(t)] for lp, t in zip(log_probs, trg_sentences)]
+
+
+class FusedTensor2TensorEnsemble(Tensor2TensorAdaptor):
+    """Builds several T2T models in a single graph. All models share the
+    source and target placeholders, so a single session call computes
+    the log-probabilities of all models and the statistics which compare
+    them. The variables of model i live in the `fused_model_i/` scope and
+    are restored from the corresponding checkpoint with their original
+    names.
+    """
+
+    def __init__(self,
+                 model_names,
+                 problem_names,
+                 hparams_set_names,
+                 checkpoint_dirs,
+                 src_vocab_size,
+                 trg_vocab_size,
+                 single_cpu_thread=False,
+                 intra_op_threads=0,
+                 top_k=5):
+        start_time = time.time()
+        self._init_adaptor(src_vocab_size, trg_vocab_size,
+                           single_cpu_thread=single_cpu_thread,
+                           intra_op_threads=intra_op_threads)
+        self.n_models = len(model_names)
+        fused_graph = tf.Graph()
+        with fused_graph.as_default() as g:
+            self._inputs_var = tf.placeholder(
+                dtype=tf.int32, shape=[None], name="sgnmt_inputs")
+            self._targets_var = tf.placeholder(
+                dtype=tf.int32, shape=[None], name="sgnmt_targets")
+            all_log_probs = []
+            savers = []
+            for i, (model_name, problem_name, hparams_set_name,
+                    checkpoint_dir) in enumerate(zip(
+                        model_names, problem_names, hparams_set_names,
+                        checkpoint_dirs)):
+                logging.info("Initializing model at %s" % checkpoint_dir)
+                scope = "fused_model_%d" % i
+                with tf.variable_scope(scope):
+                    hparams = trainer_lib.create_hparams(hparams_set_name)
+                    self._add_problem_hparams(hparams, problem_name)
+                    translate_model = registry.model(model_name)(
+                        hparams, tf.estimator.ModeKeys.EVAL)
+                    features = {
+                        "inputs": expand_input_dims_for_t2t(self._inputs_var),
+                        "targets": expand_input_dims_for_t2t(
+                            self._targets_var)}
+                    translate_model.prepare_features_for_infer(features)
+                    translate_model._fill_problem_hparams_features(features)
+                    logits, _ = translate_model(features)
+                    logits = tf.squeeze(logits, [0, 2, 3])
+                    all_log_probs.append(log_prob_from_logits(logits))
+                var_list = {v.op.name[len(scope)+1:]: v
+                            for v in tf.global_variables()
+                            if v.op.name.startswith(scope + "/")}
+                savers.append((tf.train.Saver(var_list),
+                               self._checkpoint_path(checkpoint_dir)))
+            # Per-model statistics are stacked along the second dimension
+            model_stats = [per_token_stats(lp, self._targets_var, top_k)
+                           for lp in all_log_probs]
+            self._stats = {n: tf.stack([ms[n] for ms in model_stats], axis=1)
+                           for n in model_stats[0]}
+            self._stats["log_probs"] = tf.stack(all_log_probs)
+            # [trg_len, n_models*(n_models-1)] in the order of the kl headers
+            kls = []
+            for p in xrange(self.n_models):
+                for q in xrange(self.n_models):
+                    if p != q:
+                        kls.append(tf.reduce_sum(
+                            tf.exp(all_log_probs[p])
+                            * (all_log_probs[p] - all_log_probs[q]), -1))
+            if kls:
+                self._stats["kl"] = tf.stack(kls, axis=1)
+            restore_start_time = time.time()
+            self.mon_sess = tf.Session(config=self._session_config())
+            self.mon_sess.run(tf.global_variables_initializer())
+            for model_saver, checkpoint_path in savers:
+                model_saver.restore(self.mon_sess, checkpoint_path)
+        instrumentation.record("graph_build", restore_start_time - start_time)
+        instrumentation.record("restore", time.time() - restore_start_time)
+
+    def get_stats(self, src_sentence, trg_sentence, stat_names):
+        """Computes statistics for all models in one session call.
+
+        Args:
+          src_sentence: Integer list with source sentence
+          trg_sentence: Integer list with target sentence
+          stat_names: Names of statistics to fetch: "log_probs", "kl", or
+                      one of the names in `per_token_stats()`
+
+        Returns:
+          Dictionary from statistic name to numpy array.
+        """
+        stat_names = list(stat_names)
+        if not stat_names:
+            return {}
+        values = instrumentation.run(
+            self.mon_sess, [self._stats[n] for n in stat_names],
+            {self._inputs_var: src_sentence,
+             self._targets_var: trg_sentence},
+            batches=[src_sentence, trg_sentence])
+        return dict(zip(stat_names, values))
+
+    def get_stats_batch(self, src_sentence, trg_sentences, stat_names):
+        return [self.get_stats(src_sentence, t, stat_names)
+                for t in trg_sentences]
+
+
+class FrozenTensor2TensorAdaptor(Tensor2TensorAdaptor):
+    """Adaptor for a graph exported with t2t_freeze_graph.py. Sentence
+    pairs are scored as with batch_pairs. Statistics are not computed
+    in the graph.
+    """
+
+    def __init__(self, frozen_graph, src_vocab_size, trg_vocab_size,
+                 intra_op_threads=0):
+        logging.info("Loading frozen graph %s" % frozen_graph)
+        start_time = time.time()
+        self._init_adaptor(src_vocab_size, trg_vocab_size,
+                           intra_op_threads=intra_op_threads,
+                           batch_pairs=True)
+        graph, self.mon_sess = t2t_freeze_graph.load_frozen_graph(
+            frozen_graph, intra_op_threads)
+        tensor = lambda name: graph.get_tensor_by_name("%s:0" % name)
+        self._inputs_var = tensor(t2t_freeze_graph.INPUTS)
+        self._targets_var = tensor(t2t_freeze_graph.TARGETS)
+        self._log_probs = tensor(t2t_freeze_graph.LOG_PROBS)
+        instrumentation.record("graph_load", time.time() - start_time)
+        logging.info("Loading the frozen graph took %.2fs"
+                     % (time.time() - start_time))
+
+
+class RemoteAdaptor(object):
+    """Adaptor for a model on a t2t_server.py instance."""
+
+    def __init__(self, client, model_name):
+        self._client = client
+        self._model_name = model_name
+
+    def get_log_probs(self, src_sentence, trg_sentence):
+        return self.get_log_probs_pairs([src_sentence], [trg_sentence])[0]
+
+    def get_log_probs_batch(self, src_sentence, trg_sentences):
+        return self.get_log_probs_pairs([src_sentence] * len(trg_sentences),
+                                        trg_sentences)
+
+    def get_log_probs_pairs(self, src_sentences, trg_sentences):
+        with instrumentation.timed("remote_call"):
+            return self._client.force_decode(self._model_name, src_sentences,
+                                             trg_sentences)
+
+    def supported_graph_stats(self):
+        """The server only returns log-probabilities, so all statistics
+        are computed from them and get_stats_batch() is not needed.
+        """
+        return set()
+
 
 class GlueModifier(object):
-  def __init__(self, adaptor):
+  """Scores glued documents sentence by sentence. The sentences of a
+  document are scored in padded batches of at most `max_tokens` source
+  and target tokens (including padding) if the wrapped adaptor was
+  created with batch_pairs.
+  """
+
+  def __init__(self, adaptor, max_tokens=4096):
     self._adaptor = adaptor
+    self._max_tokens = max_tokens
+
+  def _chunks(self, src_sentences, trg_sentences):
+    """Splits the sentences of a document into consecutive chunks under
+    the token budget. A single sentence above the budget forms its own
+    chunk.
+    """
+    start = 0
+    max_len = 0
+    for i, (s, t) in enumerate(zip(src_sentences, trg_sentences)):
+      pair_len = max(len(s), len(t), 1)
+      if i > start and (i - start + 1) * max(max_len, pair_len) * 2 \
+          > self._max_tokens:
+        yield start, i
+        start = i
+        max_len = 0
+      max_len = max(max_len, pair_len)
+    if start < len(src_sentences):
+      yield start, len(src_sentences)
 
   def get_log_probs(self, src_document, trg_document):
     src_sentences = [[]]
@@ -233,15 +644,62 @@ class GlueModifier(object):
         trg_sentences.append([])
       else:
         trg_sentences[-1].append(tok)
-    all_log_probs = [self._adaptor.get_log_probs(s, t) 
-                     for s, t in zip(src_sentences, trg_sentences)]
+    all_log_probs = []
+    for start, end in self._chunks(src_sentences, trg_sentences):
+      all_log_probs.extend(self._adaptor.get_log_probs_pairs(
+          src_sentences[start:end], trg_sentences[start:end]))
     for log_probs in all_log_probs:
       log_probs[BOS_ID] = log_probs[EOS_ID]
     return np.concatenate(all_log_probs, axis=0)
+
+  def get_log_probs_batch(self, src_document, trg_documents):
+    return [self.get_log_probs(src_document, t) for t in trg_documents]
+
+  def supported_graph_stats(self):
+    return set()
    
  
+def pairwise_kl(log_probs, block_size=1 << 16):
+  """KL divergences between all ordered pairs of models at each target
+  position, in the order of the kl headers. exp() is computed once per
+  model, and each pair is processed over blocks of target positions
+  with about `block_size` entries so that the temporaries stay in the
+  CPU cache. Rows are summed with np.sum() as before, so the values are
+  identical to the position-by-position computation.
+
+  Args:
+    log_probs: [n_models, trg_len, vocab_size] array, or a list of
+               [trg_len, vocab_size] arrays
+
+  Returns:
+    [trg_len, n_models*(n_models-1)] array
+  """
+  n_models = len(log_probs)
+  trg_len, vocab_size = log_probs[0].shape
+  pairs = [(p, q) for p in xrange(n_models) for q in xrange(n_models)
+           if p != q]
+  kls = np.zeros((trg_len, len(pairs)), dtype=log_probs[0].dtype)
+  if not pairs or trg_len == 0:
+    return kls
+  probs = [np.exp(log_prob) for log_prob in log_probs]
+  n_rows = max(1, block_size // max(vocab_size, 1))
+  buf = np.empty((n_rows, vocab_size), dtype=kls.dtype)
+  for i, (p, q) in enumerate(pairs):
+    for start in xrange(0, trg_len, n_rows):
+      end = min(trg_len, start + n_rows)
+      diff = buf[:end-start]
+      np.subtract(log_probs[p][start:end], log_probs[q][start:end], out=diff)
+      np.multiply(probs[p][start:end], diff, out=diff)
+      kls[start:end, i] = np.sum(diff, axis=-1)
+  return kls
+
+
 class OutputHandler(object):
 
+  # Statistics which FusedTensor2TensorEnsemble computes in the graph
+  # for this handler
+  graph_stats = []
+
   def __init__(self, adaptors):
     self._adaptors = adaptors
 
@@ -253,7 +711,7 @@ class OutputHandler(object):
     """
     raise NotImplemented()
 
-  def process(self, src_sentence, trg_sentence, log_probs):
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
     """Computes statistics for the sentence pair.
 
     Args:
@@ -261,6 +719,8 @@ class OutputHandler(object):
       trg_sentence: Integer list with target sentence
       log_probs: List of [trg_len, vocab_size] arrays with log probs
                  (one from each adaptor)
+      stats: Dictionary with statistics computed in the graph by a
+             FusedTensor2TensorEnsemble, or None
     
     Return:
       List of list of floats.
@@ -273,7 +733,7 @@ class WordsOutputHandler(OutputHandler):
   def get_headers(self):
     return ["trg_word"]
 
-  def process(self, src_sentence, trg_sentence, log_probs):
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
     return [[w] for w in trg_sentence]
 
 
@@ -286,7 +746,7 @@ class SentenceIdOutputHandler(OutputHandler):
   def get_headers(self):
     return ["sen_idx"]
 
-  def process(self, src_sentence, trg_sentence, log_probs):
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
     self.sen_id += 1
     return [[self.sen_id] for w in trg_sentence]
 
@@ -296,12 +756,14 @@ class WordIdOutputHandler(OutputHandler):
   def get_headers(self):
     return ["word_idx"]
 
-  def process(self, src_sentence, trg_sentence, log_probs):
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
     return [[i] for i, _ in enumerate(trg_sentence)]
 
 
 class KLDivergenceOutputHandler(OutputHandler):
 
+  graph_stats = ["kl"]
+
   def get_headers(self):
     n = len(self._adaptors)
     headers = []
@@ -311,51 +773,185 @@ class KLDivergenceOutputHandler(OutputHandler):
           headers.append("kl-%d-%d" % (p, q))
     return headers
 
-  def _kl(self, p_log_probs, q_log_probs):
-    return np.sum(np.exp(p_log_probs) * (p_log_probs - q_log_probs))
-
-  def process(self, src_sentence, trg_sentence, log_probs):
-    n = len(self._adaptors)
-    ret = []
-    for idx, word in enumerate(trg_sentence):
-      ret.append([])
-      for p in xrange(n):
-        for q in xrange(n):
-          if p != q:
-            ret[-1].append(self._kl(log_probs[p][idx], log_probs[q][idx]))
-    return ret
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
+    if stats is not None:
+      return [list(row) for row in stats["kl"]]
+    return [list(row) for row in pairwise_kl(log_probs)]
 
 
 class LogProbOutputHandler(OutputHandler):
 
+  graph_stats = ["log_prob"]
+
   def get_headers(self):
     return ["log_prob-%d" % i for i, _ in enumerate(self._adaptors)]
 
-  def process(self, src_sentence, trg_sentence, log_probs):
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
+    if stats is not None:
+      return [list(row) for row in stats["log_prob"]]
+    positions = np.arange(len(trg_sentence))
+    # [trg_len, n_models]
+    word_log_probs = np.stack([log_prob[positions, trg_sentence]
+                               for log_prob in log_probs], axis=1)
+    return [list(row) for row in word_log_probs]
+
+
+class RankOutputHandler(OutputHandler):
+  """Rank of the reference word, i.e. the number of words with a higher
+  log-probability (0 if the reference is the most likely word).
+  """
+
+  graph_stats = ["rank"]
+
+  def get_headers(self):
+    return ["rank-%d" % i for i, _ in enumerate(self._adaptors)]
+
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
+    if stats is not None:
+      return [list(row) for row in stats["rank"]]
+    return [[np.sum(log_prob[idx] > log_prob[idx, word]) 
+             for log_prob in log_probs]
+            for idx, word in enumerate(trg_sentence)]
+
+
+class EntropyOutputHandler(OutputHandler):
+
+  graph_stats = ["entropy"]
+
+  def get_headers(self):
+    return ["entropy-%d" % i for i, _ in enumerate(self._adaptors)]
+
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
+    if stats is not None:
+      return [list(row) for row in stats["entropy"]]
+    return [[-np.sum(np.exp(log_prob[idx]) * log_prob[idx])
+             for log_prob in log_probs]
+            for idx, _ in enumerate(trg_sentence)]
+
+
+class TopKOutputHandler(OutputHandler):
+  """IDs and probabilities of the k most likely words."""
+
+  graph_stats = ["topk_ids", "topk_probs"]
+
+  def __init__(self, adaptors, k):
+    self._adaptors = adaptors
+    self.k = k
+
+  def get_headers(self):
+    headers = []
+    for i, _ in enumerate(self._adaptors):
+      headers.extend(["top%d_id-%d" % (j, i) for j in xrange(self.k)])
+      headers.extend(["top%d_prob-%d" % (j, i) for j in xrange(self.k)])
+    return headers
+
+  def process(self, src_sentence, trg_sentence, log_probs, stats=None):
+    if stats is not None:
+      topk_ids = stats["topk_ids"]
+      topk_probs = stats["topk_probs"]
+    else:
+      topk_ids = np.stack([np.argsort(-log_prob, axis=1)[:, :self.k]
+                           for log_prob in log_probs], axis=1)
+      rows = np.expand_dims(np.arange(len(trg_sentence)), 1)
+      topk_probs = np.stack([np.exp(log_prob[rows, topk_ids[:, i]])
+                             for i, log_prob in enumerate(log_probs)], axis=1)
     ret = []
-    for idx, word in enumerate(trg_sentence):
-      ret.append([log_prob[idx, word] for log_prob in log_probs])
+    for ids, probs in zip(topk_ids, topk_probs):
+      ret.append([])
+      for model_ids, model_probs in zip(ids, probs):
+        ret[-1].extend(model_ids)
+        ret[-1].extend(model_probs)
     return ret
 
 
-def main():
-  parser = argparse.ArgumentParser(description='Force decoding')
-  parser.add_argument('-tm', '--t2t_models', help='Comma-separated list of T2T models', required=True)
-  parser.add_argument('-tp', '--t2t_problems', help='Comma-separated list of T2T problems', required=True)
-  parser.add_argument('-th', '--t2t_hparams_sets', help='Comma-separated list of T2T hparams sets', required=True)
-  parser.add_argument('-tc', '--t2t_checkpoints', help='Paths to T2T checkpoints.', required=True)
-  parser.add_argument('-tu', '--t2t_usr_dir', help='usr directory', required=True)
-  parser.add_argument('-sv', '--src_vocab_size', help='Source vocabulary size', required=True, type=int)
-  parser.add_argument('-tv', '--trg_vocab_size', help='Target vocabulary size', required=True, type=int)
-  parser.add_argument('-src', '--src_sentences', help='Source sentences', required=True)
-  parser.add_argument('-trg', '--trg_sentences', help='Target sentences', required=True)
-  parser.add_argument('-of', '--output_file', help='Output file', required=True)
-  parser.add_argument('-m', '--modifiers', help='Comma-separated list of modifiers. g: glue model', default="")
-  parser.add_argument('-oh', '--output_handlers', help='Output handlers. Comma-separated list of logprob,kl,word,word_idx,sen_idx', required=True)
-  parser.add_argument("--write_headers", help="Write name of statistics in first line of the output file", action="store_true")
-  args = parser.parse_args()
+def sentence_pair_groups(src_path, trg_path, group_sources=False):
+  """Reads parallel source and target files.
 
-  _initialize_t2t(args.t2t_usr_dir)
+  Args:
+    src_path: Path to the source sentences
+    trg_path: Path to the target sentences
+    group_sources: If true, consecutive lines with the same source
+                   sentence are grouped together
+
+  Yields:
+    Tuples (src_sentence, trg_sentences). EOS is appended to each target
+    sentence.
+  """
+  src_sentence = None
+  trg_sentences = []
+  with open(src_path) as src_reader:
+    with open(trg_path) as trg_reader:
+      for src_line, trg_line in zip(src_reader, trg_reader):
+        src = map(int, src_line.strip().split())
+        trg = map(int, trg_line.strip().split()) + [EOS_ID]
+        if trg_sentences and (not group_sources or src != src_sentence):
+          yield src_sentence, trg_sentences
+          trg_sentences = []
+        src_sentence = src
+        trg_sentences.append(trg)
+  if trg_sentences:
+    yield src_sentence, trg_sentences
+
+
+def model_names(args):
+  if args.server:
+    return args.server_models.split(",")
+  if args.frozen_graphs:
+    return args.frozen_graphs.split(",")
+  return args.t2t_models.split(",")
+
+
+def create_adaptors(args):
+  """Creates a list of adaptors, or a FusedTensor2TensorEnsemble if
+  --fused_ensemble is set.
+  """
+  if args.server:
+    if args.fused_ensemble:
+      tf.logging.fatal("--fused_ensemble cannot be combined with --server")
+      raise AttributeError
+    client = t2t_client.ScoringClient(args.server)
+    if not args.modifiers:
+      modifiers = [""] * len(model_names(args))
+    else:
+      modifiers = args.modifiers.split(",")
+    adaptors = []
+    for model_name, modifier in zip(model_names(args), modifiers):
+      adaptor = RemoteAdaptor(client, model_name)
+      if "g" in modifier:
+        adaptor = GlueModifier(adaptor, max_tokens=args.glue_max_tokens)
+      adaptors.append(adaptor)
+    return adaptors
+  if args.frozen_graphs:
+    if args.fused_ensemble or args.encode_once or args.prefix_trie:
+      tf.logging.fatal("--frozen_graphs cannot be combined with "
+                       "--fused_ensemble, --encode_once, or --prefix_trie")
+      raise AttributeError
+    if not args.modifiers:
+      modifiers = [""] * len(model_names(args))
+    else:
+      modifiers = args.modifiers.split(",")
+    adaptors = []
+    for frozen_graph, modifier in zip(model_names(args), modifiers):
+      adaptor = FrozenTensor2TensorAdaptor(
+          frozen_graph, args.src_vocab_size, args.trg_vocab_size,
+          intra_op_threads=args.intra_op_threads)
+      if "g" in modifier:
+        adaptor = GlueModifier(adaptor, max_tokens=args.glue_max_tokens)
+      adaptors.append(adaptor)
+    return adaptors
+  if args.fused_ensemble:
+    if args.modifiers or args.encode_once or args.prefix_trie:
+      tf.logging.fatal("--fused_ensemble cannot be combined with modifiers, "
+                       "--encode_once, or --prefix_trie")
+      raise AttributeError
+    return FusedTensor2TensorEnsemble(args.t2t_models.split(","),
+                                      args.t2t_problems.split(","),
+                                      args.t2t_hparams_sets.split(","),
+                                      args.t2t_checkpoints.split(","),
+                                      args.src_vocab_size,
+                                      args.trg_vocab_size,
+                                      intra_op_threads=args.intra_op_threads,
+                                      top_k=args.top_k)
   adaptors = []
   if not args.modifiers:
     modifiers = [""] * len(args.t2t_models.split(","))
@@ -372,11 +968,21 @@ def main():
                                    hparams_set_name,
                                    checkpoint_dir,
                                    args.src_vocab_size,
-                                   args.trg_vocab_size)
+                                   args.trg_vocab_size,
+                                   encode_once=args.encode_once,
+                                   use_prefix_trie=args.prefix_trie,
+                                   intra_op_threads=args.intra_op_threads,
+                                   top_k=args.top_k,
+                                   batch_pairs="g" in modifier)
     if "g" in modifier:
-      adaptor = GlueModifier(adaptor)
+      adaptor = GlueModifier(adaptor, max_tokens=args.glue_max_tokens)
     adaptors.append(adaptor)
+  return adaptors
 
+
+def create_output_handlers(args, adaptors):
+  if isinstance(adaptors, FusedTensor2TensorEnsemble):
+    adaptors = [adaptors] * adaptors.n_models
   output_handlers = []
   for handler_name in args.output_handlers.split(","):
     if handler_name == "word":
@@ -389,38 +995,237 @@ def main():
       h = WordIdOutputHandler(adaptors)
     elif handler_name == "log_prob":
       h = LogProbOutputHandler(adaptors)
+    elif handler_name == "rank":
+      h = RankOutputHandler(adaptors)
+    elif handler_name == "entropy":
+      h = EntropyOutputHandler(adaptors)
+    elif handler_name == "topk":
+      h = TopKOutputHandler(adaptors, args.top_k)
     else:
       tf.logging.fatal("Unknown output handler '%s'" % handler_name)
       raise AttributeError
     output_handlers.append(h)
-  
-  tf,logging.info("Start writing output file...")
-  with open(args.output_file, "w") as writer:
+  return output_handlers
+
+
+def format_groups(adaptors, output_handlers, groups, output_format="tsv"):
+  """Computes statistics for a list of (src_sentence, trg_sentences)
+  groups and formats them as rows of the output file.
+
+  Returns:
+    Tuple (output, number of processed sentences). For the tsv format,
+    output is a string. For the columnar format, output is a list of
+    (trg_sentence, rows) tuples for ColumnarOutputWriter.
+  """
+  sentences = []
+  n_sentences = 0
+  stat_names = set(n for h in output_handlers for n in h.graph_stats)
+  fused = isinstance(adaptors, FusedTensor2TensorEnsemble)
+  # Compute statistics in TF if all handlers and adaptors support it.
+  # Handlers without graph statistics (word, sen_idx, word_idx) use
+  # the log-probability path, which every adaptor implements.
+  in_graph = fused or (bool(stat_names) and
+                       all(stat_names <= a.supported_graph_stats()
+                           for a in adaptors))
+  for src_sentence, trg_sentences in groups:
+    if fused:
+      all_graph_stats = adaptors.get_stats_batch(
+          src_sentence, trg_sentences, stat_names)
+    elif in_graph:
+      model_stats = [a.get_stats_batch(src_sentence, trg_sentences, stat_names)
+                     for a in adaptors]
+      all_graph_stats = [
+          {n: np.stack([ms[group_idx][n] for ms in model_stats], axis=1)
+           for n in stat_names}
+          for group_idx in xrange(len(trg_sentences))]
+    else:
+      all_log_probs = [a.get_log_probs_batch(src_sentence, trg_sentences)
+                       for a in adaptors]
+    with instrumentation.timed("postprocess"):
+      for group_idx, trg_sentence in enumerate(trg_sentences):
+        if in_graph:
+          log_probs = None
+          graph_stats = all_graph_stats[group_idx]
+        else:
+          log_probs = [lp[group_idx] for lp in all_log_probs]
+          graph_stats = None
+        stats = [h.process(src_sentence, trg_sentence, log_probs, 
+                           graph_stats) 
+                 for h in output_handlers]
+        rows = []
+        for i in xrange(len(trg_sentence)):
+          line = []
+          for handler_stats in stats:
+            line.extend(handler_stats[i])
+          rows.append(line)
+        n_sentences += 1
+        sentences.append((trg_sentence, rows))
+  if output_format == "columnar":
+    return sentences, n_sentences
+  return rows_to_tsv(sentences), n_sentences
+
+
+def rows_to_tsv(sentences):
+  """Formats a list of (trg_sentence, rows) tuples as tsv, with one
+  line per token and an empty line after each sentence.
+  """
+  lines = []
+  for _, rows in sentences:
+    for line in rows:
+      lines.append("\t".join(map(str, line)))
+      lines.append("\n")
+    lines.append("\n")
+  return "".join(lines)
+
+
+def chunk_iter(groups, chunk_size):
+  """Splits the groups into chunks and attaches the index of the first
+  sentence of each chunk.
+
+  Yields:
+    Tuples (first sentence index, list of groups)
+  """
+  sen_idx = 0
+  while True:
+    chunk = list(itertools.islice(groups, chunk_size))
+    if not chunk:
+      break
+    yield sen_idx, chunk
+    sen_idx += sum(len(trg_sentences) for _, trg_sentences in chunk)
+
+
+# State of a worker process in --num_workers mode
+_worker_adaptors = None
+_worker_output_handlers = None
+_worker_output_format = None
+
+
+def _init_worker(args):
+  """Creates the TF sessions in a worker process."""
+  global _worker_adaptors, _worker_output_handlers, _worker_output_format
+  _worker_output_format = args.output_format
+  _initialize_t2t(args.t2t_usr_dir)
+  _worker_adaptors = create_adaptors(args)
+  _worker_output_handlers = create_output_handlers(args, _worker_adaptors)
+
+
+def _format_chunk_in_worker(chunk):
+  first_sen_idx, groups = chunk
+  for h in _worker_output_handlers:
+    if isinstance(h, SentenceIdOutputHandler):
+      h.sen_id = first_sen_idx - 1
+  return format_groups(_worker_adaptors, _worker_output_handlers, groups,
+                       _worker_output_format)
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Force decoding')
+  parser.add_argument('-tm', '--t2t_models', help='Comma-separated list of T2T models', default="")
+  parser.add_argument('-tp', '--t2t_problems', help='Comma-separated list of T2T problems', default="")
+  parser.add_argument('-th', '--t2t_hparams_sets', help='Comma-separated list of T2T hparams sets', default="")
+  parser.add_argument('-tc', '--t2t_checkpoints', help='Paths to T2T checkpoints.', default="")
+  parser.add_argument('-tu', '--t2t_usr_dir', help='usr directory', default="")
+  parser.add_argument('-sv', '--src_vocab_size', help='Source vocabulary size', required=True, type=int)
+  parser.add_argument('-tv', '--trg_vocab_size', help='Target vocabulary size', required=True, type=int)
+  parser.add_argument('-src', '--src_sentences', help='Source sentences', required=True)
+  parser.add_argument('-trg', '--trg_sentences', help='Target sentences', required=True)
+  parser.add_argument('-of', '--output_file', help='Output file (directory for the columnar format)', required=True)
+  parser.add_argument('--output_format', help='tsv: one line per token. columnar: binary column files which can be memory-mapped with columnar_output.load()', choices=['tsv', 'columnar'], default='tsv')
+  parser.add_argument('-m', '--modifiers', help='Comma-separated list of modifiers. g: glue model', default="")
+  parser.add_argument('--glue_max_tokens', help='Maximum number of (padded) source and target tokens per batch when the glue modifier scores the sentences of a document', default=4096, type=int)
+  parser.add_argument('-oh', '--output_handlers', help='Output handlers. Comma-separated list of log_prob,kl,rank,entropy,topk,word,word_idx,sen_idx', required=True)
+  parser.add_argument('--top_k', help='Number of words in the topk output handler', default=5, type=int)
+  parser.add_argument("--write_headers", help="Write name of statistics in first line of the output file", action="store_true")
+  parser.add_argument("--encode_once", help="Run the encoder only once for consecutive lines with the same source sentence (e.g. for n-best lists)", action="store_true")
+  parser.add_argument("--prefix_trie", help="Score consecutive lines with the same source sentence with a prefix trie such that shared target prefixes are computed once", action="store_true")
+  parser.add_argument("--fused_ensemble", help="Build all models in a single graph and compute kl and log_prob statistics in TF", action="store_true")
+  parser.add_argument("--num_workers", help="Number of worker processes, each with its own TF sessions", default=1, type=int)
+  parser.add_argument("--intra_op_threads", help="Number of intra-op threads per TF session (0: TF default)", default=0, type=int)
+  parser.add_argument("--worker_chunk_size", help="Number of source sentences sent to a worker at once", default=10, type=int)
+  parser.add_argument("--server", help="Path to the Unix socket of a t2t_server.py instance. If set, the models on the server are used instead of local TF sessions", default="")
+  parser.add_argument("--server_models", help="Comma-separated list of model names on the server (with --server)", default="")
+  parser.add_argument("--queue_size", help="Maximum number of items in the queues of the reader and writer threads (0: read, score, and write in the main thread)", default=16, type=int)
+  parser.add_argument("--profile_output", help="If set, write the wall time of each session call, graph building, checkpoint restore, and pre- and post-processing step to this JSON-lines file", default="")
+  parser.add_argument("--trace_every_n", help="If positive, write a TF step trace for every n-th session call to --trace_dir", default=0, type=int)
+  parser.add_argument("--trace_dir", help="Output directory for --trace_every_n", default="traces")
+  parser.add_argument("--frozen_graphs", help="Comma-separated list of frozen graphs exported with t2t_freeze_graph.py, used instead of -tm, -tp, -th, and -tc", default="")
+  args = parser.parse_args()
+  if args.server:
+    if not args.server_models:
+      parser.error("--server requires --server_models")
+  elif not args.frozen_graphs and not (
+      args.t2t_models and args.t2t_problems and args.t2t_hparams_sets
+      and args.t2t_checkpoints and args.t2t_usr_dir):
+    parser.error("-tm, -tp, -th, -tc, and -tu are required without "
+                 "--server or --frozen_graphs")
+
+  instrumentation.configure(args.profile_output, args.trace_every_n,
+                            args.trace_dir)
+  if args.num_workers > 1:
+    # TF sessions must not be created before forking the workers
+    pool = multiprocessing.Pool(args.num_workers, _init_worker, (args,))
+    output_handlers = create_output_handlers(
+        args, [None] * len(model_names(args)))
+  else:
+    _initialize_t2t(args.t2t_usr_dir)
+    adaptors = create_adaptors(args)
+    output_handlers = create_output_handlers(args, adaptors)
+
+  tf.logging.info("Start writing output file...")
+  start_time = time.time()
+  headers = []
+  for oh in output_handlers:
+    headers.extend(oh.get_headers())
+  if args.output_format == "columnar":
+    writer = columnar_output.ColumnarOutputWriter(args.output_file, headers)
+  else:
+    writer = open(args.output_file, "w")
     if args.write_headers:
-      headers = []
-      for oh in output_handlers:
-        headers.extend(oh.get_headers())
       writer.write("%s\n" % "\t".join(headers))  
-    with open(args.src_sentences) as src_reader:
-      with open(args.trg_sentences) as trg_reader:
-        for sen_idx, (src_line, trg_line) in enumerate(zip(src_reader, trg_reader)):
-          src_sentence = map(int, src_line.strip().split())
-          trg_sentence = map(int, trg_line.strip().split()) + [EOS_ID]
-          log_probs = [a.get_log_probs(src_sentence, trg_sentence) for a in adaptors]
-          stats = [h.process(src_sentence, trg_sentence, log_probs) for h in output_handlers]
-          for i in xrange(len(trg_sentence)):
-            line = []
-            for handler_stats in stats:
-              line.extend(handler_stats[i])
-            writer.write("\t".join(map(str, line)))
-            writer.write("\n")
-          writer.write("\n")
-          if sen_idx % 10 == 0:
-            tf.logging.info("Processed %d sentences" % sen_idx)
+  groups = instrumentation.timed_iter(
+      sentence_pair_groups(args.src_sentences, args.trg_sentences, 
+                           args.encode_once or args.prefix_trie),
+      "preprocess")
+  if args.num_workers > 1:
+    # imap() returns the results in the order of the input chunks. The
+    # chunks are formatted in the workers.
+    inputs = pool.imap(_format_chunk_in_worker,
+                       chunk_iter(groups, args.worker_chunk_size))
+    process_fn = None
+  else:
+    # Sentence pairs are read in the reader thread and tsv lines are
+    # formatted in the writer thread
+    inputs = groups
+    process_fn = lambda group: format_groups(adaptors, output_handlers,
+                                             [group], "columnar")
+  progress = {"sen_idx": 0}
+
+  def write_result(result):
+    output, n_sentences = result
+    with instrumentation.timed("write_output"):
+      if args.output_format == "columnar":
+        for trg_sentence, rows in output:
+          writer.write(trg_sentence, rows)
+      elif process_fn is None:
+        writer.write(output)
+      else:
+        writer.write(rows_to_tsv(output))
+    sen_idx = progress["sen_idx"]
+    if sen_idx == 0:
+      tf.logging.info("First sentence latency: %.3fs" 
+                      % (time.time() - start_time))
+    if sen_idx // 10 != (sen_idx + n_sentences) // 10:
+      tf.logging.info("Processed %d sentences" % (sen_idx + n_sentences))
+    progress["sen_idx"] = sen_idx + n_sentences
+
+  pipeline.run(inputs, process_fn, write_result, args.queue_size,
+               "force_decode_pipeline")
+  writer.close()
+  if args.num_workers > 1:
+    pool.close()
+    pool.join()
+  instrumentation.finish()
 
 
 if __name__ == '__main__':
   main()
-
-
-
@@ -0,0 +1,497 @@
+# coding=utf-8
+r"""Exports a T2T checkpoint as frozen scoring graph.
+
+The frozen graph contains only the ops needed for scoring, with all
+variables folded into constants. Loading it skips building the model
+from the hparams set and restoring the checkpoint, which speeds up the
+startup of t2t_rescore.py (--frozen_graph), t2t_force_decode.py
+(--frozen_graphs), and t2t_refine_with_glue_lm.py (--frozen_graph).
+
+The graph is batched. Translation models have the inputs
+
+  frozen_inputs:  [batch_size, src_len] int32, padded with 0
+  frozen_targets: [batch_size, trg_len] int32, padded with 0
+
+Glue LMs (--glue_lm) have frozen_targets, frozen_targets_seg, and
+frozen_targets_pos instead. Outputs are
+
+  frozen_log_probs:        [batch_size, trg_len, vocab_size]
+  frozen_word_log_probs:   [batch_size, trg_len], 0 at padding
+  frozen_sentence_scores:  [batch_size]
+
+With --precision float16 or int8, weight matrices are stored in reduced
+precision and converted back to float32 inside the graph. int8 weights
+use one scale per output channel (last axis). This reduces the size of
+the graph file and the memory of the loaded model. Constant folding is
+disabled for such graphs, since it would restore the float32 weights.
+--accuracy_nbest compares the sentence scores of the reduced-precision
+graph with float32 on an n-best list.
+
+  python t2t_freeze_graph.py -tm transformer -tp translate_ende_wmt32k \
+    -th transformer_base -tc train_dir -tu usr -sv 32000 -tv 32000 \
+    -o model.pb --benchmark --precision int8 \
+    --accuracy_src dev.src --accuracy_nbest dev.nbest
+"""
+
+import argparse
+import logging
+import os
+import time
+
+# Requires tensor2tensor
+from tensor2tensor import models  # pylint: disable=unused-import
+from tensor2tensor import problems as problems_lib  # pylint: disable=unused-import
+from tensor2tensor.utils import usr_dir
+from tensor2tensor.utils import registry
+from tensor2tensor.utils import trainer_lib
+from tensor2tensor.data_generators.text_encoder import TextEncoder
+from tensor2tensor.data_generators import problem  # pylint: disable=unused-import
+import tensorflow as tf
+from tensorflow.core.protobuf import rewriter_config_pb2
+from tensorflow.python.framework import tensor_util
+from tensorflow.python.training import saver
+import numpy as np
+
+PAD_ID = 0
+EOS_ID = 1
+BOS_ID = 2
+
+INPUTS = "frozen_inputs"
+TARGETS = "frozen_targets"
+TARGETS_SEG = "frozen_targets_seg"
+TARGETS_POS = "frozen_targets_pos"
+LOG_PROBS = "frozen_log_probs"
+WORD_LOG_PROBS = "frozen_word_log_probs"
+SENTENCE_SCORES = "frozen_sentence_scores"
+OUTPUTS = [LOG_PROBS, WORD_LOG_PROBS, SENTENCE_SCORES]
+# Suffix of the constants with reduced-precision weights
+QUANTIZED_SUFFIX = "/quantized_values"
+
+
+class DummyTextEncoder(TextEncoder):
+  """Dummy TextEncoder implementation. The TextEncoder
+  implementation in tensor2tensor reads the vocabulary file in
+  the constructor, which is not available inside SGNMT. This
+  class can be used to replace the standard TextEncoder
+  implementation with a fixed vocabulary size. Note that this
+  encoder cannot be used to translate between raw text and
+  integer sequences.
+  """
+
+  def __init__(self, vocab_size):
+    super(DummyTextEncoder, self).__init__(num_reserved_ids=None)
+    self._vocab_size = vocab_size
+
+  def encode(self, s):
+    raise NotImplementedError("Dummy encoder cannot be used to encode.")
+
+  def decode(self, ids):
+    raise NotImplementedError("Dummy encoder cannot be used to decode.")
+
+  @property
+  def vocab_size(self):
+    return self._vocab_size
+
+
+def expand_input_dims_for_t2t(t):
+  """Expands a [batch_size, len] tensor for using it in a T2T graph."""
+  t = tf.expand_dims(t, -1) # Because of modality
+  t = tf.expand_dims(t, -1) # Because of random reason X
+  return t
+
+
+def gather_2d(params, indices):
+  """Batched version of tf.gather(), see t2t_gibbs.py."""
+  batch_size = tf.shape(params)[0]
+  num_indices = tf.shape(indices)[1]
+  batch_indices = tf.tile(tf.expand_dims(tf.range(batch_size), 1),
+                          [1, num_indices])
+  gather_nd_indices = tf.stack([batch_indices, indices], axis=2)
+  return tf.gather_nd(params, gather_nd_indices)
+
+
+def build_scoring_graph(model_name, problem_name, hparams_set_name,
+                        src_vocab_size, trg_vocab_size, glue_lm=False):
+  """Builds the batched scoring graph in the default graph, with the
+  tensor names listed in the module docstring.
+  """
+  hparams = trainer_lib.create_hparams(hparams_set_name)
+  problem = registry.problem(problem_name)
+  problem._encoders = {
+      "targets": DummyTextEncoder(vocab_size=trg_vocab_size)
+  }
+  if not glue_lm:
+    problem._encoders["inputs"] = DummyTextEncoder(vocab_size=src_vocab_size)
+  hparams.problem = problem
+  hparams.problem_hparams = problem.get_hparams(hparams)
+  translate_model = registry.model(model_name)(
+      hparams, tf.estimator.ModeKeys.EVAL)
+  targets = tf.placeholder(dtype=tf.int32, shape=[None, None], name=TARGETS)
+  features = {"targets": expand_input_dims_for_t2t(targets)}
+  if glue_lm:
+    features["targets_seg"] = tf.placeholder(
+        dtype=tf.int32, shape=[None, None], name=TARGETS_SEG)
+    features["targets_pos"] = tf.placeholder(
+        dtype=tf.int32, shape=[None, None], name=TARGETS_POS)
+  else:
+    inputs = tf.placeholder(dtype=tf.int32, shape=[None, None], name=INPUTS)
+    features["inputs"] = expand_input_dims_for_t2t(inputs)
+  translate_model.prepare_features_for_infer(features)
+  translate_model._fill_problem_hparams_features(features)
+  logits, _ = translate_model(features)
+  logits = tf.squeeze(logits, [2, 3])
+  log_probs = logits - tf.reduce_logsumexp(logits, axis=-1, keepdims=True)
+  no_pad = tf.cast(tf.not_equal(targets, PAD_ID), tf.float32)
+  shp = tf.shape(targets)
+  flat_bsz = shp[0] * shp[1]
+  word_log_probs = gather_2d(tf.reshape(log_probs, [flat_bsz, -1]),
+                             tf.reshape(targets, [flat_bsz, 1]))
+  word_log_probs = tf.reshape(word_log_probs, (shp[0], shp[1])) * no_pad
+  tf.identity(log_probs, name=LOG_PROBS)
+  tf.identity(word_log_probs, name=WORD_LOG_PROBS)
+  tf.identity(tf.reduce_sum(word_log_probs, -1), name=SENTENCE_SCORES)
+
+
+def pad_sentences(sentences):
+  """Creates a [len(sentences), max_len] array padded with zeros."""
+  max_len = max(len(s) for s in sentences)
+  padded = np.zeros((len(sentences), max_len), dtype=np.int32)
+  for i, s in enumerate(sentences):
+    padded[i, :len(s)] = s
+  return padded
+
+
+def _session_config(intra_op_threads, constant_folding=True):
+  graph_options = tf.GraphOptions(optimizer_options=tf.OptimizerOptions(
+      opt_level=tf.OptimizerOptions.L1 if constant_folding
+                else tf.OptimizerOptions.L0,
+      do_function_inlining=False))
+  if not constant_folding:
+    graph_options.rewrite_options.constant_folding = \
+        rewriter_config_pb2.RewriterConfig.OFF
+  return tf.ConfigProto(
+      intra_op_parallelism_threads=intra_op_threads,
+      allow_soft_placement=True,
+      graph_options=graph_options,
+      gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=0.95),
+      log_device_placement=False)
+
+
+def _checkpoint_path(checkpoint_dir):
+  if os.path.isdir(checkpoint_dir):
+    return saver.latest_checkpoint(checkpoint_dir)
+  return checkpoint_dir
+
+
+def freeze(args):
+  """Builds the scoring graph, restores the checkpoint, and returns the
+  frozen GraphDef.
+  """
+  graph = tf.Graph()
+  with graph.as_default():
+    build_scoring_graph(args.t2t_model, args.t2t_problem,
+                        args.t2t_hparams_set, args.src_vocab_size,
+                        args.trg_vocab_size, args.glue_lm)
+    with tf.Session(config=_session_config(0)) as sess:
+      tf.train.Saver().restore(sess, _checkpoint_path(args.t2t_checkpoint))
+      # Also removes all ops which are not needed for the outputs
+      return tf.graph_util.convert_variables_to_constants(
+          sess, graph.as_graph_def(), OUTPUTS)
+
+
+def _const_node(name, value):
+  node = tf.NodeDef()
+  node.op = "Const"
+  node.name = name
+  node.attr["dtype"].type = tf.as_dtype(value.dtype).as_datatype_enum
+  node.attr["value"].tensor.CopyFrom(tensor_util.make_tensor_proto(value))
+  return node
+
+
+def _op_node(name, op, inputs, **attrs):
+  node = tf.NodeDef()
+  node.op = op
+  node.name = name
+  node.input.extend(inputs)
+  for key, dtype in attrs.items():
+    node.attr[key].type = dtype.as_datatype_enum
+  return node
+
+
+def quantize_weights(weights, precision):
+  """Converts a float32 weight matrix to reduced precision.
+
+  Returns:
+    Tuple (values, scales). `scales` is None for float16. For int8,
+    weights are approximated by values * scales, with one scale for
+    each entry in the last dimension.
+  """
+  if precision == "float16":
+    return weights.astype(np.float16), None
+  axes = tuple(range(weights.ndim - 1))
+  scales = np.max(np.abs(weights), axis=axes) / 127.0
+  scales[scales == 0.0] = 1.0
+  values = np.clip(np.round(weights / scales), -127, 127).astype(np.int8)
+  return values, scales.astype(np.float32)
+
+
+def quantize_graph_def(graph_def, precision, min_size=1024):
+  """Replaces float32 constants with at least two dimensions and
+  `min_size` entries by reduced-precision constants and conversion ops
+  with the same name, so that the consumers are unchanged. Biases and
+  layer norm parameters are kept in float32.
+  """
+  quantized = tf.GraphDef()
+  quantized.versions.CopyFrom(graph_def.versions)
+  n_bytes = [0, 0]
+  for node in graph_def.node:
+    if (node.op != "Const"
+        or node.attr["dtype"].type != tf.float32.as_datatype_enum):
+      quantized.node.extend([node])
+      continue
+    weights = tensor_util.MakeNdarray(node.attr["value"].tensor)
+    if weights.ndim < 2 or weights.size < min_size:
+      quantized.node.extend([node])
+      continue
+    values, scales = quantize_weights(weights, precision)
+    n_bytes[0] += weights.nbytes
+    n_bytes[1] += values.nbytes + (scales.nbytes if scales is not None else 0)
+    values_name = node.name + QUANTIZED_SUFFIX
+    quantized.node.extend([_const_node(values_name, values)])
+    if scales is None:
+      quantized.node.extend([_op_node(node.name, "Cast", [values_name],
+                                      SrcT=tf.float16, DstT=tf.float32)])
+    else:
+      scales_name = node.name + "/quantized_scales"
+      cast_name = node.name + "/dequantize"
+      quantized.node.extend([
+          _const_node(scales_name, scales),
+          _op_node(cast_name, "Cast", [values_name],
+                   SrcT=tf.int8, DstT=tf.float32),
+          _op_node(node.name, "Mul", [cast_name, scales_name], T=tf.float32)])
+  logging.info("Converted %.1f MB of float32 weights to %.1f MB %s weights"
+               % (n_bytes[0] / 1e6, n_bytes[1] / 1e6, precision))
+  return quantized
+
+
+def load_frozen_graph(path, intra_op_threads=0):
+  """Imports a frozen graph written by this script.
+
+  Returns:
+    Tuple (graph, session). Tensors can be looked up with
+    graph.get_tensor_by_name("%s:0" % name).
+  """
+  graph_def = tf.GraphDef()
+  with tf.gfile.GFile(path, "rb") as f:
+    graph_def.ParseFromString(f.read())
+  return _import_graph_def(graph_def, intra_op_threads)
+
+
+def _import_graph_def(graph_def, intra_op_threads=0):
+  graph = tf.Graph()
+  with graph.as_default():
+    tf.import_graph_def(graph_def, name="")
+  constant_folding = not any(node.name.endswith(QUANTIZED_SUFFIX)
+                             for node in graph_def.node)
+  return graph, tf.Session(graph=graph, config=_session_config(
+      intra_op_threads, constant_folding))
+
+
+def gen_seg_and_pos(glued):
+  """Segment and position features for a glued document."""
+  seg = []
+  pos = []
+  cur_seg = 1
+  cur_pos = 0
+  for w in glued:
+    seg.append(cur_seg)
+    pos.append(cur_pos)
+    if w == BOS_ID:
+      cur_seg += 1
+      cur_pos = 0
+    else:
+      cur_pos += 1
+  return seg, pos
+
+
+def _first_sentence_feed(graph, args):
+  """Feed dict with a short dummy sentence pair."""
+  trg = [[3, 4, 5, BOS_ID, 6, 7, 1]]
+  tensor = lambda name: graph.get_tensor_by_name("%s:0" % name)
+  feed_dict = {tensor(TARGETS): trg}
+  if args.glue_lm:
+    seg, pos = gen_seg_and_pos(trg[0])
+    feed_dict[tensor(TARGETS_SEG)] = [seg]
+    feed_dict[tensor(TARGETS_POS)] = [pos]
+  else:
+    feed_dict[tensor(INPUTS)] = [[3, 4, 5, 6, 1]]
+  return feed_dict
+
+
+def benchmark(args):
+  """Compares startup time and first-sentence latency of the full graph
+  with the frozen graph in args.output.
+  """
+  start_time = time.time()
+  graph = tf.Graph()
+  with graph.as_default():
+    build_scoring_graph(args.t2t_model, args.t2t_problem,
+                        args.t2t_hparams_set, args.src_vocab_size,
+                        args.trg_vocab_size, args.glue_lm)
+    sess = tf.Session(config=_session_config(0))
+    tf.train.Saver().restore(sess, _checkpoint_path(args.t2t_checkpoint))
+  full_startup = time.time() - start_time
+  start_time = time.time()
+  full_scores = sess.run(graph.get_tensor_by_name("%s:0" % SENTENCE_SCORES),
+                         _first_sentence_feed(graph, args))
+  full_latency = time.time() - start_time
+  sess.close()
+  start_time = time.time()
+  graph, sess = load_frozen_graph(args.output)
+  frozen_startup = time.time() - start_time
+  start_time = time.time()
+  frozen_scores = sess.run(
+      graph.get_tensor_by_name("%s:0" % SENTENCE_SCORES),
+      _first_sentence_feed(graph, args))
+  frozen_latency = time.time() - start_time
+  sess.close()
+  logging.info("Full graph:   startup=%.2fs first_sentence=%.3fs"
+               % (full_startup, full_latency))
+  logging.info("Frozen graph: startup=%.2fs first_sentence=%.3fs"
+               % (frozen_startup, frozen_latency))
+  logging.info("Score difference: %g"
+               % np.max(np.abs(full_scores - frozen_scores)))
+
+
+def _read_nbest(src_path, nbest_path, glue_lm):
+  """Reads a Moses n-best list with token IDs.
+
+  Returns:
+    List of (src_sentence, trg_sentences) tuples. Target sentences end
+    with EOS unless `glue_lm` is true.
+  """
+  src_sentences = []
+  if src_path:
+    with open(src_path) as src_reader:
+      src_sentences = [[int(w) for w in line.split()] + [EOS_ID]
+                       for line in src_reader]
+  groups = []
+  cur_idx = None
+  with open(nbest_path) as nbest_reader:
+    for line in nbest_reader:
+      parts = line.split("|||")
+      idx = int(parts[0].strip())
+      trg = [int(w) for w in parts[1].split()]
+      if not glue_lm:
+        trg.append(EOS_ID)
+      if idx != cur_idx:
+        groups.append((src_sentences[idx] if src_sentences else None, []))
+        cur_idx = idx
+      groups[-1][1].append(trg)
+  return groups
+
+
+def _score_nbest(graph, sess, groups, glue_lm, batch_size=32):
+  """Sentence scores for all hypotheses in `groups`."""
+  tensor = lambda name: graph.get_tensor_by_name("%s:0" % name)
+  pairs = [(src, trg) for src, trgs in groups for trg in trgs]
+  scores = []
+  for start in xrange(0, len(pairs), batch_size):
+    batch = pairs[start:start+batch_size]
+    trg_batch = pad_sentences([trg for _, trg in batch])
+    feed_dict = {tensor(TARGETS): trg_batch}
+    if glue_lm:
+      seg_batch = np.zeros_like(trg_batch)
+      pos_batch = np.zeros_like(trg_batch)
+      for i, (_, trg) in enumerate(batch):
+        seg, pos = gen_seg_and_pos(trg)
+        seg_batch[i, :len(trg)] = seg
+        pos_batch[i, :len(trg)] = pos
+      feed_dict[tensor(TARGETS_SEG)] = seg_batch
+      feed_dict[tensor(TARGETS_POS)] = pos_batch
+    else:
+      feed_dict[tensor(INPUTS)] = pad_sentences([src for src, _ in batch])
+    scores.extend(sess.run(tensor(SENTENCE_SCORES), feed_dict))
+  return np.array(scores)
+
+
+def accuracy_report(float32_graph_def, quantized_graph_def, args):
+  """Compares the sentence scores of the reduced-precision graph with
+  float32 on an n-best list.
+  """
+  groups = _read_nbest(args.accuracy_src, args.accuracy_nbest, args.glue_lm)
+  all_scores = []
+  for graph_def in [float32_graph_def, quantized_graph_def]:
+    graph, sess = _import_graph_def(graph_def)
+    start_time = time.time()
+    all_scores.append(_score_nbest(graph, sess, groups, args.glue_lm))
+    logging.info("Scored %d hypotheses in %.2fs"
+                 % (len(all_scores[-1]), time.time() - start_time))
+    sess.close()
+  float32_scores, quantized_scores = all_scores
+  diff = np.abs(float32_scores - quantized_scores)
+  same_best = 0
+  n_pairs = 0
+  same_order = 0
+  start = 0
+  for _, trgs in groups:
+    f = float32_scores[start:start+len(trgs)]
+    q = quantized_scores[start:start+len(trgs)]
+    start += len(trgs)
+    same_best += int(np.argmax(f) == np.argmax(q))
+    f_order = np.sign(f[:, None] - f[None, :])
+    q_order = np.sign(q[:, None] - q[None, :])
+    n_pairs += len(trgs) * (len(trgs) - 1)
+    same_order += np.sum(f_order == q_order) - len(trgs)
+  logging.info("Accuracy of %s vs. float32 on %d hypotheses (%d sentences):"
+               % (args.precision, len(diff), len(groups)))
+  logging.info("  Score difference: mean=%g max=%g"
+               % (np.mean(diff), np.max(diff)))
+  logging.info("  Same 1-best: %.2f%%" % (100.0 * same_best / len(groups)))
+  logging.info("  Pairwise order agreement: %.2f%%"
+               % (100.0 * same_order / max(n_pairs, 1)))
+  logging.info("  Graph size: float32=%.1f MB %s=%.1f MB" % (
+      float32_graph_def.ByteSize() / 1e6, args.precision,
+      quantized_graph_def.ByteSize() / 1e6))
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Exports a frozen T2T scoring graph')
+  parser.add_argument('-tm', '--t2t_model', help='T2T model', required=True)
+  parser.add_argument('-tp', '--t2t_problem', help='T2T problem', required=True)
+  parser.add_argument('-th', '--t2t_hparams_set', help='T2T hparams set', required=True)
+  parser.add_argument('-tc', '--t2t_checkpoint', help='Path to T2T checkpoint', required=True)
+  parser.add_argument('-tu', '--t2t_usr_dir', help='usr directory', required=True)
+  parser.add_argument('-sv', '--src_vocab_size', help='Source vocabulary size', default=0, type=int)
+  parser.add_argument('-tv', '--trg_vocab_size', help='Target vocabulary size', required=True, type=int)
+  parser.add_argument('-o', '--output', help='Output path of the frozen graph', required=True)
+  parser.add_argument('--glue_lm', help='Export a glue LM with segment and position features', action='store_true')
+  parser.add_argument('--precision', help='Precision of the weights in the exported graph', choices=['float32', 'float16', 'int8'], default='float32')
+  parser.add_argument('--accuracy_src', help='Source sentences for --accuracy_nbest', default="")
+  parser.add_argument('--accuracy_nbest', help='Compare the sentence scores on this n-best list with float32 after exporting with reduced precision', default="")
+  parser.add_argument('--benchmark', help='Compare startup time and first-sentence latency with the full graph after exporting', action='store_true')
+  args = parser.parse_args()
+  if args.accuracy_nbest:
+    if args.precision == "float32":
+      parser.error("--accuracy_nbest requires --precision float16 or int8")
+    if not args.glue_lm and not args.accuracy_src:
+      parser.error("--accuracy_nbest requires --accuracy_src unless --glue_lm")
+  logging.basicConfig(level=logging.INFO)
+  tf.logging.set_verbosity(tf.logging.INFO)
+  usr_dir.import_usr_dir(args.t2t_usr_dir)
+  frozen_graph_def = freeze(args)
+  if args.precision != "float32":
+    float32_graph_def = frozen_graph_def
+    frozen_graph_def = quantize_graph_def(frozen_graph_def, args.precision)
+    if args.accuracy_nbest:
+      accuracy_report(float32_graph_def, frozen_graph_def, args)
+  with tf.gfile.GFile(args.output, "wb") as f:
+    f.write(frozen_graph_def.SerializeToString())
+  logging.info("Wrote frozen graph with %d ops to %s"
+               % (len(frozen_graph_def.node), args.output))
+  if args.benchmark:
+    benchmark(args)
+
+
+if __name__ == '__main__':
+  main()
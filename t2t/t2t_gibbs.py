@@ -6,9 +6,15 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import heapq
+import itertools
 import operator
+import time
 import numpy as np
 
+import instrumentation
+import t2t_client
+import xla_buckets
 
 from tensor2tensor import models  # pylint: disable=unused-import
 from tensor2tensor import problems as problems_lib  # pylint: disable=unused-import
@@ -41,7 +47,12 @@ flags.DEFINE_bool("sanity_check", False,
                   "Test conditional independence for Gibbs and exit.")
 flags.DEFINE_integer("sampling_steps_per_word", 50, "Number of Gibbs sampling steps per source word.")
 flags.DEFINE_integer("keep_every_n_samples", 1, "Only keep samples every n Gibbs sampling steps.")
-flags.DEFINE_integer("batch_size", 1, "Batch size.")
+flags.DEFINE_integer("batch_size", 1, "Number of source sentences per batch.")
+flags.DEFINE_integer("num_chains", 1, "Number of independent Gibbs chains per sentence.")
+flags.DEFINE_integer("steps_per_call", 1,
+                     "Number of Gibbs sampling steps in a single session call. "
+                     "Values larger than 1 run the sampling loop inside the "
+                     "TF graph with tf.while_loop.")
 flags.DEFINE_integer("src_vocab_size", 123, "Source vocabulary size.")
 flags.DEFINE_integer("trg_vocab_size", 123, "Target vocabulary size.")
 flags.DEFINE_float("sampling_temperature", 1.0, "Sampling temperature (high temperature -> high entropy).")
@@ -51,6 +62,31 @@ flags.DEFINE_string("model", None, "T2T model name.")
 flags.DEFINE_string("hparams_set", None, "T2T hparams set name.")
 flags.DEFINE_string("outputs", "text,nbest", "Output formats (like in SGNMT).")
 flags.DEFINE_string("output_path", "t2t-gibbs-out.%s", "Output path (like in SGNMT).")
+flags.DEFINE_integer("nbest", 0, "Maximum number of n-best entries per sentence (0: no limit).")
+flags.DEFINE_bool("resume", False,
+                  "If true, skip sentences which are already complete in an "
+                  "existing n-best output file and append to it.")
+flags.DEFINE_string("server", None,
+                    "Path to the Unix socket of a t2t_server.py instance. If "
+                    "set, sampling steps are run by the server instead of a "
+                    "local TF session.")
+flags.DEFINE_string("server_model", None,
+                    "Name of the model on the server (with --server).")
+flags.DEFINE_string("profile_output", None,
+                    "If set, write the wall time of each session call, "
+                    "graph building, checkpoint restore, and pre- and "
+                    "post-processing step to this JSON-lines file.")
+flags.DEFINE_integer("trace_every_n", 0,
+                     "If positive, write a TF step trace for every n-th "
+                     "session call to --trace_dir.")
+flags.DEFINE_string("trace_dir", "traces",
+                    "Output directory for --trace_every_n.")
+flags.DEFINE_string("xla_buckets", "",
+                    "Comma-separated list of <batch_size>x<length> buckets, "
+                    "e.g. '8x32,8x64'. If set, a copy of the sampling step "
+                    "with static shapes is compiled with XLA for each "
+                    "bucket, and batches are padded to the smallest bucket "
+                    "which fits. Not supported with --steps_per_call > 1.")
 
 EOS_ID = 1
 PAD_ID = 0
@@ -174,40 +210,160 @@ def gather_2d(params, indices):
 class GibbsSampler(object):
 
   def __init__(self):
+    start_time = time.time()
     sampling_graph = tf.Graph()
     with sampling_graph.as_default() as g:
       hparams = trainer_lib.create_hparams(FLAGS.hparams_set)
       self._add_problem_hparams(hparams)
       translate_model = registry.model(FLAGS.model)(
           hparams, tf.estimator.ModeKeys.EVAL)
-      self._inputs_var = tf.placeholder(dtype=tf.int32, shape=[FLAGS.batch_size, None],
+      # One row for each chain
+      self._inputs_var = tf.placeholder(dtype=tf.int32, shape=[None, None],
                                         name="sampler_inputs")
-      self._targets_var = tf.placeholder(dtype=tf.int32, shape=[FLAGS.batch_size, None], 
+      self._targets_var = tf.placeholder(dtype=tf.int32, shape=[None, None], 
                                          name="sampler_targets")
-      self._pos_var = tf.placeholder(dtype=tf.int32, shape=(), 
+      # Sampling position for each chain
+      self._pos_var = tf.placeholder(dtype=tf.int32, shape=[None], 
                                      name="sampler_pos")
-      features = {"inputs": expand_input_dims_for_t2t(self._inputs_var), 
-                  "targets": expand_input_dims_for_t2t(self._targets_var)}
-      translate_model.prepare_features_for_infer(features)
-      translate_model._fill_problem_hparams_features(features)
-      logits, _ = translate_model(features)
-      logits = tf.squeeze(logits, [2, 3])
-      self._log_probs = log_prob_from_logits(logits)
       if FLAGS.sampling_temperature != 1.0:
         tf.logging.info("Using sampling temperature of %f" % FLAGS.sampling_temperature)
-        logits = self._log_probs * (1.0 / FLAGS.sampling_temperature)
-      # logits are potentially temperature scaled, log_probs are not
-      self._samples = tf.squeeze(
-          tf.multinomial(logits[:,self._pos_var,:], 1), -1)
-      no_pad = tf.cast(tf.not_equal(self._targets_var, PAD_ID), tf.float32)
-      shp = tf.shape(self._targets_var)
-      flat_bsz = shp[0] * shp[1]
-      word_loss = gather_2d(
-          tf.reshape(self._log_probs, [flat_bsz, -1]),
-          tf.reshape(self._targets_var, [flat_bsz, 1]))
-      word_loss = tf.reshape(word_loss, (shp[0], shp[1])) * no_pad
-      self._sentence_loss = tf.reduce_sum(word_loss, -1)
+      self._log_probs, self._samples, self._sentence_loss = self._sampling_step(
+          translate_model, self._inputs_var, self._targets_var, self._pos_var)
+      self._in_graph = FLAGS.steps_per_call > 1
+      if self._in_graph:
+        with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+          self._build_sampling_loop(translate_model)
+      self._bucket_vars = {}
+      if FLAGS.xla_buckets:
+        if self._in_graph:
+          raise AttributeError("--xla_buckets is not supported with "
+                               "--steps_per_call > 1")
+        self._build_buckets(translate_model)
+      restore_start_time = time.time()
       self.mon_sess = create_session()
+    instrumentation.record("graph_build", restore_start_time - start_time)
+    instrumentation.record("restore", time.time() - restore_start_time)
+
+  def _build_buckets(self, translate_model):
+    """Creates a copy of the sampling step with static input shapes for
+    each bucket in --xla_buckets, see t2t_rescore.py.
+    """
+    self._buckets = xla_buckets.parse_buckets(FLAGS.xla_buckets)
+    jit_scope = tf.contrib.compiler.jit.experimental_jit_scope
+    for batch_size, length in self._buckets:
+      suffix = "%dx%d" % (batch_size, length)
+      inputs = tf.placeholder(dtype=tf.int32, shape=[batch_size, length],
+                              name="sampler_inputs_%s" % suffix)
+      targets = tf.placeholder(dtype=tf.int32, shape=[batch_size, length],
+                               name="sampler_targets_%s" % suffix)
+      pos = tf.placeholder(dtype=tf.int32, shape=[batch_size],
+                           name="sampler_pos_%s" % suffix)
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        with jit_scope():
+          _, samples, sentence_loss = self._sampling_step(
+              translate_model, inputs, targets, pos)
+      self._bucket_vars[(batch_size, length)] = (
+          inputs, targets, pos, samples, sentence_loss)
+    tf.logging.info("Created %d XLA buckets: %s" 
+                    % (len(self._buckets), FLAGS.xla_buckets))
+
+  def _sampling_step(self, translate_model, inputs, targets, pos):
+    """Creates the graph for a single Gibbs sampling step.
+
+    Returns:
+      Tuple (log_probs, samples, sentence_loss) with the full log-prob
+      tensor, a sample for position `pos` in each chain, and the score
+      of the current target sentences.
+    """
+    features = {"inputs": expand_input_dims_for_t2t(inputs), 
+                "targets": expand_input_dims_for_t2t(targets)}
+    translate_model.prepare_features_for_infer(features)
+    translate_model._fill_problem_hparams_features(features)
+    logits, _ = translate_model(features)
+    logits = tf.squeeze(logits, [2, 3])
+    log_probs = log_prob_from_logits(logits)
+    if FLAGS.sampling_temperature != 1.0:
+      logits = log_probs * (1.0 / FLAGS.sampling_temperature)
+    # logits are potentially temperature scaled, log_probs are not
+    pos_logits = tf.squeeze(gather_2d(logits, tf.expand_dims(pos, 1)), 1)
+    samples = tf.to_int32(tf.squeeze(tf.multinomial(pos_logits, 1), -1))
+    no_pad = tf.cast(tf.not_equal(targets, PAD_ID), tf.float32)
+    shp = tf.shape(targets)
+    flat_bsz = shp[0] * shp[1]
+    word_loss = gather_2d(
+        tf.reshape(log_probs, [flat_bsz, -1]),
+        tf.reshape(targets, [flat_bsz, 1]))
+    word_loss = tf.reshape(word_loss, (shp[0], shp[1])) * no_pad
+    sentence_loss = tf.reduce_sum(word_loss, -1)
+    return log_probs, samples, sentence_loss
+
+  def _build_sampling_loop(self, translate_model):
+    """Creates a tf.while_loop which runs FLAGS.steps_per_call sampling
+    steps in one session call. The loop mirrors the Python loop in
+    `sample()`: positions sweep over each chain, chains are cut after
+    EOS and extended when the last position is resampled. The targets
+    have a fixed width inside the loop, which must be at least the
+    initial width plus FLAGS.steps_per_call, because chains grow by at
+    most one token per step. Only kept samples are returned.
+    """
+    self._loop_lengths_var = tf.placeholder(dtype=tf.int32, shape=[None],
+                                            name="sampler_loop_lengths")
+    self._loop_changed_var = tf.placeholder(dtype=tf.bool, shape=[None],
+                                            name="sampler_loop_changed")
+    self._loop_n_steps_var = tf.placeholder(dtype=tf.int32, shape=[None],
+                                            name="sampler_loop_n_steps")
+    self._loop_start_step_var = tf.placeholder(
+        dtype=tf.int32, shape=(), name="sampler_loop_start_step")
+    n_iter = FLAGS.steps_per_call
+    width = tf.shape(self._targets_var)[1]
+    col_indices = tf.expand_dims(tf.range(width), 0)
+
+    def body(i, trg, pos, lengths, changed, kept_trg, kept_scores, keep_mask):
+      step = self._loop_start_step_var + i
+      active = self._loop_n_steps_var > step
+      pos += 1
+      # Don't use pos % trg_len because trg_len changes
+      pos = tf.where(pos >= lengths, tf.zeros_like(pos), pos)
+      _, samples, sentence_loss = self._sampling_step(
+          translate_model, self._inputs_var, trg, pos)
+      keep = tf.logical_and(
+          tf.logical_and(active, changed),
+          tf.equal(step % FLAGS.keep_every_n_samples, 0))
+      kept_trg = kept_trg.write(i, trg)
+      kept_scores = kept_scores.write(i, sentence_loss)
+      keep_mask = keep_mask.write(i, keep)
+      changed = tf.logical_and(changed, tf.logical_not(keep))
+      at_pos = tf.logical_and(tf.equal(col_indices, tf.expand_dims(pos, 1)),
+                              tf.expand_dims(active, 1))
+      old = tf.reduce_sum(trg * tf.to_int32(at_pos), 1)
+      trg = tf.where(at_pos, 
+                     tf.tile(tf.expand_dims(samples, 1), [1, width]), trg)
+      changed = tf.logical_or(changed, tf.logical_and(
+          active, tf.not_equal(old, samples)))
+      is_eos = tf.logical_and(active, tf.equal(samples, EOS_ID))
+      extend = tf.logical_and(tf.logical_and(active, tf.logical_not(is_eos)),
+                              tf.equal(pos, lengths - 1))
+      lengths = tf.where(is_eos, pos + 1, 
+                         tf.where(extend, lengths + 1, lengths))
+      trg *= tf.to_int32(col_indices < tf.expand_dims(lengths, 1))
+      return (i + 1, trg, pos, lengths, changed, 
+              kept_trg, kept_scores, keep_mask)
+
+    loop_vars = (
+        tf.constant(0), self._targets_var, self._pos_var,
+        self._loop_lengths_var, self._loop_changed_var,
+        tf.TensorArray(tf.int32, size=n_iter),
+        tf.TensorArray(tf.float32, size=n_iter),
+        tf.TensorArray(tf.bool, size=n_iter))
+    (_, self._loop_trg, self._loop_pos, self._loop_lengths, 
+     self._loop_changed, kept_trg, kept_scores, keep_mask) = tf.while_loop(
+        lambda i, *_: i < n_iter, body, loop_vars)
+    keep_mask = keep_mask.stack()
+    bsz = tf.shape(self._targets_var)[0]
+    self._loop_kept_trg = tf.boolean_mask(kept_trg.stack(), keep_mask)
+    self._loop_kept_scores = tf.boolean_mask(kept_scores.stack(), keep_mask)
+    self._loop_kept_chains = tf.boolean_mask(
+        tf.tile(tf.expand_dims(tf.range(bsz), 0), [n_iter, 1]), keep_mask)
 
   def _add_problem_hparams(self, hparams):
     """Add problem hparams for the problems. 
@@ -234,46 +390,153 @@ class GibbsSampler(object):
     return hparams
 
   def sample(self, src_sentences, trg_sentences):
-    bsz = src_sentences.shape[0]
-    res = [[]] * bsz
-    n_steps = src_sentences.shape[1] * FLAGS.sampling_steps_per_word
-    tf.logging.debug("Run Gibbs sampling for %d steps" % n_steps)
-    pos = 1000000
-    changed = True
-    for step in xrange(n_steps):
+    """Runs FLAGS.num_chains Gibbs chains for each sentence pair. All
+    chains are advanced together in the batch dimension. Each chain has
+    its own sampling position and length. Chains which have finished
+    all of their sampling steps stay in the batch but are masked out.
+    Target sentences are padded with PAD_ID.
+
+    Args:
+      src_sentences: List of source sentences (lists of ints)
+      trg_sentences: List of initial target sentences (with EOS)
+
+    Returns:
+      List of lists of (score, sample) tuples, one list for each
+      sentence pair.
+    """
+    n_chains = FLAGS.num_chains
+    sen_indices = np.repeat(np.arange(len(src_sentences)), n_chains)
+    bsz = len(sen_indices)
+    src_batch = pad_sentences([src_sentences[i] for i in sen_indices])
+    trg_batch = pad_sentences([trg_sentences[i] for i in sen_indices])
+    lengths = np.array([len(trg_sentences[i]) for i in sen_indices])
+    n_steps = np.array([len(src_sentences[i]) * FLAGS.sampling_steps_per_word
+                        for i in sen_indices])
+    tf.logging.debug("Run Gibbs sampling for %s steps" % n_steps)
+    res = [[] for _ in src_sentences]
+    pos = np.full(bsz, -1, dtype=np.int32)
+    changed = np.ones(bsz, dtype=np.bool)
+    if self._in_graph:
+      self._sample_in_graph(src_batch, trg_batch, lengths, n_steps, pos, 
+                            changed, sen_indices, res)
+      return res
+    for step in xrange(np.max(n_steps)):
+      active = n_steps > step
       pos += 1
-      if pos >= trg_sentences.shape[1]:
-        # Don't use pos % trg_len because trg_len changes
-        pos = 0
-        active = np.array([True] * bsz)
-      if changed and step % FLAGS.keep_every_n_samples == 0:
-        sentence_loss, samples = self.mon_sess.run(
-          (self._sentence_loss, self._samples),
-          {self._inputs_var: src_sentences,
-           self._targets_var: trg_sentences,
-           self._pos_var: pos})
-        tf.logging.debug("Sample step=%d len=%s score=%s sen=%s" 
-                         % (step, trg_sentences.shape[1], sentence_loss, trg_sentences))
-        for batch_idx in xrange(bsz):
-          res[batch_idx].append((sentence_loss[batch_idx], 
-                                 np.copy(trg_sentences[batch_idx])))
-        changed = False
+      # Don't use pos % trg_len because trg_len changes
+      pos[pos >= lengths] = 0
+      keep = active & changed
+      if step % FLAGS.keep_every_n_samples == 0 and np.any(keep):
+        sentence_loss, samples = self._run_step(src_batch, trg_batch, pos,
+                                                with_scores=True)
+        tf.logging.debug("Sample step=%d len=%s score=%s" 
+                         % (step, lengths, sentence_loss))
+        for batch_idx in np.nonzero(keep)[0]:
+          res[sen_indices[batch_idx]].append(
+              (sentence_loss[batch_idx], 
+               np.copy(trg_batch[batch_idx, :lengths[batch_idx]])))
+        changed[keep] = False
       else:
-        samples = self.mon_sess.run(self._samples,
-          {self._inputs_var: src_sentences,
-           self._targets_var: trg_sentences,
-           self._pos_var: pos})
-      samples *= active
-      if any(trg_sentences[:, pos] != samples):
-        trg_sentences[:, pos] = samples
-        changed = True
-      active = active and samples != EOS_ID
-      if not any(active):
-        trg_sentences = trg_sentences[:, :pos+1]
-      elif pos == trg_sentences.shape[1] - 1: # Extend
-        trg_sentences = np.pad(trg_sentences, ((0, 0), (0, 1)), 'constant')
+        _, samples = self._run_step(src_batch, trg_batch, pos)
+      with instrumentation.timed("postprocess"):
+        for batch_idx in np.nonzero(active)[0]:
+          p = pos[batch_idx]
+          sample = samples[batch_idx]
+          if trg_batch[batch_idx, p] != sample:
+            trg_batch[batch_idx, p] = sample
+            changed[batch_idx] = True
+          if sample == EOS_ID:
+            trg_batch[batch_idx, p+1:] = PAD_ID
+            lengths[batch_idx] = p + 1
+          elif p == lengths[batch_idx] - 1: # Extend
+            lengths[batch_idx] += 1
+        max_len = np.max(lengths)
+        if max_len > trg_batch.shape[1]:
+          trg_batch = np.pad(trg_batch, ((0, 0), (0, 1)), 'constant')
+        else:
+          trg_batch = trg_batch[:, :max_len]
     return res
 
+  def _run_step(self, src_batch, trg_batch, pos, with_scores=False):
+    """Runs a single sampling step.
+
+    Returns:
+      Tuple (sentence_loss, samples). sentence_loss is None if
+      `with_scores` is false.
+    """
+    if self._bucket_vars:
+      bucket = xla_buckets.find_bucket(
+          self._buckets, src_batch.shape[0], 
+          max(src_batch.shape[1], trg_batch.shape[1]))
+      if bucket is not None:
+        return self._run_bucket_step(bucket, src_batch, trg_batch, pos,
+                                     with_scores)
+      tf.logging.debug("No XLA bucket for batch shape src=%s trg=%s" 
+                       % (src_batch.shape, trg_batch.shape))
+    feed_dict = {self._inputs_var: src_batch,
+                 self._targets_var: trg_batch,
+                 self._pos_var: pos}
+    batches = [src_batch, trg_batch]
+    if with_scores:
+      return instrumentation.run(
+          self.mon_sess, (self._sentence_loss, self._samples), feed_dict,
+          batches=batches)
+    return None, instrumentation.run(self.mon_sess, self._samples, feed_dict,
+                                     batches=batches)
+
+  def _run_bucket_step(self, bucket, src_batch, trg_batch, pos, 
+                       with_scores):
+    """Like `_run_step()` with the XLA graph of `bucket`. Padded rows
+    are removed from the results.
+    """
+    inputs_var, targets_var, pos_var, samples, sentence_loss = \
+        self._bucket_vars[bucket]
+    bsz = src_batch.shape[0]
+    src_batch = xla_buckets.pad_to_bucket(src_batch, bucket)
+    trg_batch = xla_buckets.pad_to_bucket(trg_batch, bucket)
+    feed_dict = {inputs_var: src_batch,
+                 targets_var: trg_batch,
+                 pos_var: xla_buckets.pad_rows(pos, bucket[0])}
+    batches = [src_batch, trg_batch]
+    if with_scores:
+      sentence_loss, samples = instrumentation.run(
+          self.mon_sess, (sentence_loss, samples), feed_dict, 
+          batches=batches)
+      return sentence_loss[:bsz], samples[:bsz]
+    return None, instrumentation.run(self.mon_sess, samples, feed_dict,
+                                     batches=batches)[:bsz]
+
+  def _sample_in_graph(self, src_batch, trg_batch, lengths, n_steps, pos,
+                       changed, sen_indices, res):
+    """Like the loop in `sample()` but runs FLAGS.steps_per_call steps in
+    each session call. Kept samples are appended to `res`.
+    """
+    n_iter = FLAGS.steps_per_call
+    for start_step in xrange(0, np.max(n_steps), n_iter):
+      # Chains grow by at most one token per step
+      trg_batch = np.pad(trg_batch, ((0, 0), (0, n_iter)), 'constant')
+      (trg_batch, pos, lengths, changed, kept_trg, kept_scores, 
+       kept_chains) = instrumentation.run(
+          self.mon_sess,
+          (self._loop_trg, self._loop_pos, self._loop_lengths, 
+           self._loop_changed, self._loop_kept_trg, self._loop_kept_scores,
+           self._loop_kept_chains),
+          {self._inputs_var: src_batch,
+           self._targets_var: trg_batch,
+           self._pos_var: pos,
+           self._loop_lengths_var: lengths,
+           self._loop_changed_var: changed,
+           self._loop_n_steps_var: n_steps,
+           self._loop_start_step_var: start_step},
+          batches=[src_batch, trg_batch])
+      tf.logging.debug("Sample steps=%d-%d len=%s kept=%d" 
+                       % (start_step, start_step + n_iter - 1, lengths,
+                          len(kept_scores)))
+      for chain_idx, score, sample in zip(kept_chains, kept_scores, kept_trg):
+        res[sen_indices[chain_idx]].append(
+            (score, np.trim_zeros(sample, 'b')))
+      trg_batch = trg_batch[:, :np.max(lengths)]
+
   def sanity_check(self):
     src_sentences = [[10, 11, 12, 13]]
     trg_sentences = [[20, 21, 22, 23, 24, 1]]
@@ -294,32 +557,75 @@ class GibbsSampler(object):
       trg_sentences[0][pos] = prev
 
 
+class RemoteGibbsSampler(GibbsSampler):
+  """GibbsSampler which runs the sampling steps on a t2t_server.py
+  instance. Each step is a separate request, so --steps_per_call is
+  ignored.
+  """
+
+  def __init__(self):
+    if FLAGS.steps_per_call > 1:
+      tf.logging.warn("--steps_per_call is ignored with --server")
+    if FLAGS.xla_buckets:
+      raise AttributeError("--xla_buckets is not supported with --server")
+    self._in_graph = False
+    self._client = t2t_client.ScoringClient(FLAGS.server)
+    self._model = FLAGS.server_model
+
+  def _run_step(self, src_batch, trg_batch, pos, with_scores=False):
+    with instrumentation.timed("remote_call"):
+      samples, sentence_loss = self._client.sample(
+          self._model, list(src_batch), list(trg_batch), pos,
+          FLAGS.sampling_temperature)
+    return (sentence_loss if with_scores else None), samples
+
+  def sanity_check(self):
+    raise AttributeError("--sanity_check is not supported with --server")
+
+
 def line_to_words(line, add_eos=False):
   line = line.strip()
   if not line:
     words = []
   else:
-    words = map(int, line.split())
+    words = [int(w) for w in line.split()]
   if add_eos:
     words.append(EOS_ID)
-  return np.array([words], dtype=np.int)
+  return words
+
+
+def pad_sentences(sentences):
+  """Creates a [len(sentences), max_len] array padded with PAD_ID."""
+  max_len = max(len(s) for s in sentences)
+  padded = np.full((len(sentences), max(max_len, 1)), PAD_ID, dtype=np.int)
+  for i, s in enumerate(sentences):
+    padded[i, :len(s)] = s
+  return padded
+
 
+def batched_iter(src_path, trg_path=None, batch_size=1, skip_ids=()):
+  """Reads the source sentences and initial target sentences.
 
-def batched_iter(src_path, trg_path=None, batch_size=1):
-  if batch_size > 1:
-    raise AttributeError("Batched decoding not implemented yet")
+  Yields:
+    Tuples (ids, src_sentences, trg_sentences) with up to `batch_size`
+    sentence pairs. Target sentences end with EOS.
+  """
   with open(src_path) as src_reader:
     if trg_path:
       trg_reader = open(trg_path)
     else:
-      def yield_empty():
-        yield ""
-      trg_reader = yield_empty()
+      trg_reader = itertools.repeat("")
+    batch = []
     for idx, (src_line, trg_line) in enumerate(zip(src_reader, trg_reader)):
-      if idx == 1:
-       yield (np.array([idx], dtype=np.int),
-             line_to_words(src_line), 
-             line_to_words(trg_line, add_eos=True))
+      if idx in skip_ids:
+        continue
+      batch.append((idx, line_to_words(src_line), 
+                    line_to_words(trg_line, add_eos=True)))
+      if len(batch) >= batch_size:
+        yield tuple(map(list, zip(*batch)))
+        batch = []
+    if batch:
+      yield tuple(map(list, zip(*batch)))
 
 
 def sample2str(sample):
@@ -331,48 +637,142 @@ def sample2str(sample):
 
 class TextOutputHandler(object):
 
-  def __init__(self, path):
-    self.writer = open(path, "w")
+  def __init__(self, path, n_keep=None):
+    """Creates the handler.
+
+    Args:
+      path: Path to the text file
+      n_keep: If not None, resume writing after the first `n_keep`
+              lines of an existing file
+    """
+    if n_keep is None:
+      self.writer = open(path, "w")
+    else:
+      lines = []
+      if os.path.isfile(path):
+        with open(path) as reader:
+          lines = [line for line in itertools.islice(reader, n_keep)
+                   if line.endswith("\n")]
+      self.writer = open(path, "w")
+      self.writer.write("".join(lines))
 
   def write(self, idx, samples):
     self.writer.write("%s\n" % sample2str(samples[0][1]))
+    self.writer.flush()
 
   def finish(self):
     self.writer.close()
 
 
 class NbestOutputHandler(object):
+  """Writes n-best lists sentence by sentence. Samples are collected in
+  a bounded min-heap for the current sentence. The sentence is written
+  to the file as soon as samples for a different sentence arrive, so
+  memory does not grow with the size of the test set and a crash only
+  loses the current sentence.
+  """
 
-  def __init__(self, path):
+  def __init__(self, path, nbest=0, resume=False):
+    """Creates the handler.
+
+    Args:
+      path: Path to the n-best file
+      nbest: Maximum number of entries per sentence (0: no limit)
+      resume: If true, keep all complete sentences in an existing
+              n-best file at `path` and append to it
+    """
     self.path = path
-    self.samples = {}
+    self.nbest = nbest
+    self.completed = set()
+    if resume and os.path.isfile(path):
+      self.writer = open(path, "r+")
+      self._truncate_incomplete()
+    else:
+      self.writer = open(path, "w")
+    self.cur_idx = None
+    self.heap = []
+    self.n_pushed = 0
+
+  def _truncate_incomplete(self):
+    """Reads the sentence IDs in the existing n-best file and removes
+    the last sentence since it may be incomplete.
+    """
+    last_idx = None
+    last_start = 0
+    while True:
+      pos = self.writer.tell()
+      line = self.writer.readline()
+      if not line.endswith("\n"):
+        break
+      idx = int(line.split("|||")[0].strip())
+      if idx != last_idx:
+        if last_idx is not None:
+          self.completed.add(last_idx)
+        last_idx = idx
+        last_start = pos
+    self.writer.seek(last_start)
+    self.writer.truncate()
+    tf.logging.info("Resuming %s after %d complete sentences" 
+                    % (self.path, len(self.completed)))
 
   def write(self, idx, samples):
-    if idx in self.samples:
-      self.samples[idx].extend(samples)
-      self.samples[idx].sort(reverse=True, key=operator.itemgetter(0))
-    else:
-      self.samples[idx] = samples
+    if idx != self.cur_idx:
+      self._flush()
+      self.cur_idx = idx
+    for score, sample in samples:
+      # The negated counter keeps earlier samples first among equal scores
+      entry = (score, -self.n_pushed, sample)
+      self.n_pushed += 1
+      if self.nbest > 0 and len(self.heap) >= self.nbest:
+        heapq.heappushpop(self.heap, entry)
+      else:
+        heapq.heappush(self.heap, entry)
+
+  def _flush(self):
+    if self.cur_idx is None:
+      return
+    for score, _, sample in sorted(self.heap, reverse=True, 
+                                   key=operator.itemgetter(0, 1)):
+      self.writer.write("%d ||| %s ||| logprob=%f ||| %f\n" %
+                        (self.cur_idx, sample2str(sample), score, score))
+    self.writer.flush()
+    self.completed.add(self.cur_idx)
+    self.heap = []
+    self.n_pushed = 0
 
   def finish(self):
-    with open(self.path, "w") as writer:
-      for idx in sorted(self.samples.iterkeys()):
-        for score, sample in self.samples[idx]:
-          writer.write("%d ||| %s ||| logprob=%f ||| %f\n" %
-                       (idx, sample2str(sample), score, score))
+    self._flush()
+    self.writer.close()
 
 
 def create_output_handlers():
+  """Creates the output handlers. If --resume is set, the returned set
+  contains the IDs of the sentences which are already complete in the
+  n-best file.
+
+  Returns:
+    Tuple (list of handlers, set of completed sentence IDs)
+  """
   handlers = []
-  for handler_name in FLAGS.outputs.split(","):
+  completed = set()
+  handler_names = FLAGS.outputs.split(",")
+  # Create the n-best handler first to find out where to resume
+  if "nbest" in handler_names:
+    nbest_handler = NbestOutputHandler(FLAGS.output_path % "nbest", 
+                                       FLAGS.nbest, FLAGS.resume)
+    completed = set(nbest_handler.completed)
+  elif FLAGS.resume:
+    raise AttributeError("--resume requires the nbest output handler")
+  for handler_name in handler_names:
     path = FLAGS.output_path % handler_name
     if handler_name == "text":
-      handlers.append(TextOutputHandler(path))
+      handlers.append(TextOutputHandler(
+          path, len(completed) if FLAGS.resume else None))
     elif handler_name == "nbest":
-      handlers.append(NbestOutputHandler(path))
+      handlers.append(nbest_handler)
     else:
       raise AttributeError("Unknown output handler")
-  return handlers
+  return handlers, completed
 
 
 def main(_):
@@ -380,21 +780,26 @@ def main(_):
   if FLAGS.verbose:
     tf.logging.set_verbosity(tf.logging.DEBUG)
   usr_dir.import_usr_dir(FLAGS.t2t_usr_dir)
-  sampler = GibbsSampler()
+  instrumentation.configure(FLAGS.profile_output, FLAGS.trace_every_n,
+                            FLAGS.trace_dir)
+  sampler = RemoteGibbsSampler() if FLAGS.server else GibbsSampler()
   if FLAGS.sanity_check:
     sampler.sanity_check()
     return
-  output_handlers = create_output_handlers()
-  for ids, src_sentences, trg_sentences in batched_iter(
-      FLAGS.src_test, FLAGS.trg_test, FLAGS.batch_size):
+  output_handlers, completed = create_output_handlers()
+  for ids, src_sentences, trg_sentences in instrumentation.timed_iter(
+      batched_iter(FLAGS.src_test, FLAGS.trg_test, FLAGS.batch_size, 
+                   completed), "preprocess"):
     res = sampler.sample(src_sentences, trg_sentences)
-    for idx, samples in zip(ids, res):
-      samples.sort(reverse=True, key=operator.itemgetter(0))
-      for ohandler in output_handlers:
-        ohandler.write(idx, samples)
-    break
+    with instrumentation.timed("postprocess"):
+      for idx, samples in zip(ids, res):
+        samples.sort(reverse=True, key=operator.itemgetter(0))
+        for ohandler in output_handlers:
+          ohandler.write(idx, samples)
+    tf.logging.info("Processed %d sentences" % (ids[-1] + 1))
   for ohandler in output_handlers:
     ohandler.finish()
+  instrumentation.finish()
 
 
 if __name__ == "__main__":
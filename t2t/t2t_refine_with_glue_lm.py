@@ -2,7 +2,9 @@
 """
 
 import logging
+import multiprocessing
 import os
+import time
 
 # Requires tensor2tensor
 from tensor2tensor import models  # pylint: disable=unused-import
@@ -20,7 +22,13 @@ from tensorflow.python.training import training
 import numpy as np
 
 import argparse
-from collections import defaultdict
+from collections import OrderedDict
+
+import instrumentation
+import nbest_index
+import pipeline
+import t2t_client
+import t2t_freeze_graph
 
 EOS_ID = 1
 BOS_ID = 2
@@ -126,6 +134,7 @@ class Tensor2TensorAdaptor(object):
                  trg_vocab_size,
                  single_cpu_thread=False):
         tf.logging.info("Initializing model at %s" % checkpoint_dir)
+        start_time = time.time()
         self._single_cpu_thread = single_cpu_thread
         self._checkpoint_dir = checkpoint_dir
         self.trg_vocab_size = trg_vocab_size
@@ -142,25 +151,42 @@ class Tensor2TensorAdaptor(object):
             translate_model = registry.model(model_name)(
                 hparams, tf.estimator.ModeKeys.EVAL)
 
-            self._targets_var = tf.placeholder(dtype=tf.int32, shape=[None], 
+            # Batch of glued documents, padded with zeros (segment 0)
+            self._targets_var = tf.placeholder(dtype=tf.int32,
+                                               shape=[None, None],
                                                name="sgnmt_targets")
-            self._targets_seg_var = tf.placeholder(dtype=tf.int32, shape=[None], 
+            self._targets_seg_var = tf.placeholder(dtype=tf.int32,
+                                                   shape=[None, None],
                                                    name="sgnmt_targets_seg")
-            self._targets_pos_var = tf.placeholder(dtype=tf.int32, shape=[None],
+            self._targets_pos_var = tf.placeholder(dtype=tf.int32,
+                                                   shape=[None, None],
                                                    name="sgnmt_targets_pos")
             features = {
-                "targets": expand_input_dims_for_t2t(self._targets_var),
-                "targets_seg": tf.expand_dims(self._targets_seg_var, 0),
-                "targets_pos": tf.expand_dims(self._targets_pos_var, 0)
+                "targets": expand_input_dims_for_t2t(self._targets_var,
+                                                     batched=True),
+                "targets_seg": self._targets_seg_var,
+                "targets_pos": self._targets_pos_var
             }
 
             translate_model.prepare_features_for_infer(features)
             translate_model._fill_problem_hparams_features(features)
             logits, _ = translate_model(features)
-            logits = tf.squeeze(logits, [0, 2, 3])
+            logits = tf.squeeze(logits, [2, 3])
             log_probs = log_prob_from_logits(logits)
-            self._log_prob = tf.reduce_sum(gather_2d(log_probs, tf.expand_dims(self._targets_var, 1)))
+            flat_targets = tf.reshape(self._targets_var, [-1, 1])
+            flat_log_probs = tf.reshape(
+                log_probs, [tf.shape(flat_targets)[0], -1])
+            self._token_log_probs = tf.reshape(
+                gather_2d(flat_log_probs, flat_targets),
+                tf.shape(self._targets_var))
+            self.n_calls = 0
+            self.n_scored_tokens = 0
+            restore_start_time = time.time()
             self.mon_sess = self.create_session()
+        instrumentation.record("graph_build", restore_start_time - start_time)
+        instrumentation.record("restore", time.time() - restore_start_time)
+        tf.logging.info("Graph building and checkpoint restore took %.2fs"
+                        % (time.time() - start_time))
 
     def _add_problem_hparams(self, hparams, problem_name):
         problem = registry.problem(problem_name)
@@ -216,12 +242,41 @@ class Tensor2TensorAdaptor(object):
                 
     def get_log_prob(self, trg_sentence):
         """Call the T2T model in self.mon_sess."""
-        trg_seg, trg_pos = self._gen_seg_and_pos(trg_sentence)
-        log_prob = self.mon_sess.run(self._log_prob,
-            {self._targets_var: trg_sentence,
-             self._targets_seg_var: trg_seg,
-             self._targets_pos_var: trg_pos})
-        return log_prob
+        return float(np.sum(self.get_token_log_probs(trg_sentence)))
+
+    def get_token_log_probs(self, trg_sentence):
+        """Like get_log_prob() but returns the log-probability of each
+        token in `trg_sentence` as array.
+        """
+        return self.get_token_log_probs_batch([trg_sentence])[0]
+
+    def get_token_log_probs_batch(self, trg_sentences):
+        """Scores a batch of glued documents in a single session call.
+
+        Returns:
+          List of arrays with token log-probabilities, one for each
+          document in `trg_sentences`.
+        """
+        with instrumentation.timed("preprocess"):
+            max_len = max(len(s) for s in trg_sentences)
+            targets = np.zeros((len(trg_sentences), max_len), dtype=np.int32)
+            targets_seg = np.zeros_like(targets)
+            targets_pos = np.zeros_like(targets)
+            for i, trg_sentence in enumerate(trg_sentences):
+                trg_seg, trg_pos = self._gen_seg_and_pos(trg_sentence)
+                l = len(trg_sentence)
+                targets[i, :l] = trg_sentence
+                targets_seg[i, :l] = trg_seg
+                targets_pos[i, :l] = trg_pos
+        self.n_calls += 1
+        self.n_scored_tokens += sum(len(s) for s in trg_sentences)
+        token_log_probs = instrumentation.run(
+            self.mon_sess, self._token_log_probs,
+            {self._targets_var: targets,
+             self._targets_seg_var: targets_seg,
+             self._targets_pos_var: targets_pos},
+            batches=[targets])
+        return [lp[:len(s)] for lp, s in zip(token_log_probs, trg_sentences)]
 
     def _gen_seg_and_pos(self, glued):
         seg = []
@@ -238,6 +293,48 @@ class Tensor2TensorAdaptor(object):
                 cur_pos += 1
         return seg, pos
 
+class FrozenTensor2TensorAdaptor(Tensor2TensorAdaptor):
+    """Adaptor for a glue LM exported with t2t_freeze_graph.py --glue_lm."""
+
+    def __init__(self, frozen_graph):
+        tf.logging.info("Loading frozen graph %s" % frozen_graph)
+        start_time = time.time()
+        graph, self.mon_sess = t2t_freeze_graph.load_frozen_graph(
+            frozen_graph)
+        tensor = lambda name: graph.get_tensor_by_name("%s:0" % name)
+        self._targets_var = tensor(t2t_freeze_graph.TARGETS)
+        self._targets_seg_var = tensor(t2t_freeze_graph.TARGETS_SEG)
+        self._targets_pos_var = tensor(t2t_freeze_graph.TARGETS_POS)
+        self._token_log_probs = tensor(t2t_freeze_graph.WORD_LOG_PROBS)
+        self.n_calls = 0
+        self.n_scored_tokens = 0
+        instrumentation.record("graph_load", time.time() - start_time)
+        tf.logging.info("Loading the frozen graph took %.2fs"
+                        % (time.time() - start_time))
+
+
+class RemoteAdaptor(object):
+    """Adaptor for a glue LM on a t2t_server.py instance."""
+
+    def __init__(self, socket_path, model_name):
+        self._client = t2t_client.ScoringClient(socket_path)
+        self._model_name = model_name
+        self.n_calls = 0
+        self.n_scored_tokens = 0
+
+    def get_log_prob(self, trg_sentence):
+        return float(np.sum(self.get_token_log_probs(trg_sentence)))
+
+    def get_token_log_probs(self, trg_sentence):
+        return self.get_token_log_probs_batch([trg_sentence])[0]
+
+    def get_token_log_probs_batch(self, trg_sentences):
+        self.n_calls += 1
+        self.n_scored_tokens += sum(len(s) for s in trg_sentences)
+        with instrumentation.timed("remote_call"):
+            return self._client.score(self._model_name, None, trg_sentences)
+
+
 class Hypo(object):
 
   def __init__(self, glued, nbest_score, t2t_score):
@@ -251,14 +348,19 @@ class Hypo(object):
     return " ".join(map(str, self.glued))
 
 
-def get_hypo(ranks, doc_nbest, adaptor, skip_scoring=False):
+def glue(ranks, doc_nbest):
+  """Returns the glued document and the summed n-best score."""
   glued = []
   nbest_score = 0.0
   for rank, nbest in zip(ranks, doc_nbest):
     glued.append(BOS_ID)
     glued.extend(nbest[rank][1])
     nbest_score += nbest[rank][0]
-  glued = glued[1:]
+  return glued[1:], nbest_score
+
+
+def get_hypo(ranks, doc_nbest, adaptor, skip_scoring=False):
+  glued, nbest_score = glue(ranks, doc_nbest)
   if skip_scoring:
     tf.logging.info("Skipping scoring...")
     t2t_score = 0.0
@@ -267,14 +369,457 @@ def get_hypo(ranks, doc_nbest, adaptor, skip_scoring=False):
   return Hypo(glued, nbest_score, t2t_score)
 
 
+class IncrementalScorer(object):
+  """Scores rank changes at a single sentence position without rescoring
+  the whole document.
+
+  The scorer keeps the token log-probabilities of the current document,
+  split by sentence (each sentence owns its tokens and the following
+  BOS). Since the LM is causal, tokens before a changed sentence keep
+  their scores. Only the changed sentence and the next `right_context`
+  sentences are rescored, and the (truncated) document is not fed to
+  the model beyond that window. Later sentences keep their cached
+  scores, so the T2T score is exact for `right_context` >= the number
+  of following sentences, and an approximation otherwise. The document
+  score is always the sum of the cached sentence scores.
+  """
+
+  def __init__(self, adaptor, doc_nbest, right_context, max_tokens=8192):
+    self._adaptor = adaptor
+    self._doc_nbest = doc_nbest
+    self._right_context = right_context
+    self._max_tokens = max_tokens
+    self._ranks = None
+    self._sen_scores = None
+    self._pending = None
+
+  def _sentence_lengths(self, ranks):
+    """Number of tokens owned by each sentence (including the BOS)."""
+    n = len(ranks)
+    return [len(self._doc_nbest[i][rank][1]) + (1 if i < n - 1 else 0)
+            for i, rank in enumerate(ranks)]
+
+  def _split(self, token_log_probs, lengths):
+    sen_scores = []
+    start = 0
+    for l in lengths:
+      sen_scores.append(float(np.sum(token_log_probs[start:start+l])))
+      start += l
+    return sen_scores
+
+  def init(self, ranks, skip_scoring=False):
+    """Scores the full document and makes `ranks` the current state.
+
+    Returns:
+      Hypo for `ranks`
+    """
+    glued, nbest_score = glue(ranks, self._doc_nbest)
+    self._ranks = list(ranks)
+    if skip_scoring:
+      tf.logging.info("Skipping scoring...")
+      self._sen_scores = [0.0] * len(ranks)
+    else:
+      self._sen_scores = self._split(
+          self._adaptor.get_token_log_probs(glued),
+          self._sentence_lengths(ranks))
+    self._pending = None
+    return Hypo(glued, nbest_score, sum(self._sen_scores))
+
+  def window_end(self, pos):
+    """Index of the first sentence after the window of `pos`."""
+    return min(len(self._ranks), pos + self._right_context + 1)
+
+  def score_windows(self, candidates):
+    """Scores the windows of multiple candidates in padded batches of at
+    most `max_tokens` tokens.
+
+    Args:
+      candidates: List of (ranks, pos) tuples. `ranks` must differ from
+                  the current state only at `pos`
+
+    Returns:
+      List with the sentence scores in the window of each candidate.
+    """
+    truncated = []
+    for ranks, pos in candidates:
+      glued, _ = glue(ranks, self._doc_nbest)
+      lengths = self._sentence_lengths(ranks)
+      end = self.window_end(pos)
+      truncated.append((glued[:sum(lengths[:end])],
+                        sum(lengths[:pos]),
+                        lengths[pos:end]))
+    # Sort by length to reduce padding
+    order = sorted(range(len(truncated)), key=lambda i: len(truncated[i][0]))
+    all_window_scores = [None] * len(truncated)
+    batch = []
+    for i in order + [None]:
+      if batch and (i is None 
+          or (len(batch) + 1) * len(truncated[i][0]) > self._max_tokens):
+        token_log_probs = self._adaptor.get_token_log_probs_batch(
+            [truncated[j][0] for j in batch])
+        for j, lp in zip(batch, token_log_probs):
+          _, window_start, window_lengths = truncated[j]
+          all_window_scores[j] = self._split(lp[window_start:],
+                                             window_lengths)
+        batch = []
+      if i is not None:
+        batch.append(i)
+    return all_window_scores
+
+  def make_hypo(self, ranks, pos, window_scores):
+    """Combines window scores with the cached scores of the current state.
+
+    Returns:
+      Tuple (hypo, sen_scores)
+    """
+    glued, nbest_score = glue(ranks, self._doc_nbest)
+    sen_scores = self._sen_scores[:pos] + window_scores \
+                 + self._sen_scores[pos+len(window_scores):]
+    return Hypo(glued, nbest_score, sum(sen_scores)), sen_scores
+
+  def get_hypo(self, ranks, pos):
+    """Scores `ranks` which differ from the current state only at `pos`.
+    Call `accept()` to make `ranks` the current state.
+    """
+    window_scores = self.score_windows([(ranks, pos)])[0]
+    hypo, sen_scores = self.make_hypo(ranks, pos, window_scores)
+    self._pending = (list(ranks), sen_scores)
+    return hypo
+
+  def accept(self):
+    """Makes the ranks of the last `get_hypo()` call the current state."""
+    self.set_state(*self._pending)
+
+  def set_state(self, ranks, sen_scores):
+    self._ranks = list(ranks)
+    self._sen_scores = sen_scores
+    self._pending = None
+
+
+def best_improvement_search(scorer, ranks, best_score, ops):
+  """Batched best-improvement hill climbing. All rank changes in `ops`
+  are scored against the current state in large batches, and the best
+  improving change is accepted. After each accepted change at position
+  q, only candidates whose windows overlap the changed tokens (i.e. at
+  positions p with p >= q or q < scorer.window_end(p)) are rescored.
+
+  Args:
+    scorer: IncrementalScorer initialized with `ranks`
+    ranks: Current rank vector (updated in place)
+    best_score: Total score of `ranks`
+    ops: List of (gap, pos, rank) tuples with candidate rank changes
+
+  Returns:
+    List of all scored hypotheses.
+  """
+  candidates = [(pos, rank) for _, pos, rank in ops]
+  window_scores = {}
+  hypos = []
+  while True:
+    to_score = [c for c in candidates 
+                if c not in window_scores and ranks[c[0]] != c[1]]
+    new_ranks = []
+    for pos, rank in to_score:
+      new_ranks.append(list(ranks))
+      new_ranks[-1][pos] = rank
+    for c, r, w in zip(to_score, new_ranks, scorer.score_windows(
+          [(r, c[0]) for r, c in zip(new_ranks, to_score)])):
+      window_scores[c] = w
+      hypos.append(scorer.make_hypo(r, c[0], w)[0])
+    best = None
+    for pos, rank in candidates:
+      if ranks[pos] == rank:
+        continue
+      candidate_ranks = list(ranks)
+      candidate_ranks[pos] = rank
+      hypo, sen_scores = scorer.make_hypo(
+          candidate_ranks, pos, window_scores[(pos, rank)])
+      if hypo.total_score() > best_score:
+        best_score = hypo.total_score()
+        best = (pos, rank, hypo, sen_scores)
+    if best is None:
+      return hypos
+    pos, rank, hypo, sen_scores = best
+    tf.logging.info("%d -> %d at pos %d" % (ranks[pos], rank, pos))
+    tf.logging.info("New best: %f %s" % (best_score, hypo.scores))
+    ranks[pos] = rank
+    scorer.set_state(ranks, sen_scores)
+    for c in list(window_scores):
+      if c[0] >= pos or pos < scorer.window_end(c[0]):
+        del window_scores[c]
+
+
+class LRUCache(object):
+  """Dictionary with a maximum size which evicts the least recently used
+  entries first.
+  """
+
+  def __init__(self, max_size):
+    self.max_size = max_size
+    self.hits = 0
+    self.misses = 0
+    self._data = OrderedDict()
+
+  def get(self, key):
+    value = self._data.pop(key, None)
+    if value is None:
+      self.misses += 1
+      return None
+    self.hits += 1
+    self._data[key] = value
+    return value
+
+  def put(self, key, value):
+    self._data.pop(key, None)
+    self._data[key] = value
+    if len(self._data) > self.max_size:
+      self._data.popitem(last=False)
+
+
+def score_rank_vectors(adaptor, doc_nbest, rank_vectors, max_tokens):
+  """Scores full documents in padded batches of at most `max_tokens`
+  tokens.
+
+  Returns:
+    List of Hypo instances, one for each rank vector.
+  """
+  glued = [glue(ranks, doc_nbest) for ranks in rank_vectors]
+  order = sorted(range(len(glued)), key=lambda i: len(glued[i][0]))
+  hypos = [None] * len(glued)
+  batch = []
+  for i in order + [None]:
+    if batch and (i is None 
+        or (len(batch) + 1) * len(glued[i][0]) > max_tokens):
+      token_log_probs = adaptor.get_token_log_probs_batch(
+          [glued[j][0] for j in batch])
+      for j, lp in zip(batch, token_log_probs):
+        hypos[j] = Hypo(glued[j][0], glued[j][1], float(np.sum(lp)))
+      batch = []
+    if i is not None:
+      batch.append(i)
+  return hypos
+
+
+def beam_search(adaptor, doc_nbest, base_hypo, ops, beam_width, memo,
+                max_tokens, max_expansions):
+  """Beam search over rank vectors. In each iteration, every rank vector
+  in the beam is expanded by all rank changes in `ops`, and the best
+  `beam_width` rank vectors are kept. The search stops when the beam
+  does not change or `max_expansions` rank vectors have been scored.
+  Scores are memoized in `memo`, keyed by the rank tuple.
+
+  Expansions are pruned with an admissible upper bound on their total
+  score: the T2T log-probability is at most 0, so an expansion scores
+  at most its exact weighted n-best score and word count. Expansions
+  which are scored are taken in order of this bound.
+
+  Args:
+    base_hypo: Hypo for the all-zero rank vector
+    ops: List of (gap, pos, rank) tuples with candidate rank changes
+    memo: LRUCache
+    max_expansions: Maximum number of rank vectors to score, or a
+                    negative value for no limit
+
+  Returns:
+    Tuple (ranks, hypos) with the best rank vector and all scored
+    hypotheses.
+  """
+  n_weight, wc_weight = model_weights[1], model_weights[2]
+  # Upper bound of the weighted T2T score
+  max_t2t_score = 0.0 if model_weights[0] >= 0.0 else np.inf
+  changes = [(pos, rank) for _, pos, rank in ops]
+  ranks = tuple([0] * len(doc_nbest))
+  memo.put(ranks, base_hypo)
+  beam = [(base_hypo.total_score(), ranks, base_hypo)]
+  hypos = []
+  n_pruned = 0
+  budget_exhausted = False
+  while True:
+    threshold = beam[-1][0] if len(beam) >= beam_width else -np.inf
+    expansions = {}
+    bounds = {}
+    for _, ranks, hypo in beam:
+      nbest_score, length = hypo.scores[1], hypo.scores[2]
+      for pos, rank in changes:
+        if ranks[pos] == rank:
+          continue
+        new_ranks = ranks[:pos] + (rank,) + ranks[pos+1:]
+        if new_ranks in expansions:
+          continue
+        old_entry = doc_nbest[pos][ranks[pos]]
+        new_entry = doc_nbest[pos][rank]
+        bound = max_t2t_score \
+            + n_weight * (nbest_score + new_entry[0] - old_entry[0]) \
+            + wc_weight * (length + len(new_entry[1]) - len(old_entry[1]))
+        if bound <= threshold:
+          n_pruned += 1
+          continue
+        expansions[new_ranks] = memo.get(new_ranks)
+        bounds[new_ranks] = bound
+    to_score = sorted([r for r, hypo in expansions.iteritems() if hypo is None],
+                      key=lambda r: (-bounds[r], r))
+    if max_expansions >= 0 and len(hypos) + len(to_score) > max_expansions:
+      budget_exhausted = True
+      for r in to_score[max(0, max_expansions - len(hypos)):]:
+        del expansions[r]
+      to_score = to_score[:max(0, max_expansions - len(hypos))]
+    for r, hypo in zip(to_score, score_rank_vectors(
+          adaptor, doc_nbest, to_score, max_tokens)):
+      memo.put(r, hypo)
+      expansions[r] = hypo
+      hypos.append(hypo)
+    candidates = dict((r, h) for _, r, h in beam)
+    candidates.update(expansions)
+    new_beam = sorted([(h.total_score(), r, h) 
+                       for r, h in candidates.iteritems()],
+                      key=lambda x: (-x[0], x[1]))[:beam_width]
+    if [r for _, r, _ in new_beam] == [r for _, r, _ in beam]:
+      break
+    beam = new_beam
+    tf.logging.info("New beam: best=%f worst=%f" % (beam[0][0], beam[-1][0]))
+    if budget_exhausted:
+      break
+  tf.logging.info("Beam search: scored=%d max_expansions=%d greedy_ops=%d "
+                  "memo_hits=%d memo_misses=%d pruned=%d" % (
+                      len(hypos), max_expansions, len(ops), memo.hits,
+                      memo.misses, n_pruned))
+  return list(beam[0][1]), hypos
+
+
+def refine_document(adaptor, trg_nbest, args, doc_idx, trg_sen_idx, n_sentences,
+                    doc_nbest=None):
+  """Searches for the best combination of n-best entries for a document.
+  `doc_nbest` contains the n-best lists of the document sentences if
+  they have already been read from `trg_nbest`.
+
+  Returns:
+    List of the best hypotheses, sorted by total score.
+  """
+  start_time = time.time()
+  start_n_calls = adaptor.n_calls
+  start_n_tokens = adaptor.n_scored_tokens
+  current_ranks = [0] * n_sentences
+  if doc_nbest is None:
+    doc_nbest = read_doc_nbest(trg_nbest, trg_sen_idx, n_sentences)
+  if args.delta_context >= 0 or args.search == "best_improvement":
+    right_context = args.delta_context if args.delta_context >= 0 else n_sentences
+    scorer = IncrementalScorer(adaptor, doc_nbest, right_context,
+                               max_tokens=args.max_tokens_per_batch)
+    base_hypo = scorer.init(current_ranks, skip_scoring=n_sentences > args.max_sen)
+  else:
+    scorer = None
+    base_hypo = get_hypo(current_ranks, doc_nbest, adaptor, skip_scoring=n_sentences > args.max_sen)
+  best_score = base_hypo.total_score()
+  ops = []
+  hypos = [base_hypo]
+  tf.logging.info("Document id=%d n_sentences=%d base_score=%f %s" % (doc_idx+1, n_sentences, best_score, base_hypo.scores))
+  if n_sentences >= args.min_sen and n_sentences <= args.max_sen:
+    for i, nbest_single in enumerate(doc_nbest):
+      first_best_score = nbest_single[0][0]
+      for j in xrange(1, len(nbest_single)):
+        ops.append((first_best_score - nbest_single[j][0], i, j))
+    ops.sort()
+  if args.search == "best_improvement":
+    ops = [op for op in ops if op[0] <= args.prune_threshold]
+    hypos.extend(best_improvement_search(scorer, current_ranks, best_score, ops))
+    ops = []
+  elif args.search == "beam":
+    ops = [op for op in ops if op[0] <= args.prune_threshold]
+    current_ranks, beam_hypos = beam_search(
+        adaptor, doc_nbest, base_hypo, ops, args.beam_width,
+        LRUCache(args.memo_size), args.max_tokens_per_batch,
+        len(ops) if args.max_expansions == 0 else args.max_expansions)
+    hypos.extend(beam_hypos)
+    ops = []
+  for op in ops:
+    if op[0] > args.prune_threshold:
+      break
+    pos, new_rank = op[1:]
+    old_rank = current_ranks[pos]
+    tf.logging.info("%d -> %d at pos %d (%f)" % (old_rank, new_rank, pos, op[0]))
+    current_ranks[pos] = new_rank
+    if scorer:
+      hypo = scorer.get_hypo(current_ranks, pos)
+    else:
+      hypo = get_hypo(current_ranks, doc_nbest, adaptor)
+    hypos.append(hypo)
+    if hypo.total_score() > best_score:
+      best_score = hypo.total_score()
+      if scorer:
+        scorer.accept()
+      tf.logging.info("New best: %f %s" % (best_score, hypo.scores))
+    else:
+      current_ranks[pos] = old_rank
+  hypos.sort(key=lambda h: -h.total_score())
+  tf.logging.info("Decoded (ID: %d): %s" % (doc_idx+1, hypos[0].str_glued()))
+  tf.logging.info("Stats (ID: %d): score=%f num_expansions=%d" % (doc_idx+1, hypos[0].total_score(), len(hypos)))
+  tf.logging.info("Timing (ID: %d): time=%.3fs session_calls=%d scored_tokens=%d" % (
+      doc_idx+1, time.time() - start_time, adaptor.n_calls - start_n_calls,
+      adaptor.n_scored_tokens - start_n_tokens))
+  instrumentation.record("refine_document", time.time() - start_time,
+                         n_sentences=n_sentences,
+                         session_calls=adaptor.n_calls - start_n_calls)
+  return hypos[:max(1, args.nbest)]
+
+
+# State of a worker process in --num_workers mode
+_worker_adaptor = None
+_worker_trg_nbest = None
+_worker_args = None
+
+
+def _init_worker(args):
+  """Creates the TF session in a worker process."""
+  global _worker_adaptor, _worker_trg_nbest, _worker_args
+  _worker_args = args
+  _initialize_t2t(args.t2t_usr_dir)
+  _worker_adaptor = create_adaptor(args)
+  _worker_trg_nbest = nbest_index.load_or_build(args.trg_nbest,
+                                                args.nbest_index)
+
+
+def _refine_document_in_worker(doc):
+  return doc[0], refine_document(_worker_adaptor, _worker_trg_nbest,
+                                 _worker_args, *doc)
+
+
+def read_doc_nbest(trg_nbest, trg_sen_idx, n_sentences):
+  return [trg_nbest.get(idx) for idx in xrange(trg_sen_idx, trg_sen_idx+n_sentences)]
+
+
+def create_adaptor(args):
+  if args.server:
+    return RemoteAdaptor(args.server, args.server_model)
+  if args.frozen_graph:
+    return FrozenTensor2TensorAdaptor(args.frozen_graph)
+  return Tensor2TensorAdaptor(args.t2t_model,
+                              args.t2t_problem,
+                              args.t2t_hparams_set,
+                              args.t2t_checkpoint,
+                              args.trg_vocab_size)
+
+
+def document_iter(src_glued, from_doc_idx, to_doc_idx):
+  """Yields (doc_idx, trg_sen_idx, n_sentences) for each document in
+  the range.
+  """
+  trg_sen_idx = 0
+  with open(src_glued) as src_reader:
+    for doc_idx, glued_line in enumerate(src_reader):
+      n_sentences = glued_line.strip().split().count(str(BOS_ID)) + 1
+      if doc_idx >= from_doc_idx and doc_idx <= to_doc_idx:
+        yield doc_idx, trg_sen_idx, n_sentences
+      trg_sen_idx += n_sentences
+
+
 def main():
   global model_weights
   parser = argparse.ArgumentParser(description='Refines sentences with a document-level LM')
-  parser.add_argument('-tm', '--t2t_model', help='T2T models', required=True)
-  parser.add_argument('-tp', '--t2t_problem', help='T2T problems', required=True)
-  parser.add_argument('-th', '--t2t_hparams_set', help='T2T hparams set', required=True)
-  parser.add_argument('-tc', '--t2t_checkpoint', help='Path to T2T checkpoint.', required=True)
-  parser.add_argument('-tu', '--t2t_usr_dir', help='usr directory', required=True)
+  parser.add_argument('-tm', '--t2t_model', help='T2T models', required=False, default="")
+  parser.add_argument('-tp', '--t2t_problem', help='T2T problems', required=False, default="")
+  parser.add_argument('-th', '--t2t_hparams_set', help='T2T hparams set', required=False, default="")
+  parser.add_argument('-tc', '--t2t_checkpoint', help='Path to T2T checkpoint.', required=False, default="")
+  parser.add_argument('-tu', '--t2t_usr_dir', help='usr directory', required=False, default="")
   parser.add_argument('-tv', '--trg_vocab_size', help='Target vocabulary size', required=True, type=int)
   parser.add_argument('-src', '--src_glued', help='Source documents (Glued)', required=True)
   parser.add_argument('-trg', '--trg_nbest', help='Target nbest list of sentences', required=True)
@@ -285,76 +830,76 @@ def main():
   parser.add_argument('-pt', '--prune_threshold', help='Lower values lead to more pruning', required=False, default=1.5, type=float)
   parser.add_argument('-n', '--nbest', help='Number of entries in output nbest list', required=False, default=10, type=int)
   parser.add_argument('-min', '--min_sen', help='If document has less than this sentences, skip', required=False, default=3, type=int)
+  parser.add_argument('-dc', '--delta_context', help='If non-negative, rescore only the changed sentence and this many following sentences after a rank change, and reuse cached scores for the rest of the document. Negative: rescore the full document', required=False, default=-1, type=int)
+  parser.add_argument('-s', '--search', help='greedy: accept the first improving rank change in order of n-best score gap. best_improvement: score all candidate rank changes in batches and accept the best one. beam: beam search over rank vectors with memoized scores', required=False, default="greedy", choices=["greedy", "best_improvement", "beam"])
+  parser.add_argument('-bw', '--beam_width', help='Beam width for --search beam', required=False, default=4, type=int)
+  parser.add_argument('-ms', '--memo_size', help='Maximum number of memoized rank vector scores per document for --search beam', required=False, default=100000, type=int)
+  parser.add_argument('-me', '--max_expansions', help='Maximum number of scored rank vectors per document for --search beam. 0: the number of rank changes tried by the greedy search, negative: no limit', required=False, default=0, type=int)
+  parser.add_argument('-bt', '--max_tokens_per_batch', help='Maximum number of (padded) tokens per batch', required=False, default=8192, type=int)
   parser.add_argument('-max', '--max_sen', help='If document has less than this sentences, skip', required=False, default=200, type=int)
+  parser.add_argument('-ni', '--nbest_index', help='Directory of the n-best index (see nbest_index.py). Built if it does not exist or is outdated. Defaults to <trg_nbest>.idx', required=False, default="")
+  parser.add_argument('-nw', '--num_workers', help='Number of worker processes, each with its own TF session', required=False, default=1, type=int)
+  parser.add_argument('--server', help='Path to the Unix socket of a t2t_server.py instance. If set, the glue LM on the server is used instead of a local TF session', required=False, default="")
+  parser.add_argument('--server_model', help='Name of the glue LM on the server (with --server)', required=False, default="")
+  parser.add_argument('--queue_size', help='Maximum number of documents in the queues of the reader and writer threads (0: read, refine, and write in the main thread)', required=False, default=16, type=int)
+  parser.add_argument('--profile_output', help='If set, write the wall time of each session call, graph building, checkpoint restore, and pre- and post-processing step to this JSON-lines file', required=False, default="")
+  parser.add_argument('--trace_every_n', help='If positive, write a TF step trace for every n-th session call to --trace_dir', required=False, default=0, type=int)
+  parser.add_argument('--trace_dir', help='Output directory for --trace_every_n', required=False, default="traces")
+  parser.add_argument('--frozen_graph', help='Glue LM exported with t2t_freeze_graph.py --glue_lm, used instead of -tm, -tp, -th, and -tc', required=False, default="")
   args = parser.parse_args()
+  if args.server:
+    if not args.server_model:
+      parser.error("--server requires --server_model")
+  elif not args.frozen_graph and not (
+      args.t2t_model and args.t2t_problem and args.t2t_hparams_set
+      and args.t2t_checkpoint and args.t2t_usr_dir):
+    parser.error("-tm, -tp, -th, -tc, and -tu are required without "
+                 "--server or --frozen_graph")
 
   model_weights = map(float, args.weights.split(","))
 
-  _initialize_t2t(args.t2t_usr_dir)
-  adaptor = Tensor2TensorAdaptor(args.t2t_model,
-                                 args.t2t_problem,
-                                 args.t2t_hparams_set,
-                                 args.t2t_checkpoint,
-                                 args.trg_vocab_size)
   if not args.range:
     from_doc_idx = -1
     to_doc_idx = 1000000
   else:
     from_doc_idx, to_doc_idx = map(lambda x: int(x) - 1, args.range.split(":"))
-  tf.logging.info("Loading nbest file...")
-  trg_nbest = defaultdict(lambda: [])
-  with open(args.trg_nbest) as trg_reader:
-    for line in trg_reader:
-      parts = line.split("|")
-      idx = int(parts[0].strip())
-      trg_nbest[idx].append((float(parts[-1].strip()), map(int, parts[3].strip().split())))
+  instrumentation.configure(args.profile_output, args.trace_every_n,
+                            args.trace_dir)
+  tf.logging.info("Loading nbest index...")
+  with instrumentation.timed("load_nbest_index"):
+    trg_nbest = nbest_index.load_or_build(args.trg_nbest, args.nbest_index)
+  docs = document_iter(args.src_glued, from_doc_idx, to_doc_idx)
+  if args.num_workers > 1:
+    # TF sessions must not be created before forking the workers.
+    # imap() returns the results in document order.
+    pool = multiprocessing.Pool(args.num_workers, _init_worker, (args,))
+    inputs = pool.imap(_refine_document_in_worker, docs)
+    process_fn = None
+  else:
+    _initialize_t2t(args.t2t_usr_dir)
+    adaptor = create_adaptor(args)
+    # The n-best lists are read in the reader thread
+    inputs = ((doc, read_doc_nbest(trg_nbest, *doc[1:])) for doc in docs)
+    def process_fn(item):
+      doc, doc_nbest = item
+      return doc[0], refine_document(adaptor, trg_nbest, args, *doc,
+                                     doc_nbest=doc_nbest)
   with open(args.output_path % "text", "w") as plain_writer:
     with open(args.output_path % "nbest", "w") as nbest_writer:
-      trg_sen_idx = 0
-      with open(args.src_glued) as src_reader:
-        for doc_idx, glued_line in enumerate(src_reader):
-          n_sentences = glued_line.strip().split().count(str(BOS_ID)) + 1
-          if doc_idx >= from_doc_idx and doc_idx <= to_doc_idx:
-            current_ranks = [0] * n_sentences
-            doc_nbest = [trg_nbest[idx] for idx in xrange(trg_sen_idx, trg_sen_idx+n_sentences)]
-            base_hypo = get_hypo(current_ranks, doc_nbest, adaptor, skip_scoring=n_sentences > args.max_sen)
-            best_score = base_hypo.total_score()
-            ops = []
-            hypos = [base_hypo]
-            tf.logging.info("Document id=%d n_sentences=%d base_score=%f %s" % (doc_idx+1, n_sentences, best_score, base_hypo.scores))
-            if n_sentences >= args.min_sen and n_sentences <= args.max_sen:
-              for i, nbest_single in enumerate(doc_nbest):
-                first_best_score = nbest_single[0][0]
-                for j in xrange(1, len(nbest_single)):
-                  ops.append((first_best_score - nbest_single[j][0], i, j))
-              ops.sort()
-            for op in ops:
-              if op[0] > args.prune_threshold:
-                break
-              pos, new_rank = op[1:]
-              old_rank = current_ranks[pos]
-              tf.logging.info("%d -> %d at pos %d (%f)" % (old_rank, new_rank, pos, op[0]))
-              current_ranks[pos] = new_rank
-              hypo = get_hypo(current_ranks, doc_nbest, adaptor)
-              hypos.append(hypo)
-              if hypo.total_score() > best_score:
-                best_score = hypo.total_score()
-                tf.logging.info("New best: %f %s" % (best_score, hypo.scores))
-              else:
-                current_ranks[pos] = old_rank
-            hypos.sort(key=lambda h: -h.total_score())
-            tf.logging.info("Decoded (ID: %d): %s" % (doc_idx+1, hypos[0].str_glued()))
-            tf.logging.info("Stats (ID: %d): score=%f num_expansions=%d" % (doc_idx+1, hypos[0].total_score(), len(hypos)))
-            if "text" in args.output_formats:
-              plain_writer.write("%s\n" % hypos[0].str_glued())
-            if "nbest" in args.output_formats:
-              for hypo in hypos[:args.nbest]:
-                nbest_writer.write("%d ||| %s ||| t2t=%f sennbest=%f wc=%f ||| %f\n" % (doc_idx, hypo.str_glued(), hypo.scores[0], hypo.scores[1], hypo.scores[2], hypo.total_score()))
-
-          trg_sen_idx += n_sentences
+      def write_result(result):
+        doc_idx, hypos = result
+        with instrumentation.timed("write_output"):
+          if "text" in args.output_formats:
+            plain_writer.write("%s\n" % hypos[0].str_glued())
+          if "nbest" in args.output_formats:
+            for hypo in hypos[:args.nbest]:
+              nbest_writer.write("%d ||| %s ||| t2t=%f sennbest=%f wc=%f ||| %f\n" % (doc_idx, hypo.str_glued(), hypo.scores[0], hypo.scores[1], hypo.scores[2], hypo.total_score()))
+      pipeline.run(inputs, process_fn, write_result, args.queue_size,
+                   "refine_pipeline")
+  if args.num_workers > 1:
+    pool.close()
+    pool.join()
+  instrumentation.finish()
 
 if __name__ == '__main__':
   main()
-
-
-
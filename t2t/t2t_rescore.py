@@ -6,9 +6,20 @@ from __future__ import division
 from __future__ import print_function
 
 import os
+import heapq
 import operator
+import itertools
+import multiprocessing
+import time
 import numpy as np
 
+import instrumentation
+import pipeline
+import prefix_trie
+import t2t_client
+import t2t_freeze_graph
+import xla_buckets
+
 
 from tensor2tensor import models  # pylint: disable=unused-import
 from tensor2tensor import problems as problems_lib  # pylint: disable=unused-import
@@ -33,12 +44,78 @@ flags.DEFINE_string("checkpoint_path", None,
                     "Path to the model checkpoint.")
 flags.DEFINE_bool("single_cpu_thread", False,
                   "If true, do not use more than one CPU")
+flags.DEFINE_bool("verbose", False,
+                  "If true, print debug messages")
+flags.DEFINE_integer("batch_size", 1, "Maximum number of hypotheses per batch.")
+flags.DEFINE_integer("max_tokens_per_batch", 0,
+                     "Token budget per batch (batch size times padded "
+                     "sequence length). 0 means no limit.")
+flags.DEFINE_integer("sort_window", 100,
+                     "Number of source sentences whose hypotheses are sorted "
+                     "by length together before batching.")
+flags.DEFINE_bool("encode_once", False,
+                  "If true, run the encoder only once per source sentence "
+                  "and share its output with all hypotheses in the batch.")
+flags.DEFINE_bool("prefix_trie", False,
+                  "If true, build a prefix trie over the hypotheses of each "
+                  "source sentence and score each shared prefix only once. "
+                  "--batch_size then refers to the number of tries.")
+flags.DEFINE_bool("benchmark_prefix_trie", False,
+                  "Compare prefix trie scoring with hypothesis-by-hypothesis "
+                  "scoring on --trg_test, log timings and exit.")
+flags.DEFINE_integer("num_workers", 1,
+                     "Number of worker processes, each with its own TF "
+                     "session. The n-best list is sharded into windows of "
+                     "--sort_window sentences.")
+flags.DEFINE_integer("intra_op_threads", 0,
+                     "Number of intra-op threads per TF session (0: TF "
+                     "default).")
+flags.DEFINE_integer("src_vocab_size", 123, "Source vocabulary size.")
+flags.DEFINE_integer("trg_vocab_size", 123, "Target vocabulary size.")
 flags.DEFINE_string("t2t_usr_dir", None, "Path to the t2t usr directory.")
 flags.DEFINE_string("problem", None, "T2T problem name.")
 flags.DEFINE_string("model", None, "T2T model name.")
 flags.DEFINE_string("hparams_set", None, "T2T hparams set name.")
 flags.DEFINE_string("outputs", "text,nbest", "Output formats (like in SGNMT).")
 flags.DEFINE_string("output_path", "t2t-gibbs-out.%s", "Output path (like in SGNMT).")
+flags.DEFINE_integer("nbest", 0, "Maximum number of n-best entries per sentence (0: no limit).")
+flags.DEFINE_bool("resume", False,
+                  "If true, skip sentences which are already complete in an "
+                  "existing n-best output file and append to it.")
+flags.DEFINE_string("server", None,
+                    "Path to the Unix socket of a t2t_server.py instance. If "
+                    "set, sentences are scored by the server instead of a "
+                    "local TF session.")
+flags.DEFINE_string("server_model", None,
+                    "Name of the model on the server (with --server).")
+flags.DEFINE_string("frozen_graph", None,
+                    "Path to a graph exported with t2t_freeze_graph.py. If "
+                    "set, the graph is imported instead of building the "
+                    "model and restoring --checkpoint_path.")
+flags.DEFINE_string("xla_buckets", "",
+                    "Comma-separated list of <batch_size>x<length> buckets, "
+                    "e.g. '8x32,8x64,4x128'. If set, a copy of the scoring "
+                    "graph with static shapes is compiled with XLA for each "
+                    "bucket, and batches are padded to the smallest bucket "
+                    "which fits. Batches which do not fit any bucket use the "
+                    "dynamic-shape graph.")
+flags.DEFINE_integer("queue_size", 4,
+                     "Maximum number of windows in the queues of the reader "
+                     "and writer threads (0: read, score, and write in the "
+                     "main thread).")
+flags.DEFINE_string("profile_output", None,
+                    "If set, write the wall time of each session call, "
+                    "graph building, checkpoint restore, and pre- and "
+                    "post-processing step to this JSON-lines file.")
+flags.DEFINE_integer("trace_every_n", 0,
+                     "If positive, write a TF step trace for every n-th "
+                     "session call to --trace_dir.")
+flags.DEFINE_string("trace_dir", "traces",
+                    "Output directory for --trace_every_n.")
+flags.DEFINE_bool("benchmark_xla_buckets", False,
+                  "Compare the per-token throughput of --xla_buckets with "
+                  "the dynamic-shape graph on --trg_test, log timings and "
+                  "exit.")
 
 EOS_ID = 1
 PAD_ID = 0
@@ -83,6 +160,7 @@ def session_config():
   else:
     gpu_options = tf.GPUOptions(per_process_gpu_memory_fraction=0.95)
     config = tf.ConfigProto(
+        intra_op_parallelism_threads=FLAGS.intra_op_threads,
         allow_soft_placement=True,
         graph_options=graph_options,
         gpu_options=gpu_options,
@@ -159,35 +237,157 @@ def gather_2d(params, indices):
   return tf.gather_nd(params, gather_nd_indices)
 
 
+def share_encoder_output(translate_model, src_indices):
+  """Makes the encoder output of `translate_model` shareable across
+  hypotheses. The inputs fed to the model only contain the distinct
+  source sentences of the batch. The encoder runs over them once, and
+  its outputs are gathered along the batch dimension so that each
+  target sentence is paired with the encoding of its source sentence.
+
+  Args:
+    translate_model: T2TModel with an `encode()` method (Transformer)
+    src_indices: [batch_size] int32 tensor with the source sentence
+                 index for each target sentence
+  """
+  if not hasattr(translate_model, "encode"):
+    raise AttributeError("--encode_once requires a model with an encoder")
+  encode_fn = translate_model.encode
+  def encode_and_gather(*args, **kwargs):
+    encoder_output, encoder_decoder_attention_bias = encode_fn(
+        *args, **kwargs)
+    return (tf.gather(encoder_output, src_indices),
+            tf.gather(encoder_decoder_attention_bias, src_indices))
+  translate_model.encode = encode_and_gather
+
+
 class Rescorer(object):
 
-  def __init__(self):
+  def __init__(self, use_prefix_trie=False):
+    start_time = time.time()
+    # Each trie belongs to a single source sentence, so prefix trie
+    # scoring runs the encoder once per source sentence anyway
+    self._encode_once = FLAGS.encode_once and not use_prefix_trie
     rescoring_graph = tf.Graph()
     with rescoring_graph.as_default() as g:
       hparams = trainer_lib.create_hparams(FLAGS.hparams_set)
       self._add_problem_hparams(hparams)
       translate_model = registry.model(FLAGS.model)(
           hparams, tf.estimator.ModeKeys.EVAL)
-      self._inputs_var = tf.placeholder(dtype=tf.int32, shape=[FLAGS.batch_size, None],
+      # The batch dimension is left open because length bucketing produces
+      # batches smaller than FLAGS.batch_size
+      self._inputs_var = tf.placeholder(dtype=tf.int32, shape=[None, None],
                                         name="rescorer_inputs")
-      self._targets_var = tf.placeholder(dtype=tf.int32, shape=[FLAGS.batch_size, None], 
+      self._targets_var = tf.placeholder(dtype=tf.int32, shape=[None, None], 
                                          name="rescorer_targets")
-      features = {"inputs": expand_input_dims_for_t2t(self._inputs_var), 
-                  "targets": expand_input_dims_for_t2t(self._targets_var)}
-      translate_model.prepare_features_for_infer(features)
-      translate_model._fill_problem_hparams_features(features)
-      logits, _ = translate_model(features)
-      logits = tf.squeeze(logits, [2, 3])
-      log_probs = log_prob_from_logits(logits)
-      no_pad = tf.cast(tf.not_equal(self._targets_var, PAD_ID), tf.float32)
-      shp = tf.shape(self._targets_var)
-      flat_bsz = shp[0] * shp[1]
-      word_loss = gather_2d(
-          tf.reshape(log_probs, [flat_bsz, -1]),
-          tf.reshape(self._targets_var, [flat_bsz, 1]))
-      word_loss = tf.reshape(word_loss, (shp[0], shp[1])) * no_pad
-      self._sentence_loss = tf.reduce_sum(word_loss, -1)
+      if self._encode_once:
+        self._src_indices_var = tf.placeholder(dtype=tf.int32, shape=[None],
+                                               name="rescorer_src_indices")
+        share_encoder_output(translate_model, self._src_indices_var)
+      if use_prefix_trie:
+        # _targets_var holds the shifted trie inputs, see prefix_trie.py
+        self._node_tokens_var = tf.placeholder(
+            dtype=tf.int32, shape=[None, None], name="rescorer_node_tokens")
+        self._positions_var = tf.placeholder(
+            dtype=tf.int32, shape=[None, None], name="rescorer_positions")
+        self._ancestor_mask_var = tf.placeholder(
+            dtype=tf.bool, shape=[None, None, None], 
+            name="rescorer_ancestor_mask")
+        prefix_trie.use_tree_attention(translate_model, self._positions_var,
+                                       self._ancestor_mask_var)
+        scored_tokens = self._node_tokens_var
+      else:
+        scored_tokens = self._targets_var
+      self._word_loss, self._sentence_loss = self._scoring_graph(
+          translate_model, self._inputs_var, self._targets_var, 
+          scored_tokens)
+      self._bucket_vars = {}
+      if FLAGS.xla_buckets:
+        if self._encode_once or use_prefix_trie:
+          raise AttributeError("--encode_once and --prefix_trie are not "
+                               "supported with --xla_buckets")
+        self._build_buckets(translate_model)
+      restore_start_time = time.time()
       self.mon_sess = create_session()
+    instrumentation.record("graph_build", restore_start_time - start_time)
+    instrumentation.record("restore", time.time() - restore_start_time)
+    tf.logging.info("Graph building and checkpoint restore took %.2fs"
+                    % (time.time() - start_time))
+    self.use_buckets = bool(self._bucket_vars)
+    self._compiled_buckets = set()
+    self.n_bucket_fallbacks = 0
+
+  def _scoring_graph(self, translate_model, inputs, targets, scored_tokens):
+    """Creates the scoring graph for padded inputs and targets.
+
+    Returns:
+      Tuple (word_loss, sentence_loss) with the log-probabilities of
+      `scored_tokens`, masked at padding, and their sum.
+    """
+    features = {"inputs": expand_input_dims_for_t2t(inputs), 
+                "targets": expand_input_dims_for_t2t(targets)}
+    translate_model.prepare_features_for_infer(features)
+    translate_model._fill_problem_hparams_features(features)
+    logits, _ = translate_model(features)
+    logits = tf.squeeze(logits, [2, 3])
+    log_probs = log_prob_from_logits(logits)
+    no_pad = tf.cast(tf.not_equal(scored_tokens, PAD_ID), tf.float32)
+    shp = tf.shape(scored_tokens)
+    flat_bsz = shp[0] * shp[1]
+    word_loss = gather_2d(
+        tf.reshape(log_probs, [flat_bsz, -1]),
+        tf.reshape(scored_tokens, [flat_bsz, 1]))
+    word_loss = tf.reshape(word_loss, (shp[0], shp[1])) * no_pad
+    return word_loss, tf.reduce_sum(word_loss, -1)
+
+  def _build_buckets(self, translate_model):
+    """Creates a copy of the scoring graph with static input shapes for
+    each bucket in --xla_buckets. The copies share the model variables
+    and are marked for XLA compilation. XLA compiles each copy on its
+    first call, and the session keeps the executable for the whole run.
+    """
+    self._buckets = xla_buckets.parse_buckets(FLAGS.xla_buckets)
+    jit_scope = tf.contrib.compiler.jit.experimental_jit_scope
+    for batch_size, length in self._buckets:
+      suffix = "%dx%d" % (batch_size, length)
+      inputs = tf.placeholder(dtype=tf.int32, shape=[batch_size, length],
+                              name="rescorer_inputs_%s" % suffix)
+      targets = tf.placeholder(dtype=tf.int32, shape=[batch_size, length],
+                               name="rescorer_targets_%s" % suffix)
+      with tf.variable_scope(tf.get_variable_scope(), reuse=True):
+        with jit_scope():
+          _, sentence_loss = self._scoring_graph(
+              translate_model, inputs, targets, targets)
+      self._bucket_vars[(batch_size, length)] = (
+          inputs, targets, sentence_loss)
+    tf.logging.info("Created %d XLA buckets: %s" 
+                    % (len(self._buckets), FLAGS.xla_buckets))
+
+  def _rescore_bucket(self, src_sentences, trg_sentences):
+    """Scores a batch with the XLA graph of the smallest bucket which
+    fits it, or returns None if there is no such bucket.
+    """
+    bucket = xla_buckets.find_bucket(
+        self._buckets, trg_sentences.shape[0], 
+        max(src_sentences.shape[1], trg_sentences.shape[1]))
+    if bucket is None:
+      self.n_bucket_fallbacks += 1
+      tf.logging.debug("No XLA bucket for batch shape src=%s trg=%s" 
+                       % (src_sentences.shape, trg_sentences.shape))
+      return None
+    inputs_var, targets_var, sentence_loss = self._bucket_vars[bucket]
+    src_batch = xla_buckets.pad_to_bucket(src_sentences, bucket)
+    trg_batch = xla_buckets.pad_to_bucket(trg_sentences, bucket)
+    start_time = time.time()
+    sentence_loss = instrumentation.run(
+        self.mon_sess, sentence_loss, 
+        {inputs_var: src_batch, targets_var: trg_batch},
+        batches=[src_batch, trg_batch])
+    if bucket not in self._compiled_buckets:
+      self._compiled_buckets.add(bucket)
+      tf.logging.info("First call of XLA bucket %dx%d (with compilation) "
+                      "took %.2fs" % (bucket[0], bucket[1], 
+                                      time.time() - start_time))
+    return sentence_loss[:trg_sentences.shape[0]]
 
   def _add_problem_hparams(self, hparams):
     """Add problem hparams for the problems. 
@@ -213,36 +413,267 @@ class Rescorer(object):
     hparams.problem_hparams = p_hparams
     return hparams
 
-  def rescore(self, src_sentences, trg_sentences):
-    bsz = src_sentences.shape[0]
-    sentence_loss = self.mon_sess.run(
-      self._sentence_loss,
-      {self._inputs_var: src_sentences,
-       self._targets_var: trg_sentences,
-       self._pos_var: pos})
+  def rescore(self, src_sentences, trg_sentences, src_indices=None):
+    """Scores a batch of padded sentence pairs.
+
+    Args:
+      src_sentences: [batch_size, src_len] int array, padded with PAD_ID.
+                     With --encode_once, this only contains the distinct
+                     source sentences in the batch.
+      trg_sentences: [batch_size, trg_len] int array, padded with PAD_ID
+      src_indices: Row in `src_sentences` for each target sentence. Only
+                   used with --encode_once.
+
+    Returns:
+      [batch_size] float array with sentence level log-probabilities.
+    """
+    if self.use_buckets:
+      sentence_loss = self._rescore_bucket(src_sentences, trg_sentences)
+      if sentence_loss is not None:
+        return sentence_loss
+    feed_dict = {self._inputs_var: src_sentences,
+                 self._targets_var: trg_sentences}
+    if self._encode_once:
+      feed_dict[self._src_indices_var] = src_indices
+    sentence_loss = instrumentation.run(
+        self.mon_sess, self._sentence_loss, feed_dict,
+        batches=[src_sentences, trg_sentences])
     return sentence_loss
 
+  def rescore_tries(self, src_sentences, tries):
+    """Scores a batch of prefix tries. Requires use_prefix_trie.
+
+    Args:
+      src_sentences: [n_tries, src_len] int array, padded with PAD_ID
+      tries: List of PrefixTrie instances, one for each source sentence
+
+    Returns:
+      List of lists with sentence level log-probabilities, one list for
+      each trie in the order in which sentences were added to the trie.
+    """
+    targets, positions, ancestor_mask = prefix_trie.create_trie_batch(tries)
+    node_loss = instrumentation.run(
+      self.mon_sess,
+      self._word_loss,
+      {self._inputs_var: src_sentences,
+       self._targets_var: targets,
+       self._node_tokens_var: prefix_trie.node_tokens_batch(tries),
+       self._positions_var: positions,
+       self._ancestor_mask_var: ancestor_mask},
+      batches=[src_sentences, targets])
+    return [trie.hypo_scores(loss) for trie, loss in zip(tries, node_loss)]
+
+
+class FrozenRescorer(Rescorer):
+  """Rescorer for a graph exported with t2t_freeze_graph.py."""
+
+  def __init__(self):
+    if FLAGS.encode_once or FLAGS.prefix_trie:
+      raise AttributeError("--encode_once and --prefix_trie are not "
+                           "supported with --frozen_graph")
+    if FLAGS.xla_buckets:
+      raise AttributeError("--xla_buckets is not supported with "
+                           "--frozen_graph")
+    start_time = time.time()
+    self._encode_once = False
+    self.use_buckets = False
+    graph, self.mon_sess = t2t_freeze_graph.load_frozen_graph(
+        FLAGS.frozen_graph, FLAGS.intra_op_threads)
+    tensor = lambda name: graph.get_tensor_by_name("%s:0" % name)
+    self._inputs_var = tensor(t2t_freeze_graph.INPUTS)
+    self._targets_var = tensor(t2t_freeze_graph.TARGETS)
+    self._word_loss = tensor(t2t_freeze_graph.WORD_LOG_PROBS)
+    self._sentence_loss = tensor(t2t_freeze_graph.SENTENCE_SCORES)
+    instrumentation.record("graph_load", time.time() - start_time)
+    tf.logging.info("Loading the frozen graph took %.2fs"
+                    % (time.time() - start_time))
+
+
+class RemoteRescorer(object):
+  """Drop-in replacement for Rescorer which sends the batches to a
+  t2t_server.py instance. Prefix trie scoring is not supported.
+  """
+
+  def __init__(self):
+    if FLAGS.prefix_trie or FLAGS.xla_buckets:
+      raise AttributeError("--prefix_trie and --xla_buckets are not "
+                           "supported with --server")
+    self._client = t2t_client.ScoringClient(FLAGS.server)
+    self._model = FLAGS.server_model
+
+  def rescore(self, src_sentences, trg_sentences, src_indices=None):
+    """See Rescorer.rescore()."""
+    if FLAGS.encode_once:
+      src_sentences = src_sentences[src_indices]
+    with instrumentation.timed("remote_call"):
+      word_loss = self._client.score(self._model, list(src_sentences),
+                                     list(trg_sentences))
+    return np.array([np.sum(l) for l in word_loss])
+
+
+def create_rescorer(use_prefix_trie=False):
+  if FLAGS.server:
+    return RemoteRescorer()
+  if FLAGS.frozen_graph:
+    return FrozenRescorer()
+  return Rescorer(use_prefix_trie=use_prefix_trie)
+
 
 def line_to_words(line, add_eos=False):
   line = line.strip()
   if not line:
     words = []
   else:
-    words = map(int, line.split())
+    words = [int(w) for w in line.split()]
   if add_eos:
     words.append(EOS_ID)
-  return np.array([words], dtype=np.int)
+  return words
 
 
-def batched_iter(src_path, trg_path=None, batch_size=1):
-  if batch_size > 1:
-    raise AttributeError("Batched decoding not implemented yet")
+def load_src_sentences(src_path):
   with open(src_path) as src_reader:
-    with open(trg_path) as trg_reader:
-      for idx, (src_line, trg_line) in enumerate(zip(src_reader, trg_reader)):
-        yield (np.array([idx], dtype=np.int),
-               line_to_words(src_line), 
-               line_to_words(trg_line, add_eos=True))
+    return [line_to_words(line) for line in src_reader]
+
+
+def nbest_iter(trg_path):
+  """Reads a Moses n-best list and groups consecutive entries with the
+  same sentence ID.
+
+  Yields:
+    Tuples (sen_idx, hypos) with a list of target sentences (with EOS).
+  """
+  cur_idx = None
+  hypos = []
+  with open(trg_path) as trg_reader:
+    for line in trg_reader:
+      parts = line.split("|||")
+      idx = int(parts[0].strip())
+      if idx != cur_idx and hypos:
+        yield cur_idx, hypos
+        hypos = []
+      cur_idx = idx
+      hypos.append(line_to_words(parts[1], add_eos=True))
+  if hypos:
+    yield cur_idx, hypos
+
+
+def pad_sentences(sentences):
+  """Creates a [len(sentences), max_len] array padded with PAD_ID."""
+  max_len = max(len(s) for s in sentences)
+  padded = np.full((len(sentences), max(max_len, 1)), PAD_ID, dtype=np.int)
+  for i, s in enumerate(sentences):
+    padded[i, :len(s)] = s
+  return padded
+
+
+def batched_iter(src_sentences, groups, batch_size=1, max_tokens=0,
+                 encode_once=False):
+  """Creates length-bucketed batches from n-best groups.
+
+  All hypotheses in `groups` are sorted by target and source length so
+  that each batch contains sentences of similar lengths, which keeps
+  the amount of padding small. If `encode_once` is true, hypotheses
+  are sorted by source length first and kept together with the other
+  hypotheses of the same source sentence, and each source sentence
+  occurs only once in the source batch. A batch is closed when it contains
+  `batch_size` hypotheses or when the padded batch would exceed
+  `max_tokens` tokens. The PAD_ID mask in the rescoring graph makes
+  sure that padding does not change the scores.
+
+  Args:
+    src_sentences: List of source sentences, indexed by sentence ID
+    groups: List of (sen_idx, hypos) tuples as created by `nbest_iter`
+    batch_size: Maximum number of hypotheses in a batch
+    max_tokens: Token budget per batch, 0 for unlimited
+    encode_once: Whether to share source sentences within a batch
+
+  Yields:
+    Tuples (keys, src_batch, trg_batch, src_indices). keys is a list of
+    (group_pos, hypo_pos) tuples which map each batch entry back to
+    `groups`. src_indices contains the row in src_batch for each entry.
+  """
+  entries = []
+  for group_pos, (sen_idx, hypos) in enumerate(groups):
+    src = src_sentences[sen_idx]
+    for hypo_pos, hypo in enumerate(hypos):
+      if encode_once:
+        entries.append((len(src), group_pos, len(hypo), hypo_pos))
+      else:
+        entries.append((len(hypo), len(src), group_pos, hypo_pos))
+  entries.sort()
+  keys = []
+  max_len = 0
+  for entry in entries:
+    if encode_once:
+      src_len, group_pos, trg_len, hypo_pos = entry
+    else:
+      trg_len, src_len, group_pos, hypo_pos = entry
+    new_max_len = max(max_len, trg_len, src_len)
+    if keys and (len(keys) >= batch_size or 
+        (max_tokens > 0 and (len(keys) + 1) * new_max_len > max_tokens)):
+      yield _create_batch(keys, src_sentences, groups, encode_once)
+      keys = []
+      new_max_len = max(trg_len, src_len)
+    keys.append((group_pos, hypo_pos))
+    max_len = new_max_len
+  if keys:
+    yield _create_batch(keys, src_sentences, groups, encode_once)
+
+
+def trie_batched_iter(src_sentences, groups, batch_size=1, max_tokens=0):
+  """Like `batched_iter` but creates one PrefixTrie for each n-best
+  group. `batch_size` and `max_tokens` are applied to tries and trie
+  nodes rather than hypotheses and tokens.
+
+  Yields:
+    Tuples (group_positions, src_batch, tries)
+  """
+  entries = []
+  for group_pos, (sen_idx, hypos) in enumerate(groups):
+    trie = prefix_trie.PrefixTrie()
+    for hypo in hypos:
+      trie.add(hypo)
+    entries.append((len(src_sentences[sen_idx]), len(trie), group_pos, trie))
+  entries.sort(key=operator.itemgetter(0, 1, 2))
+  group_positions = []
+  tries = []
+  max_len = 0
+  for src_len, n_nodes, group_pos, trie in entries:
+    new_max_len = max(max_len, src_len, n_nodes)
+    if tries and (len(tries) >= batch_size or 
+        (max_tokens > 0 and (len(tries) + 1) * new_max_len > max_tokens)):
+      yield (group_positions, 
+             pad_sentences([src_sentences[groups[g][0]] 
+                            for g in group_positions]),
+             tries)
+      group_positions = []
+      tries = []
+      new_max_len = max(src_len, n_nodes)
+    group_positions.append(group_pos)
+    tries.append(trie)
+    max_len = new_max_len
+  if tries:
+    yield (group_positions, 
+           pad_sentences([src_sentences[groups[g][0]] 
+                          for g in group_positions]),
+           tries)
+
+
+def _create_batch(keys, src_sentences, groups, encode_once):
+  if encode_once:
+    src_group_pos = []
+    src_indices = []
+    for g, _ in keys:
+      if not src_group_pos or src_group_pos[-1] != g:
+        src_group_pos.append(g)
+      src_indices.append(len(src_group_pos) - 1)
+  else:
+    src_group_pos = [g for g, _ in keys]
+    src_indices = range(len(keys))
+  src_batch = pad_sentences([src_sentences[groups[g][0]] 
+                             for g in src_group_pos])
+  trg_batch = pad_sentences([groups[g][1][h] for g, h in keys])
+  return keys, src_batch, trg_batch, np.array(src_indices, dtype=np.int32)
 
 
 def sample2str(sample):
@@ -254,48 +685,291 @@ def sample2str(sample):
 
 class TextOutputHandler(object):
 
-  def __init__(self, path):
-    self.writer = open(path, "w")
+  def __init__(self, path, n_keep=None):
+    """Creates the handler.
+
+    Args:
+      path: Path to the text file
+      n_keep: If not None, resume writing after the first `n_keep`
+              lines of an existing file
+    """
+    if n_keep is None:
+      self.writer = open(path, "w")
+    else:
+      lines = []
+      if os.path.isfile(path):
+        with open(path) as reader:
+          lines = [line for line in itertools.islice(reader, n_keep)
+                   if line.endswith("\n")]
+      self.writer = open(path, "w")
+      self.writer.write("".join(lines))
 
   def write(self, idx, samples):
     self.writer.write("%s\n" % sample2str(samples[0][1]))
+    self.writer.flush()
 
   def finish(self):
     self.writer.close()
 
 
 class NbestOutputHandler(object):
+  """Writes n-best lists sentence by sentence. Samples are collected in
+  a bounded min-heap for the current sentence. The sentence is written
+  to the file as soon as samples for a different sentence arrive, so
+  memory does not grow with the size of the test set and a crash only
+  loses the current sentence.
+  """
+
+  def __init__(self, path, nbest=0, resume=False):
+    """Creates the handler.
 
-  def __init__(self, path):
+    Args:
+      path: Path to the n-best file
+      nbest: Maximum number of entries per sentence (0: no limit)
+      resume: If true, keep all complete sentences in an existing
+              n-best file at `path` and append to it
+    """
     self.path = path
-    self.samples = {}
+    self.nbest = nbest
+    self.completed = set()
+    if resume and os.path.isfile(path):
+      self.writer = open(path, "r+")
+      self._truncate_incomplete()
+    else:
+      self.writer = open(path, "w")
+    self.cur_idx = None
+    self.heap = []
+    self.n_pushed = 0
+
+  def _truncate_incomplete(self):
+    """Reads the sentence IDs in the existing n-best file and removes
+    the last sentence since it may be incomplete.
+    """
+    last_idx = None
+    last_start = 0
+    while True:
+      pos = self.writer.tell()
+      line = self.writer.readline()
+      if not line.endswith("\n"):
+        break
+      idx = int(line.split("|||")[0].strip())
+      if idx != last_idx:
+        if last_idx is not None:
+          self.completed.add(last_idx)
+        last_idx = idx
+        last_start = pos
+    self.writer.seek(last_start)
+    self.writer.truncate()
+    tf.logging.info("Resuming %s after %d complete sentences" 
+                    % (self.path, len(self.completed)))
 
   def write(self, idx, samples):
-    if idx in self.samples:
-      self.samples[idx].extend(samples)
-      self.samples[idx].sort(reverse=True, key=operator.itemgetter(0))
-    else:
-      self.samples[idx] = samples
+    if idx != self.cur_idx:
+      self._flush()
+      self.cur_idx = idx
+    for score, sample in samples:
+      # The negated counter keeps earlier samples first among equal scores
+      entry = (score, -self.n_pushed, sample)
+      self.n_pushed += 1
+      if self.nbest > 0 and len(self.heap) >= self.nbest:
+        heapq.heappushpop(self.heap, entry)
+      else:
+        heapq.heappush(self.heap, entry)
+
+  def _flush(self):
+    if self.cur_idx is None:
+      return
+    for score, _, sample in sorted(self.heap, reverse=True, 
+                                   key=operator.itemgetter(0, 1)):
+      self.writer.write("%d ||| %s ||| logprob=%f ||| %f\n" %
+                        (self.cur_idx, sample2str(sample), score, score))
+    self.writer.flush()
+    self.completed.add(self.cur_idx)
+    self.heap = []
+    self.n_pushed = 0
 
   def finish(self):
-    with open(self.path, "w") as writer:
-      for idx in sorted(self.samples.iterkeys()):
-        for score, sample in self.samples[idx]:
-          writer.write("%d ||| %s ||| logprob=%f ||| %f\n" %
-                       (idx, sample2str(sample), score, score))
+    self._flush()
+    self.writer.close()
 
 
 def create_output_handlers():
+  """Creates the output handlers. If --resume is set, the returned set
+  contains the IDs of the sentences which are already complete in the
+  n-best file.
+
+  Returns:
+    Tuple (list of handlers, set of completed sentence IDs)
+  """
   handlers = []
-  for handler_name in FLAGS.outputs.split(","):
+  completed = set()
+  handler_names = FLAGS.outputs.split(",")
+  # Create the n-best handler first to find out where to resume
+  if "nbest" in handler_names:
+    nbest_handler = NbestOutputHandler(FLAGS.output_path % "nbest", 
+                                       FLAGS.nbest, FLAGS.resume)
+    completed = set(nbest_handler.completed)
+  elif FLAGS.resume:
+    raise AttributeError("--resume requires the nbest output handler")
+  for handler_name in handler_names:
     path = FLAGS.output_path % handler_name
     if handler_name == "text":
-      handlers.append(TextOutputHandler(path))
+      handlers.append(TextOutputHandler(
+          path, len(completed) if FLAGS.resume else None))
     elif handler_name == "nbest":
-      handlers.append(NbestOutputHandler(path))
+      handlers.append(nbest_handler)
     else:
       raise AttributeError("Unknown output handler")
-  return handlers
+  return handlers, completed
+
+
+def make_batches(src_sentences, groups):
+  """Creates the batches for a list of n-best groups, see
+  `batched_iter()` and `trie_batched_iter()`.
+  """
+  if FLAGS.prefix_trie:
+    return list(instrumentation.timed_iter(
+        trie_batched_iter(src_sentences, groups, FLAGS.batch_size, 
+                          FLAGS.max_tokens_per_batch), "preprocess"))
+  return list(instrumentation.timed_iter(
+      batched_iter(src_sentences, groups, FLAGS.batch_size, 
+                   FLAGS.max_tokens_per_batch, FLAGS.encode_once),
+      "preprocess"))
+
+
+def score_batches(rescorer, groups, batches):
+  """Scores the batches created by `make_batches()`.
+
+  Returns:
+    List of lists with a score for each hypothesis in `groups`.
+  """
+  scores = [[0.0] * len(hypos) for _, hypos in groups]
+  if FLAGS.prefix_trie:
+    for group_positions, src_batch, tries in batches:
+      tf.logging.debug("Trie batch shape src=%s nodes=%d" 
+                       % (src_batch.shape, max(len(t) for t in tries)))
+      for group_pos, trie_scores in zip(
+          group_positions, rescorer.rescore_tries(src_batch, tries)):
+        scores[group_pos] = trie_scores
+    return scores
+  for keys, src_batch, trg_batch, src_indices in batches:
+    tf.logging.debug("Batch shape src=%s trg=%s" 
+                     % (src_batch.shape, trg_batch.shape))
+    sentence_loss = rescorer.rescore(src_batch, trg_batch, src_indices)
+    for (group_pos, hypo_pos), loss in zip(keys, sentence_loss):
+      scores[group_pos][hypo_pos] = loss
+  return scores
+
+
+def score_groups(rescorer, src_sentences, groups):
+  """Scores all hypotheses in a list of n-best groups.
+
+  Returns:
+    List of lists with a score for each hypothesis in `groups`.
+  """
+  return score_batches(rescorer, groups, make_batches(src_sentences, groups))
+
+
+def benchmark_prefix_trie(src_sentences):
+  """Compares prefix trie scoring with scoring each hypothesis in a
+  separate session call on the full n-best list.
+  """
+  groups = list(nbest_iter(FLAGS.trg_test))
+  n_tokens = 0
+  n_nodes = 0
+  for _, hypos in groups:
+    trie = prefix_trie.PrefixTrie()
+    for hypo in hypos:
+      trie.add(hypo)
+    n_tokens += trie.n_tokens()
+    n_nodes += len(trie)
+  tf.logging.info("%d hypotheses with %d tokens and %d trie nodes (%.2f%%)"
+                  % (sum(len(h) for _, h in groups), n_tokens, n_nodes,
+                     100.0 * n_nodes / max(n_tokens, 1)))
+  rescorer = Rescorer()
+  start_time = time.time()
+  single_scores = []
+  for sen_idx, hypos in groups:
+    src_batch = pad_sentences([src_sentences[sen_idx]])
+    single_scores.append(
+        [rescorer.rescore(src_batch, pad_sentences([h]), [0])[0] 
+         for h in hypos])
+  single_time = time.time() - start_time
+  rescorer = Rescorer(use_prefix_trie=True)
+  start_time = time.time()
+  trie_scores = []
+  for sen_idx, hypos in groups:
+    trie = prefix_trie.PrefixTrie()
+    for hypo in hypos:
+      trie.add(hypo)
+    trie_scores.append(rescorer.rescore_tries(
+        pad_sentences([src_sentences[sen_idx]]), [trie])[0])
+  trie_time = time.time() - start_time
+  max_diff = max(abs(s - t) 
+                 for ss, ts in zip(single_scores, trie_scores)
+                 for s, t in zip(ss, ts))
+  tf.logging.info("Hypothesis-by-hypothesis: %.2fs, prefix trie: %.2fs, "
+                  "speedup: %.2fx, max score difference: %g (identical=%s)" 
+                  % (single_time, trie_time, 
+                     single_time / max(trie_time, 1e-6), max_diff,
+                     max_diff == 0.0))
+
+
+def benchmark_xla_buckets(src_sentences):
+  """Compares the per-token throughput of the XLA bucket graphs with the
+  dynamic-shape graph on the full n-best list. Each path scores the
+  n-best list twice, and only the second pass is timed so that XLA
+  compilation is excluded.
+  """
+  if not FLAGS.xla_buckets:
+    raise AttributeError("--benchmark_xla_buckets requires --xla_buckets")
+  groups = list(nbest_iter(FLAGS.trg_test))
+  n_tokens = sum(len(h) for _, hypos in groups for h in hypos)
+  rescorer = Rescorer()
+  results = {}
+  for use_buckets in [False, True]:
+    rescorer.use_buckets = use_buckets
+    start_time = time.time()
+    score_groups(rescorer, src_sentences, groups)
+    first_time = time.time() - start_time
+    start_time = time.time()
+    scores = score_groups(rescorer, src_sentences, groups)
+    results[use_buckets] = (first_time, time.time() - start_time, scores)
+  for use_buckets, name in [(False, "Dynamic shapes"), (True, "XLA buckets")]:
+    first_time, run_time, _ = results[use_buckets]
+    tf.logging.info("%s: first pass %.2fs, second pass %.2fs, "
+                    "%.1f tokens/s" % (name, first_time, run_time,
+                                       n_tokens / max(run_time, 1e-6)))
+  max_diff = max(abs(s - t) 
+                 for ss, ts in zip(results[False][2], results[True][2])
+                 for s, t in zip(ss, ts))
+  tf.logging.info("%d tokens, speedup: %.2fx, batches without bucket: %d, "
+                  "max score difference: %g" 
+                  % (n_tokens, results[False][1] / max(results[True][1], 1e-6),
+                     rescorer.n_bucket_fallbacks // 2, max_diff))
+
+
+# State of a worker process in --num_workers mode
+_worker_rescorer = None
+_worker_src_sentences = None
+
+
+def _init_worker():
+  """Creates the TF session in a worker process."""
+  global _worker_rescorer
+  _worker_rescorer = create_rescorer(use_prefix_trie=FLAGS.prefix_trie)
+
+
+def _score_groups_in_worker(groups):
+  return groups, score_groups(_worker_rescorer, _worker_src_sentences, groups)
+
+
+def window_iter(groups_iter, window_size):
+  while True:
+    groups = list(itertools.islice(groups_iter, window_size))
+    if not groups:
+      break
+    yield groups
 
 
 def main(_):
@@ -303,18 +977,62 @@ def main(_):
   if FLAGS.verbose:
     tf.logging.set_verbosity(tf.logging.DEBUG)
   usr_dir.import_usr_dir(FLAGS.t2t_usr_dir)
-  rescorer = Rescorer()
-  output_handlers = create_output_handlers()
-  for ids, src_sentences, trg_sentences in batched_iter(
-      FLAGS.src_test, FLAGS.trg_test, FLAGS.batch_size):
-    res = sampler.sample(src_sentences, trg_sentences)
-    for idx, samples in zip(ids, res):
-      samples.sort(reverse=True, key=operator.itemgetter(0))
-      for ohandler in output_handlers:
-        ohandler.write(idx, samples)
-    break
+  if FLAGS.benchmark_prefix_trie:
+    benchmark_prefix_trie(load_src_sentences(FLAGS.src_test))
+    return
+  if FLAGS.benchmark_xla_buckets:
+    benchmark_xla_buckets(load_src_sentences(FLAGS.src_test))
+    return
+  global _worker_src_sentences
+  instrumentation.configure(FLAGS.profile_output, FLAGS.trace_every_n,
+                            FLAGS.trace_dir)
+  output_handlers, completed = create_output_handlers()
+  src_sentences = load_src_sentences(FLAGS.src_test)
+  groups_iter = (group for group in nbest_iter(FLAGS.trg_test)
+                 if group[0] not in completed)
+  windows = window_iter(groups_iter, FLAGS.sort_window)
+  if FLAGS.num_workers > 1:
+    # Workers inherit the source sentences when they are forked. TF
+    # sessions must not be created before forking.
+    _worker_src_sentences = src_sentences
+    pool = multiprocessing.Pool(FLAGS.num_workers, _init_worker)
+    # imap() returns the results in the order of the input windows
+    inputs = pool.imap(_score_groups_in_worker, windows)
+    process_fn = None
+  else:
+    rescorer = create_rescorer(use_prefix_trie=FLAGS.prefix_trie)
+    # The n-best list is read and batched in the reader thread
+    inputs = ((groups, make_batches(src_sentences, groups)) 
+              for groups in windows)
+    def process_fn(item):
+      groups, batches = item
+      return groups, score_batches(rescorer, groups, batches)
+  progress = {"n_processed": 0}
+  start_time = time.time()
+
+  def write_result(result):
+    groups, scores = result
+    if progress["n_processed"] == 0:
+      tf.logging.info("First window latency: %.3fs" 
+                      % (time.time() - start_time))
+    with instrumentation.timed("postprocess"):
+      for (idx, hypos), sen_scores in zip(groups, scores):
+        samples = [(score, np.array(hypo)) 
+                   for score, hypo in zip(sen_scores, hypos)]
+        samples.sort(reverse=True, key=operator.itemgetter(0))
+        for ohandler in output_handlers:
+          ohandler.write(idx, samples)
+    progress["n_processed"] += len(groups)
+    tf.logging.info("Processed %d sentences" % progress["n_processed"])
+
+  pipeline.run(inputs, process_fn, write_result, FLAGS.queue_size,
+               "rescore_pipeline")
   for ohandler in output_handlers:
     ohandler.finish()
+  if FLAGS.num_workers > 1:
+    pool.close()
+    pool.join()
+  instrumentation.finish()
 
 
 if __name__ == "__main__":
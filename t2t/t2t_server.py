@@ -0,0 +1,463 @@
+# coding=utf-8
+r"""Persistent T2T scoring server.
+
+Keeps a set of named T2T models loaded and serves score, force-decode,
+and Gibbs sampling requests over a Unix socket. This avoids building
+the graph and restoring the checkpoint on every invocation of
+t2t_rescore.py, t2t_gibbs.py, t2t_force_decode.py, or
+t2t_refine_with_glue_lm.py (see their --server option).
+
+Requests from all clients for the same model and operation are combined
+into shared batches of at most --max_tokens_per_batch tokens. The server
+waits up to --batch_timeout_ms for concurrent requests before running a
+batch.
+
+The models are specified in a JSON file:
+
+  [{"name": "nmt",
+    "model": "transformer",
+    "problem": "translate_ende_wmt32k",
+    "hparams_set": "transformer_base",
+    "checkpoint": "/path/to/train_dir",
+    "src_vocab_size": 32000,
+    "trg_vocab_size": 32000},
+   {"name": "doclm",
+    "model": "transformer",
+    "problem": "my_glue_lm_problem",
+    "hparams_set": "transformer_base",
+    "checkpoint": "/path/to/lm_dir",
+    "trg_vocab_size": 32000,
+    "glue_lm": true}]
+
+Glue LMs have no source side and are fed with targets_seg and
+targets_pos features derived from the BOS separators like in
+t2t_refine_with_glue_lm.py.
+
+  python t2t_server.py --config models.json --socket /tmp/t2t.sock \
+    --t2t_usr_dir usr
+"""
+
+import argparse
+import json
+import logging
+import os
+import threading
+import time
+
+try:
+  import Queue as queue
+  import SocketServer as socketserver
+except ImportError:
+  import queue
+  import socketserver
+
+# Requires tensor2tensor
+from tensor2tensor import models  # pylint: disable=unused-import
+from tensor2tensor import problems as problems_lib  # pylint: disable=unused-import
+from tensor2tensor.utils import usr_dir
+from tensor2tensor.utils import registry
+from tensor2tensor.utils import trainer_lib
+from tensor2tensor.data_generators.text_encoder import TextEncoder
+from tensor2tensor.data_generators import problem  # pylint: disable=unused-import
+import tensorflow as tf
+from tensorflow.python.training import saver
+from tensorflow.python.training import training
+import numpy as np
+
+from t2t_client import send_message, recv_message
+
+PAD_ID = 0
+BOS_ID = 2
+OPS = ["score", "force_decode", "sample"]
+
+
+class DummyTextEncoder(TextEncoder):
+  """Dummy TextEncoder implementation. The TextEncoder
+  implementation in tensor2tensor reads the vocabulary file in
+  the constructor, which is not available inside SGNMT. This
+  class can be used to replace the standard TextEncoder
+  implementation with a fixed vocabulary size. Note that this
+  encoder cannot be used to translate between raw text and
+  integer sequences.
+  """
+
+  def __init__(self, vocab_size):
+    super(DummyTextEncoder, self).__init__(num_reserved_ids=None)
+    self._vocab_size = vocab_size
+
+  def encode(self, s):
+    raise NotImplementedError("Dummy encoder cannot be used to encode.")
+
+  def decode(self, ids):
+    raise NotImplementedError("Dummy encoder cannot be used to decode.")
+
+  @property
+  def vocab_size(self):
+    return self._vocab_size
+
+
+def log_prob_from_logits(logits):
+  """Softmax function."""
+  return logits - tf.reduce_logsumexp(logits, keepdims=True, axis=-1)
+
+
+def expand_input_dims_for_t2t(t):
+  """Expands a [batch_size, len] tensor by two dimensions on the right
+  for using it in a T2T graph.
+  """
+  t = tf.expand_dims(t, -1) # Because of modality
+  t = tf.expand_dims(t, -1) # Because of random reason X
+  return t
+
+
+def gather_2d(params, indices):
+  """Batched version of tf.gather(), see t2t_gibbs.py."""
+  batch_size = tf.shape(params)[0]
+  num_indices = tf.shape(indices)[1]
+  batch_indices = tf.tile(tf.expand_dims(tf.range(batch_size), 1),
+                          [1, num_indices])
+  gather_nd_indices = tf.stack([batch_indices, indices], axis=2)
+  return tf.gather_nd(params, gather_nd_indices)
+
+
+def pad_sentences(sentences):
+  """Creates a [len(sentences), max_len] array padded with zeros."""
+  max_len = max(len(s) for s in sentences)
+  padded = np.zeros((len(sentences), max_len), dtype=np.int32)
+  for i, s in enumerate(sentences):
+    padded[i, :len(s)] = s
+  return padded
+
+
+def gen_seg_and_pos(glued):
+  """Segment and position features for a glued document."""
+  seg = []
+  pos = []
+  cur_seg = 1
+  cur_pos = 0
+  for w in glued:
+    seg.append(cur_seg)
+    pos.append(cur_pos)
+    if w == BOS_ID:
+      cur_seg += 1
+      cur_pos = 0
+    else:
+      cur_pos += 1
+  return seg, pos
+
+
+class ServedModel(object):
+  """T2T model with a batched graph for all operations."""
+
+  def __init__(self, spec, intra_op_threads=0):
+    self.name = spec["name"]
+    self.glue_lm = spec.get("glue_lm", False)
+    self.trg_vocab_size = spec["trg_vocab_size"]
+    self._spec = spec
+    self._intra_op_threads = intra_op_threads
+    start_time = time.time()
+    graph = tf.Graph()
+    with graph.as_default():
+      hparams = trainer_lib.create_hparams(spec["hparams_set"])
+      self._add_problem_hparams(hparams)
+      translate_model = registry.model(spec["model"])(
+          hparams, tf.estimator.ModeKeys.EVAL)
+      self._targets_var = tf.placeholder(dtype=tf.int32, shape=[None, None],
+                                         name="server_targets")
+      features = {"targets": expand_input_dims_for_t2t(self._targets_var)}
+      if self.glue_lm:
+        self._targets_seg_var = tf.placeholder(
+            dtype=tf.int32, shape=[None, None], name="server_targets_seg")
+        self._targets_pos_var = tf.placeholder(
+            dtype=tf.int32, shape=[None, None], name="server_targets_pos")
+        features["targets_seg"] = self._targets_seg_var
+        features["targets_pos"] = self._targets_pos_var
+      else:
+        self._inputs_var = tf.placeholder(dtype=tf.int32, shape=[None, None],
+                                          name="server_inputs")
+        features["inputs"] = expand_input_dims_for_t2t(self._inputs_var)
+      translate_model.prepare_features_for_infer(features)
+      translate_model._fill_problem_hparams_features(features)
+      logits, _ = translate_model(features)
+      logits = tf.squeeze(logits, [2, 3])
+      self._log_probs = log_prob_from_logits(logits)
+      no_pad = tf.cast(tf.not_equal(self._targets_var, PAD_ID), tf.float32)
+      shp = tf.shape(self._targets_var)
+      flat_bsz = shp[0] * shp[1]
+      word_log_probs = gather_2d(
+          tf.reshape(self._log_probs, [flat_bsz, -1]),
+          tf.reshape(self._targets_var, [flat_bsz, 1]))
+      self._word_log_probs = tf.reshape(word_log_probs,
+                                        (shp[0], shp[1])) * no_pad
+      self._sentence_scores = tf.reduce_sum(self._word_log_probs, -1)
+      self._pos_var = tf.placeholder(dtype=tf.int32, shape=[None],
+                                     name="server_pos")
+      self._temperature_var = tf.placeholder_with_default(
+          1.0, shape=(), name="server_temperature")
+      pos_logits = tf.squeeze(gather_2d(self._log_probs,
+                                        tf.expand_dims(self._pos_var, 1)), 1)
+      self._samples = tf.to_int32(tf.squeeze(
+          tf.multinomial(pos_logits / self._temperature_var, 1), -1))
+      self.mon_sess = self._create_session()
+    logging.info("Loaded model %s in %.2fs" % (self.name,
+                                               time.time() - start_time))
+
+  def _add_problem_hparams(self, hparams):
+    problem = registry.problem(self._spec["problem"])
+    problem._encoders = {
+        "targets": DummyTextEncoder(vocab_size=self.trg_vocab_size)
+    }
+    if not self.glue_lm:
+      problem._encoders["inputs"] = DummyTextEncoder(
+          vocab_size=self._spec["src_vocab_size"])
+    p_hparams = problem.get_hparams(hparams)
+    hparams.problem = problem
+    hparams.problem_hparams = p_hparams
+    return hparams
+
+  def _create_session(self):
+    graph_options = tf.GraphOptions(optimizer_options=tf.OptimizerOptions(
+        opt_level=tf.OptimizerOptions.L1, do_function_inlining=False))
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=self._intra_op_threads,
+        allow_soft_placement=True,
+        graph_options=graph_options,
+        gpu_options=tf.GPUOptions(per_process_gpu_memory_fraction=0.95),
+        log_device_placement=False)
+    checkpoint_path = self._spec["checkpoint"]
+    if os.path.isdir(checkpoint_path):
+      checkpoint_path = saver.latest_checkpoint(checkpoint_path)
+    return training.MonitoredSession(
+        session_creator=training.ChiefSessionCreator(
+            checkpoint_filename_with_path=checkpoint_path,
+            config=config))
+
+  def run(self, op, src_sentences, trg_sentences, pos=None, temperature=1.0):
+    """Runs an operation on a batch of sentences.
+
+    Returns:
+      A list with the result for each target sentence.
+    """
+    trg_batch = pad_sentences(trg_sentences)
+    feed_dict = {self._targets_var: trg_batch}
+    if self.glue_lm:
+      seg_batch = np.zeros_like(trg_batch)
+      pos_batch = np.zeros_like(trg_batch)
+      for i, trg_sentence in enumerate(trg_sentences):
+        seg, positions = gen_seg_and_pos(trg_sentence)
+        seg_batch[i, :len(seg)] = seg
+        pos_batch[i, :len(positions)] = positions
+      feed_dict[self._targets_seg_var] = seg_batch
+      feed_dict[self._targets_pos_var] = pos_batch
+    else:
+      feed_dict[self._inputs_var] = pad_sentences(src_sentences)
+    if op == "score":
+      word_log_probs = self.mon_sess.run(self._word_log_probs, feed_dict)
+      return [lp[:len(t)] for lp, t in zip(word_log_probs, trg_sentences)]
+    if op == "force_decode":
+      log_probs = self.mon_sess.run(self._log_probs, feed_dict)
+      return [lp[:len(t)] for lp, t in zip(log_probs, trg_sentences)]
+    feed_dict[self._pos_var] = pos
+    feed_dict[self._temperature_var] = temperature
+    samples, sentence_scores = self.mon_sess.run(
+        (self._samples, self._sentence_scores), feed_dict)
+    return list(zip(samples, sentence_scores))
+
+
+class Request(object):
+  """Client request waiting in the queue of a Batcher."""
+
+  def __init__(self, msg):
+    self.op = msg["op"]
+    self.trg = list(msg["trg"])
+    self.src = list(msg["src"]) if msg.get("src") is not None else None
+    self.pos = msg.get("pos")
+    self.temperature = msg.get("temperature", 1.0)
+    self.n_tokens = sum(len(t) for t in self.trg)
+    if self.src is not None:
+      self.n_tokens += sum(len(s) for s in self.src)
+    self.result = None
+    self.error = None
+    self.done = threading.Event()
+
+  def key(self):
+    """Requests with the same key can be run in the same batch."""
+    return self.op, self.temperature
+
+
+class Batcher(threading.Thread):
+  """Runs the requests for a model in a background thread and combines
+  concurrent requests into shared batches.
+  """
+
+  def __init__(self, model, max_tokens, timeout):
+    super(Batcher, self).__init__()
+    self.daemon = True
+    self._model = model
+    self._max_tokens = max_tokens
+    self._timeout = timeout
+    self._queue = queue.Queue()
+    self.n_requests = 0
+    self.n_batches = 0
+
+  def submit(self, request):
+    """Blocks until `request` has been processed."""
+    self._queue.put(request)
+    request.done.wait()
+    if request.error is not None:
+      raise request.error
+    return request.result
+
+  def _collect(self, pending):
+    """Waits up to timeout for more requests."""
+    if not pending:
+      pending.append(self._queue.get())
+    deadline = time.time() + self._timeout
+    while sum(r.n_tokens for r in pending) < self._max_tokens:
+      remaining = deadline - time.time()
+      if remaining <= 0.0:
+        break
+      try:
+        pending.append(self._queue.get(timeout=remaining))
+      except queue.Empty:
+        break
+
+  def run(self):
+    pending = []
+    while True:
+      self._collect(pending)
+      key = pending[0].key()
+      batch = []
+      rest = []
+      n_tokens = 0
+      for request in pending:
+        if request.key() == key and (
+            not batch or n_tokens + request.n_tokens <= self._max_tokens):
+          batch.append(request)
+          n_tokens += request.n_tokens
+        else:
+          rest.append(request)
+      pending = rest
+      self._run_batch(batch)
+
+  def _run_batch(self, batch):
+    self.n_requests += len(batch)
+    self.n_batches += 1
+    try:
+      trg = [t for r in batch for t in r.trg]
+      src = None if self._model.glue_lm else [s for r in batch for s in r.src]
+      pos = None
+      if batch[0].op == "sample":
+        pos = np.concatenate([np.asarray(r.pos, dtype=np.int32)
+                              for r in batch])
+      results = self._model.run(batch[0].op, src, trg, pos,
+                                batch[0].temperature)
+      start = 0
+      for r in batch:
+        r.result = results[start:start+len(r.trg)]
+        start += len(r.trg)
+      logging.debug("Model %s: batch of %d requests with %d tokens"
+                    % (self._model.name, len(batch),
+                       sum(r.n_tokens for r in batch)))
+    except Exception as e:
+      for r in batch:
+        r.error = e
+    for r in batch:
+      r.done.set()
+
+
+class ScoringServer(object):
+  """Dispatches client messages to the Batchers of the models."""
+
+  def __init__(self, served_models, max_tokens, timeout):
+    self.models = {m.name: m for m in served_models}
+    self.batchers = {}
+    for m in served_models:
+      self.batchers[m.name] = Batcher(m, max_tokens, timeout)
+      self.batchers[m.name].start()
+
+  def handle(self, msg):
+    op = msg.get("op")
+    if op == "list":
+      return {name: {"glue_lm": m.glue_lm,
+                     "trg_vocab_size": m.trg_vocab_size}
+              for name, m in self.models.items()}
+    if op not in OPS:
+      raise ValueError("Unknown operation %s" % op)
+    if msg.get("model") not in self.models:
+      raise ValueError("Unknown model %s" % msg.get("model"))
+    if not msg["trg"]:
+      if op == "sample":
+        return np.zeros(0, np.int32), np.zeros(0, np.float32)
+      return []
+    request = Request(msg)
+    result = self.batchers[msg["model"]].submit(request)
+    if op == "sample":
+      samples, sentence_scores = zip(*result)
+      return np.array(samples), np.array(sentence_scores)
+    return result
+
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+  """Handles all messages of a client connection."""
+
+  def handle(self):
+    while True:
+      try:
+        msg = recv_message(self.request)
+      except EOFError:
+        return
+      try:
+        response = {"result": self.server.scoring_server.handle(msg)}
+      except Exception as e:
+        logging.exception("Error while processing request")
+        response = {"error": "%s: %s" % (type(e).__name__, e)}
+      send_message(self.request, response)
+
+
+class _ThreadingUnixServer(socketserver.ThreadingMixIn,
+                           socketserver.UnixStreamServer):
+  daemon_threads = True
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Serves T2T models over a Unix socket')
+  parser.add_argument('-c', '--config', help='JSON file with the model specifications', required=True)
+  parser.add_argument('-s', '--socket', help='Path to the Unix socket', required=True)
+  parser.add_argument('-tu', '--t2t_usr_dir', help='usr directory', required=False, default="")
+  parser.add_argument('--max_tokens_per_batch', help='Maximum number of tokens in a shared batch', default=8192, type=int)
+  parser.add_argument('--batch_timeout_ms', help='Time to wait for concurrent requests before running a batch', default=5.0, type=float)
+  parser.add_argument('--intra_op_threads', help='Number of intra-op threads per TF session (0: TF default)', default=0, type=int)
+  parser.add_argument('--verbose', help='Log every batch', action='store_true')
+  args = parser.parse_args()
+  logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+  tf.logging.set_verbosity(tf.logging.INFO)
+  usr_dir.import_usr_dir(args.t2t_usr_dir)
+  with open(args.config) as config_reader:
+    specs = json.load(config_reader)
+  served_models = [ServedModel(spec, args.intra_op_threads)
+                   for spec in specs]
+  if os.path.exists(args.socket):
+    os.remove(args.socket)
+  # Messages are pickled, so only the owner may connect. The umask
+  # applies when the socket is bound, so there is no window in which
+  # the socket is accessible to other users.
+  old_umask = os.umask(0o077)
+  try:
+    server = _ThreadingUnixServer(args.socket, _ConnectionHandler)
+  finally:
+    os.umask(old_umask)
+  server.scoring_server = ScoringServer(served_models,
+                                        args.max_tokens_per_batch,
+                                        args.batch_timeout_ms / 1000.0)
+  logging.info("Serving %s on %s" % (", ".join(s["name"] for s in specs),
+                                     args.socket))
+  try:
+    server.serve_forever()
+  finally:
+    server.server_close()
+    os.remove(args.socket)
+
+
+if __name__ == '__main__':
+  main()
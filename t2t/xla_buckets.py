@@ -0,0 +1,60 @@
+# coding=utf-8
+r"""Fixed-shape buckets for XLA-compiled scoring graphs.
+
+A bucket list is given as comma-separated <batch_size>x<length> pairs,
+e.g. "8x32,8x64,16x32". Batches are padded with PAD (0) to the smallest
+bucket which fits both dimensions, so XLA compiles each bucket once and
+reuses the executable for the rest of the run.
+
+  buckets = xla_buckets.parse_buckets("8x32,8x64")
+  bucket = xla_buckets.find_bucket(buckets, 5, 40)  # (8, 64)
+  padded = xla_buckets.pad_to_bucket(batch, bucket)
+"""
+
+import numpy as np
+
+PAD_ID = 0
+
+
+def parse_buckets(spec):
+  """Parses a bucket specification.
+
+  Returns:
+    List of (batch_size, length) tuples sorted by size.
+  """
+  buckets = set()
+  for entry in spec.split(","):
+    entry = entry.strip()
+    if not entry:
+      continue
+    try:
+      batch_size, length = map(int, entry.lower().split("x"))
+    except ValueError:
+      raise AttributeError("Invalid bucket '%s', expected <batch>x<length>"
+                           % entry)
+    if batch_size < 1 or length < 1:
+      raise AttributeError("Invalid bucket '%s'" % entry)
+    buckets.add((batch_size, length))
+  return sorted(buckets, key=lambda b: (b[0] * b[1], b))
+
+
+def find_bucket(buckets, batch_size, length):
+  """Returns the smallest bucket with at least `batch_size` rows and
+  `length` columns, or None if no bucket is large enough.
+  """
+  for bucket in buckets:
+    if bucket[0] >= batch_size and bucket[1] >= length:
+      return bucket
+  return None
+
+
+def pad_to_bucket(batch, bucket):
+  """Pads a [batch_size, length] array with PAD to the bucket shape."""
+  return np.pad(batch, ((0, bucket[0] - batch.shape[0]),
+                        (0, bucket[1] - batch.shape[1])), 'constant',
+                constant_values=PAD_ID)
+
+
+def pad_rows(values, batch_size):
+  """Pads a 1D array with zeros to `batch_size` entries."""
+  return np.pad(values, (0, batch_size - len(values)), 'constant')